@@ -0,0 +1,99 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+#
+# Copyright 2013 Mellanox Technologies, Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+eSwitchHandler benchmarks on top of the simulator.
+
+Usage (from the daemon directory):
+    python -m benchmarks.daemon_bench [vfs...]
+
+For every VF count a single fabric is simulated with all its VFs
+usable as direct devices; a quarter of them are attached to running
+domains of one interface each.
+"""
+
+import sys
+import timeit
+
+from nova.openstack.common import cfg
+from common import config
+from eswitch_handler import eSwitchHandler
+from resource_mngr import ResourceManager
+from simulator import fake_libvirt
+from simulator import fake_sysfs
+
+VFS = (128, 256, 512, 1024)
+FABRIC = 'sim'
+PF = 'simpf0'
+PCI_ID = '0000:03:00'
+ITERATIONS = 20
+
+
+def _report(name, seconds, ops=1):
+    print "  %-20s %10.3f msec/op %10.0f ops/sec" % (name,
+                                                     seconds * 1e3 / ops,
+                                                     ops / seconds)
+
+
+def run(vfs):
+    sysfs = fake_sysfs.FakeSysfs()
+    try:
+        eths, hostdevs = sysfs.add_pf(PF, PCI_ID, vfs=vfs)
+        conn = fake_libvirt.FakeConnection()
+        conn.create_domains(vfs / 4, eths)
+        rm = ResourceManager(sysfs_root=sysfs.root, libvirt_factory=conn)
+        handler = eSwitchHandler(rm=rm)
+        print "%d VFs, %d domains" % (vfs, len(conn.domains))
+        timer = timeit.default_timer
+
+        start = timer()
+        handler.add_fabrics([(FABRIC, PF)])
+        _report('add_fabrics', timer() - start)
+
+        start = timer()
+        for i in range(ITERATIONS):
+            handler.sync_devices()
+        _report('sync_devices', timer() - start, ITERATIONS)
+
+        macs = [fake_libvirt.make_mac(0x800000 + i)
+                for i in range(len(rm.get_free_eths(FABRIC)))]
+        start = timer()
+        for mac in macs:
+            handler.create_port(FABRIC, 'direct', 'instance', mac)
+        _report('create_port', timer() - start, len(macs))
+
+        start = timer()
+        for i in range(ITERATIONS):
+            handler.get_vnics([FABRIC])
+        _report('get_vnics', timer() - start, ITERATIONS)
+
+        start = timer()
+        for mac in macs:
+            handler.delete_port(FABRIC, mac)
+        _report('delete_port', timer() - start, len(macs))
+    finally:
+        sysfs.cleanup()
+
+
+def main(argv):
+    cfg.CONF(args=[], project='mlnx_daemon', default_config_files=[])
+    for vfs in [int(arg) for arg in argv] or VFS:
+        run(vfs)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,83 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+#
+# Copyright 2013 Mellanox Technologies, Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+DeviceDB allocate/free/lookup cost.
+
+Usage (from the daemon directory):
+    python -m benchmarks.device_db_bench [fabrics] [vfs]
+
+The vfs are spread evenly across the fabrics.
+"""
+
+import sys
+import timeit
+
+from db import device_db
+
+FABRICS = 8
+VFS = 1024
+
+
+def build_db(fabrics, vfs):
+    db = device_db.DeviceDB()
+    for index in range(fabrics):
+        fabric = 'fabric%d' % index
+        db.add_fabric(fabric, 'eth%d' % index, '0000:%02x:00.0' % index, 1)
+        db.set_fabric_devices(fabric,
+                              ['eth%d_%d' % (index, vf) for vf in range(vfs)],
+                              ['0000:%02x:00.%d' % (index, vf)
+                               for vf in range(vfs)])
+    return db
+
+
+def _report(name, seconds, ops):
+    print "%-24s %10.2f usec/op" % (name, seconds * 1e6 / ops)
+
+
+def run(fabrics=FABRICS, vfs=VFS):
+    vfs = vfs // fabrics
+    db = build_db(fabrics, vfs)
+    devs = ['eth%d_%d' % (index, vf)
+            for index in range(fabrics) for vf in range(vfs)]
+    print "%d fabrics x %d devices" % (fabrics, vfs)
+
+    timer = timeit.default_timer
+    start = timer()
+    for dev in devs:
+        db.get_dev_fabric(dev)
+    _report('get_dev_fabric', timer() - start, len(devs))
+
+    start = timer()
+    for dev in devs:
+        db.allocate_device(db.get_dev_fabric(dev), True, dev)
+    _report('allocate_device(dev)', timer() - start, len(devs))
+
+    start = timer()
+    for dev in devs:
+        db.deallocate_device(db.get_dev_fabric(dev), True, dev)
+    _report('deallocate_device', timer() - start, len(devs))
+
+    start = timer()
+    for index in range(fabrics):
+        for vf in range(vfs):
+            db.allocate_device('fabric%d' % index, False)
+    _report('allocate_device(any)', timer() - start, fabrics * vfs)
+
+
+if __name__ == '__main__':
+    run(*[int(arg) for arg in sys.argv[1:]])
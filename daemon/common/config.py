@@ -22,15 +22,87 @@ DEAFAULT_INTERFACE_MAPPINGS = []
 mlx_daemon_opts = [
                     cfg.StrOpt('socket_vif', default="tcp://0.0.0.0:5001"),
                     cfg.StrOpt('socket_of', default="tcp://0.0.0.0:5000"),
+                    cfg.StrOpt('socket_events', default="tcp://0.0.0.0:5002",
+                               help=('PUB socket for vNIC attach, detach and '
+                                     'VLAN events and job completion '
+                                     'notifications')),
                     cfg.ListOpt('fabrics',
                                 default=DEAFAULT_INTERFACE_MAPPINGS,
                                 help=("List of <physical_network>:<physical_interface>")),
                     cfg.IntOpt('default_timeout',
                                default=5000,
                                help=('Default timeout waiting for messages')),
-                    cfg.IntOpt('max_polling_count',
-                               default=5,
-                               help=('Daemon will do sync after max_polling_count * default_timeout'))
+                    cfg.IntOpt('sync_interval',
+                               default=300,
+                               help=('Interval in seconds between full device syncs')),
+                    cfg.BoolOpt('libvirt_events',
+                                default=True,
+                                help=('Sync domain devices on libvirt lifecycle events')),
+                    cfg.BoolOpt('uevents',
+                                default=True,
+                                help=('Track VF hotplug through kernel uevents, '
+                                      'otherwise devices are rescanned every sync_interval')),
+                    cfg.StrOpt('sysfs_root',
+                               default='/sys',
+                               help=('Root of the sysfs tree devices are discovered in')),
+                    cfg.StrOpt('link_backend',
+                               default='netlink',
+                               help=('VF VLAN configuration through netlink or ip commands (ip)')),
+                    cfg.IntOpt('vlan_batch_window',
+                               default=10,
+                               help=('Milliseconds to gather VF VLAN changes of a PF into one batch')),
+                    cfg.BoolOpt('vlan_link_bounce',
+                                default=True,
+                                help=('Set the VF netdev down while changing its VLAN, '
+                                      'disable for drivers applying VLAN changes live')),
+                    cfg.BoolOpt('privileged_helper',
+                                default=True,
+                                help=('Run privileged commands through a helper process started once')),
+                    cfg.StrOpt('root_helper',
+                               default='sudo',
+                               help=('Command prefix used to run privileged commands')),
+                    cfg.IntOpt('command_timeout',
+                               default=10,
+                               help=('Seconds an external command may run before it is killed, 0 for no limit')),
+                    cfg.IntOpt('command_retries',
+                               default=1,
+                               help=('Times a timed out external command is run again')),
+                    cfg.IntOpt('command_concurrency',
+                               default=8,
+                               help=('External commands running at once, 0 for no limit')),
+                    cfg.IntOpt('command_pf_concurrency',
+                               default=2,
+                               help=('External commands running at once on the same PF, 0 for no limit')),
+                    cfg.IntOpt('libvirt_workers',
+                               default=0,
+                               help=('Threads fetching domain XML during a sync, 0 or 1 to fetch serially')),
+                    cfg.IntOpt('response_cache_size',
+                               default=1024,
+                               help=('Responses kept for requests retried with the same req_id')),
+                    cfg.StrOpt('state_dir',
+                               default='/var/lib/mlnx_daemon',
+                               help=('Directory of the persistent vNIC state journal, empty to disable')),
+                    cfg.IntOpt('journal_commit_interval',
+                               default=10,
+                               help=('Milliseconds to gather journal records into one fsync')),
+                    cfg.IntOpt('journal_compact_records',
+                               default=10000,
+                               help=('Journal records written before compacting into a snapshot')),
+                    cfg.StrOpt('metrics_host',
+                               default='127.0.0.1',
+                               help=('Address of the Prometheus metrics endpoint')),
+                    cfg.IntOpt('metrics_port',
+                               default=0,
+                               help=('Port of the Prometheus metrics endpoint, 0 to disable')),
+                    cfg.ListOpt('encodings',
+                                default=['msgpack', 'json'],
+                                help=('Wire encodings offered to clients, in order of preference')),
+                    cfg.IntOpt('workers',
+                               default=4,
+                               help=('Number of worker threads serving socket_vif and socket_of requests')),
+                    cfg.IntOpt('job_workers',
+                               default=4,
+                               help=('Number of threads running asynchronous jobs')),
 
 ]
 cfg.CONF.register_opts(mlx_daemon_opts, "DAEMON")
@@ -15,72 +15,138 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import collections
+
 from nova.openstack.common import log as logging
 
 LOG = logging.getLogger('mlnx_daemon')
 
 class DeviceDB():
+    """
+    Devices of every fabric with their free pools.
+    Free pools are ordered sets (OrderedDict keys) so that allocating a
+    given device, releasing it and membership tests are O(1) while
+    allocation order stays deterministic (last freed, first allocated).
+    dev_fabric is a reverse index from device to fabric.
+    """
     def __init__(self):
-            self.device_db  = {}
-            
+        self.device_db  = {}
+        self.dev_fabric = {}
+
     def get_pf(self,fabric):
         return self.device_db[fabric]['pf']
-    
-    def add_fabric(self,fabric,pf,pci_id,hca_port):  
-        list_keys = ['vfs','eths','free_vfs','reserved_vfs','free_eths','reserved_eths']  
+
+    def add_fabric(self,fabric,pf,pci_id,hca_port):
         details = {}
-        for key in list_keys:
-            details[key]=[]
-        details['pf'] = pf 
+        for key in ['vfs','eths']:
+            details[key] = set()
+        for key in ['free_vfs','free_eths']:
+            details[key] = collections.OrderedDict()
+        details['pf'] = pf
         details['pci_id'] = pci_id
-        details['hca_port'] = hca_port          
+        details['hca_port'] = hca_port
         self.device_db[fabric] = details
-        
+
     def set_fabric_devices(self,fabric,eths,vfs):
-        self.device_db[fabric]['vfs'] = vfs
-        self.device_db[fabric]['free_vfs'] = vfs[:]
-        self.device_db[fabric]['eths'] = eths
-        self.device_db[fabric]['free_eths'] = eths[:]
-        
+        details = self.device_db[fabric]
+        for dev in details['vfs'] | details['eths']:
+            self.dev_fabric.pop(dev, None)
+        details['vfs'] = set(vfs)
+        details['free_vfs'] = collections.OrderedDict.fromkeys(vfs)
+        details['eths'] = set(eths)
+        details['free_eths'] = collections.OrderedDict.fromkeys(eths)
+        for dev in vfs + eths:
+            self.dev_fabric[dev] = fabric
+
     def get_free_eths(self, fabric):
-        return self.device_db[fabric]['free_eths']
-    
+        return self.device_db[fabric]['free_eths'].keys()
+
     def get_free_vfs(self,fabric):
-        return self.device_db[fabric]['free_vfs']
-    
+        return self.device_db[fabric]['free_vfs'].keys()
+
     def get_free_devices(self,fabric):
-        return self.device_db[fabric]['free_vfs'] + self.device_db[fabric]['free_eths']
-    
+        return self.get_free_vfs(fabric) + self.get_free_eths(fabric)
+
     def get_dev_fabric(self,dev):
-        for fabric in self.device_db:
-            if dev in self.device_db[fabric]['vfs']+self.device_db[fabric]['eths']:
+        return self.dev_fabric.get(dev)
+
+    def get_pci_fabric(self, pci_id):
+        """
+        @param pci_id: PF PCI address without the function (bus:slot)
+        """
+        for fabric, details in self.device_db.iteritems():
+            if details['pci_id'] == pci_id:
                 return fabric
-            
+
+    def get_hca_port(self, fabric):
+        return self.device_db[fabric]['hca_port']
+
     def allocate_device(self,fabric,is_device=True,dev=None):
         available_resources = self.device_db[fabric]['free_vfs']
         if is_device:
             available_resources = self.device_db[fabric]['free_eths']
         try:
             if dev:
-                available_resources.remove(dev)
+                del available_resources[dev]
             else:
-                dev = available_resources.pop()
+                dev = available_resources.popitem()[0]
             return dev
-        except Exception, e:
+        except KeyError:
             LOG.error("exception on device allocation on dev  %s",dev)
             return None
-        
+
     def deallocate_device(self,fabric,is_device,dev):
         resources = self.device_db[fabric]['vfs']
         available_resources = self.device_db[fabric]['free_vfs']
         if is_device:
             resources = self.device_db[fabric]['eths']
             available_resources = self.device_db[fabric]['free_eths']
-        if dev in resources:                          
-            available_resources.append(dev)
-            return dev          
+        if dev in resources:
+            # re-inserting moves the device to the end of the pool
+            available_resources.pop(dev, None)
+            available_resources[dev] = None
+            return dev
         else:
             return None
-        
- 
-        
+
+    def _get_pools(self, fabric, is_device):
+        details = self.device_db[fabric]
+        if is_device:
+            return details['eths'], details['free_eths']
+        return details['vfs'], details['free_vfs']
+
+    def has_device(self, fabric, is_device, dev):
+        return dev in self._get_pools(fabric, is_device)[0]
+
+    def get_devices(self, fabric, is_device):
+        return set(self._get_pools(fabric, is_device)[0])
+
+    def add_device(self, fabric, is_device, dev):
+        """
+        @note: a hotplugged device is added as free
+        """
+        resources, available_resources = self._get_pools(fabric, is_device)
+        if dev not in resources:
+            resources.add(dev)
+            available_resources[dev] = None
+            self.dev_fabric[dev] = fabric
+
+    def remove_device(self, fabric, is_device, dev):
+        """
+        @return: True if the device was free
+        """
+        resources, available_resources = self._get_pools(fabric, is_device)
+        resources.discard(dev)
+        self.dev_fabric.pop(dev, None)
+        return available_resources.pop(dev, False) is None
+
+    def rename_device(self, fabric, is_device, old_dev, new_dev):
+        resources, available_resources = self._get_pools(fabric, is_device)
+        if old_dev not in resources:
+            return False
+        is_free = self.remove_device(fabric, is_device, old_dev)
+        resources.add(new_dev)
+        self.dev_fabric[new_dev] = fabric
+        if is_free:
+            available_resources[new_dev] = None
+        return True
@@ -15,103 +15,252 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import collections
+
 from nova.openstack.common import log as logging
+from db import journal as journal_ops
 
 LOG = logging.getLogger('mlnx_daemon')
 
+# attach/detach changes kept for get_vnics_since
+CHANGE_LOG_SIZE = 1024
+
+class Port(object):
+    __slots__ = ('name', 'type', 'vnic')
+
+    def __init__(self, name, port_type):
+        self.name = name
+        self.type = port_type
+        self.vnic = None
+
+
+class VnicPolicy(object):
+    __slots__ = ('mac', 'vlan', 'dev', 'device_id')
+
+    def __init__(self, mac, dev=None, device_id=None):
+        self.mac = mac
+        self.vlan = None
+        self.dev = dev
+        self.device_id = device_id
+
+
 class eSwitchDB():
+        """
+        port_table: {dev: Port}, port_policy: {vnic_mac: VnicPolicy}
+        (vnic_mac -> dev). Secondary indexes are kept on every change:
+        dev_vnic: {dev: vnic_mac} of attached ports,
+        device_vnics: {device_id: set(vnic_mac)} of attached vNICs,
+        vlan_vnics: {vlan: set(vnic_mac)}.
+        Every change of the attached vNICs bumps generation and is kept in
+        the bounded changes log as (generation, vnic_mac).
+        listener, if set, is called as listener(fabric, event, vnic_mac,
+        **fields) on every attach, detach and VLAN change.
+        """
 
-        def __init__(self):
+        def __init__(self, fabric=None, journal=None):
+            self.fabric = fabric
+            self.journal = journal
+            self.listener = None
             self.port_table  = {}
             self.port_policy = {}
-                           
+            self.dev_vnic = {}
+            self.device_vnics = {}
+            self.vlan_vnics = {}
+            self.attached_vnics = None
+            self.generation = 0
+            self.changes = collections.deque(maxlen=CHANGE_LOG_SIZE)
+
+        def _log(self, op, **args):
+            if self.journal:
+                self.journal.append(self.fabric, op, **args)
+
+        def _notify(self, event, vnic_mac, **fields):
+            if self.listener:
+                self.listener(self.fabric, event, vnic_mac, **fields)
+
+        def _index_add(self, index, key, vnic_mac):
+            if key is not None:
+                index.setdefault(key, set()).add(vnic_mac)
+
+        def _index_remove(self, index, key, vnic_mac):
+            macs = index.get(key)
+            if macs is not None:
+                macs.discard(vnic_mac)
+                if not macs:
+                    del index[key]
+
+        def _set_port_vnic(self, dev, vnic_mac):
+            old_mac = self.dev_vnic.pop(dev, None)
+            if old_mac in self.port_policy:
+                self._index_remove(self.device_vnics,
+                                   self.port_policy[old_mac].device_id, old_mac)
+            self.port_table[dev].vnic = vnic_mac
+            if vnic_mac:
+                self.dev_vnic[dev] = vnic_mac
+            self.attached_vnics = None
+            for mac in set([old_mac, vnic_mac]) - set([None]):
+                self.generation += 1
+                self.changes.append((self.generation, mac))
+
         def create_port(self, port_name, port_type):
-            self.port_table.update({port_name: {'type':port_type, 'vnic':None}})
+            self.port_table[port_name] = Port(port_name, port_type)
+
+        def remove_port(self, port_name):
+            """
+            @return: MAC of the vNIC detached from the removed port
+            """
+            vnic_mac = self.dev_vnic.get(port_name)
+            if vnic_mac:
+                self.detach_vnic(vnic_mac)
+            self.port_table.pop(port_name, None)
+            return vnic_mac
+
+        def rename_port(self, old_name, new_name):
+            port = self.port_table.pop(old_name, None)
+            if port is None:
+                return
+            port.name = new_name
+            self.port_table[new_name] = port
+            if old_name in self.dev_vnic:
+                self.dev_vnic[new_name] = self.dev_vnic.pop(old_name)
+            for vnic in self.port_policy.itervalues():
+                if vnic.dev == old_name:
+                    vnic.dev = new_name
+                    self._log(journal_ops.OP_RENAME, mac=vnic.mac, dev=new_name)
 
         def get_ports(self):
             return self.port_table
 
         def get_port_type(self,dev):
-            return self.port_table[dev]['type']
-            
+            return self.port_table[dev].type
+
         def get_attached_vnics(self):
-            vnics = {}
-            for port in self.port_table.values():
-                vnic_mac = port['vnic']
-                if vnic_mac:
-                    vnics[vnic_mac]={'mac':vnic_mac,
-                                    'device_id':self.port_policy[vnic_mac]['device_id']}
-            return vnics      
-                 
+            """
+            @return: {vnic_mac: {'mac', 'device_id'}} - shared, do not modify
+            """
+            if self.attached_vnics is None:
+                vnics = {}
+                for vnic_mac in self.dev_vnic.itervalues():
+                    vnic = self.port_policy.get(vnic_mac)
+                    vnics[vnic_mac] = {'mac':vnic_mac,
+                                       'device_id':vnic.device_id if vnic else None}
+                self.attached_vnics = vnics
+            return self.attached_vnics
+
+        def get_vnics_since(self, generation):
+            """
+            @param generation: generation the caller is in sync with
+            @return: ({vnic_mac: vnic} attached, [vnic_mac] detached) since
+                     generation, None if the changes log no longer covers it
+            """
+            if generation == self.generation:
+                return {}, []
+            if (generation > self.generation or not self.changes or
+                self.changes[0][0] > generation + 1):
+                return None
+            changed = set()
+            for change_generation, vnic_mac in reversed(self.changes):
+                if change_generation <= generation:
+                    break
+                changed.add(vnic_mac)
+            vnics = self.get_attached_vnics()
+            added = {}
+            removed = []
+            for vnic_mac in changed:
+                if vnic_mac in vnics:
+                    added[vnic_mac] = vnics[vnic_mac]
+                else:
+                    removed.append(vnic_mac)
+            return added, removed
+
+        def get_vnics_for_device(self, device_id):
+            """
+            @return: MACs of the vNICs attached for instance device_id
+            """
+            return list(self.device_vnics.get(device_id, ()))
+
+        def get_vnics_for_vlan(self, vlan):
+            return list(self.vlan_vnics.get(vlan, ()))
+
         def get_port_policy(self):
             return self.port_policy
         
         def create_vnic(self, vnic_mac):
             if not self.vnic_exists(vnic_mac):
-                self.port_policy.update({vnic_mac: {'vlan':None,'dev':None,'device_id':None,'port_id':None}})
+                self.port_policy[vnic_mac] = VnicPolicy(vnic_mac)
             
         def get_dev_type(self, dev):
-            dev_type = None
-
-            if dev in self.port_table:
-                dev_type = self.port_table[dev]['type']
-            return dev_type
+            port = self.port_table.get(dev)
+            if port:
+                return port.type
+            return None
         
         def get_dev_type_for_vnic(self, vnic_mac):
-            dev = None
-
-            if vnic_mac in self.port_policy:
-                if 'dev' in self.port_policy[vnic_mac]:
-                    dev = self.port_policy[vnic_mac]['dev']
+            dev = self.get_dev_for_vnic(vnic_mac)
             if dev:                     
-                return self.port_table[dev]['type']
+                return self.port_table[dev].type
             else:
                 return None
          
         def get_dev_for_vnic(self, vnic_mac):
-            dev = None
-            if vnic_mac in self.port_policy:
-                if 'dev' in self.port_policy[vnic_mac]:
-                    dev = self.port_policy[vnic_mac]['dev']
-            return dev
+            vnic = self.port_policy.get(vnic_mac)
+            if vnic:
+                return vnic.dev
+            return None
 
         def vnic_exists(self, vnic_mac):
-            if vnic_mac in self.port_policy:
-                return True
-            else:
-                return False
+            return vnic_mac in self.port_policy
             
         def attach_vnic(self,port_name, device_id, vnic_mac):
-            self.port_table[port_name]['vnic'] = vnic_mac
-            dev = self.get_dev_for_vnic(vnic_mac)
-            if not dev:
-                self.port_policy.update({vnic_mac: {'vlan':None,
-                                                    'dev':port_name,
-                                                    'device_id':device_id,
-                                                     }})
-                return True
-            return False
+            self._set_port_vnic(port_name, vnic_mac)
+            vnic = self.port_policy.get(vnic_mac)
+            if vnic and vnic.dev:
+                self._index_add(self.device_vnics, vnic.device_id, vnic_mac)
+                return False
+            if vnic:
+                self._index_remove(self.vlan_vnics, vnic.vlan, vnic_mac)
+            self.port_policy[vnic_mac] = VnicPolicy(vnic_mac, port_name,
+                                                    device_id)
+            self._index_add(self.device_vnics, device_id, vnic_mac)
+            self._log(journal_ops.OP_ATTACH, mac=vnic_mac,
+                      dev=port_name, device_id=device_id)
+            self._notify('attach', vnic_mac, dev=port_name, device_id=device_id)
+            return True
                         
         def detach_vnic(self, vnic_mac):
             dev = self.get_dev_for_vnic(vnic_mac)
             if dev:
-                for attr in ['vnic_mac','device_id']:
-                    self.port_policy[vnic_mac][attr] = None
-                self.port_table[dev]['vnic'] = None
+                self._set_port_vnic(dev, None)
+                vnic = self.port_policy[vnic_mac]
+                self._index_remove(self.device_vnics, vnic.device_id, vnic_mac)
+                vnic.device_id = None
+                self._log(journal_ops.OP_DETACH, mac=vnic_mac)
+                self._notify('detach', vnic_mac, dev=dev)
             return dev
         
         def port_release(self, vnic_mac):
-            try:
-                vnic = self.port_policy.pop(vnic_mac)
-                vnic['type'] = self.port_table[vnic['dev']]['type']
-                return vnic
-            except KeyError:
-                return 
-            except IndexError:
+            vnic = self.port_policy.pop(vnic_mac, None)
+            if vnic is None:
                 return
+            self._log(journal_ops.OP_RELEASE, mac=vnic_mac)
+            self._index_remove(self.device_vnics, vnic.device_id, vnic_mac)
+            self._index_remove(self.vlan_vnics, vnic.vlan, vnic_mac)
+            if self.dev_vnic.get(vnic.dev) == vnic_mac:
+                self._set_port_vnic(vnic.dev, None)
+                self._notify('detach', vnic_mac, dev=vnic.dev)
+            port = self.port_table.get(vnic.dev)
+            return {'vlan':vnic.vlan,
+                    'dev':vnic.dev,
+                    'device_id':vnic.device_id,
+                    'type':port.type if port else None}
             
         def set_vlan(self, vnic_mac, vlan):
             if not self.vnic_exists(vnic_mac):
                 self.create_vnic(vnic_mac)
 
-            self.port_policy[vnic_mac]['vlan']=vlan
+            vnic = self.port_policy[vnic_mac]
+            self._index_remove(self.vlan_vnics, vnic.vlan, vnic_mac)
+            vnic.vlan = vlan
+            self._index_add(self.vlan_vnics, vlan, vnic_mac)
+            self._log(journal_ops.OP_VLAN, mac=vnic_mac, vlan=vlan)
+            self._notify('vlan', vnic_mac, vlan=vlan)
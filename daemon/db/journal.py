@@ -0,0 +1,270 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+#
+# Copyright 2013 Mellanox Technologies, Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Persistent journal of the vNIC state held by eSwitchDB.
+
+Every change is appended to the journal as "<crc32> <json record>" and
+made durable by a flusher thread which fsyncs all pending records at
+once (group commit). Once the journal holds compact_records records the
+state is written to a snapshot file and the journal is truncated.
+On startup the snapshot is read through mmap and the journal records
+following it are replayed. A torn record at the journal end is discarded.
+"""
+
+import copy
+import json
+import mmap
+import os
+import threading
+import time
+import zlib
+
+from nova.openstack.common import log as logging
+
+LOG = logging.getLogger('mlnx_daemon')
+
+JOURNAL_FILE = 'eswitch.journal'
+SNAPSHOT_FILE = 'eswitch.snapshot'
+
+OP_ATTACH = 'attach'
+OP_DETACH = 'detach'
+OP_VLAN = 'vlan'
+OP_RELEASE = 'release'
+OP_RENAME = 'rename'
+
+# seconds between attempts to flush a failing journal
+FLUSH_RETRY_INTERVAL = 1
+
+
+def _checksum(data):
+    return '%08x' % (zlib.crc32(data) & 0xffffffff)
+
+
+def apply_record(state, fabric, op, args):
+    """
+    @param state: {fabric: {vnic_mac: vnic}} updated in place
+    """
+    vnics = state.setdefault(fabric, {})
+    mac = args['mac']
+    if op == OP_ATTACH:
+        vnics[mac] = {'dev':args['dev'],
+                      'device_id':args['device_id'],
+                      'vlan':None,
+                      'attached':True}
+    elif op == OP_DETACH:
+        if mac in vnics:
+            vnics[mac]['device_id'] = None
+            vnics[mac]['attached'] = False
+    elif op == OP_VLAN:
+        vnic = vnics.setdefault(mac, {'dev':None,
+                                      'device_id':None,
+                                      'vlan':None,
+                                      'attached':False})
+        vnic['vlan'] = args['vlan']
+    elif op == OP_RELEASE:
+        vnics.pop(mac, None)
+    elif op == OP_RENAME:
+        if mac in vnics:
+            vnics[mac]['dev'] = args['dev']
+
+
+class Journal(object):
+    def __init__(self, state_dir, commit_interval=10, compact_records=10000):
+        """
+        @param state_dir: directory holding the journal and snapshot
+        @param commit_interval: ms to gather records before fsync
+        @param compact_records: journal records triggering a snapshot
+        """
+        self.journal_path = os.path.join(state_dir, JOURNAL_FILE)
+        self.snapshot_path = os.path.join(state_dir, SNAPSHOT_FILE)
+        self.state_dir = state_dir
+        self.commit_interval = commit_interval / 1000.0
+        self.compact_records = compact_records
+        self.cond = threading.Condition()
+        self.state = {}
+        self.seq = 0
+        self.synced_seq = 0
+        self.records = 0
+        self.fd = None
+        # (seq, error) of the last failed flush up to seq, None once a
+        # flush succeeded
+        self.flush_error = None
+
+    def load(self):
+        if not os.path.isdir(self.state_dir):
+            os.makedirs(self.state_dir)
+        start = time.time()
+        self._load_snapshot()
+        valid_size = self._replay_journal()
+        self.fd = open(self.journal_path, 'a+')
+        self.fd.truncate(valid_size)
+        self.synced_seq = self.seq
+        flusher = threading.Thread(target=self._flush_loop,
+                                   name='journal-flusher')
+        flusher.daemon = True
+        flusher.start()
+        LOG.info("Restored state of %d vNICs up to record %d in %.3f sec",
+                 sum(len(vnics) for vnics in self.state.itervalues()),
+                 self.seq, time.time() - start)
+
+    def get_state(self):
+        """
+        @return: copy of the state {fabric: {vnic_mac: vnic}}
+        """
+        with self.cond:
+            return copy.deepcopy(self.state)
+
+    def _load_snapshot(self):
+        if not os.path.exists(self.snapshot_path):
+            return
+        with open(self.snapshot_path, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            if not size:
+                return
+            buf = mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ)
+            try:
+                header_end = buf.find('\n')
+                checksum = buf[:header_end]
+                data = buf[header_end + 1:] if header_end >= 0 else ''
+            finally:
+                buf.close()
+        if not data or _checksum(data) != checksum:
+            LOG.error("Snapshot %s is corrupted - ignored", self.snapshot_path)
+            return
+        snapshot = json.loads(data)
+        self.seq = snapshot['seq']
+        self.state = snapshot['state']
+
+    def _replay_journal(self):
+        """
+        @return: size of the valid journal prefix
+        """
+        valid_size = 0
+        if not os.path.exists(self.journal_path):
+            return valid_size
+        with open(self.journal_path, 'rb') as f:
+            for line in f:
+                if not line.endswith('\n'):
+                    break
+                checksum, _sep, data = line[:-1].partition(' ')
+                if _checksum(data) != checksum:
+                    LOG.warning("Discarding corrupted journal tail at %d",
+                                valid_size)
+                    break
+                seq, fabric, op, args = json.loads(data)
+                valid_size += len(line)
+                if seq <= self.seq:
+                    continue
+                apply_record(self.state, fabric, op, args)
+                self.seq = seq
+                self.records += 1
+        return valid_size
+
+    def append(self, fabric, op, **args):
+        """
+        @note: the record is durable once commit() returns
+        """
+        with self.cond:
+            self.seq += 1
+            apply_record(self.state, fabric, op, args)
+            data = json.dumps([self.seq, fabric, op, args])
+            self.fd.write('%s %s\n' % (_checksum(data), data))
+            self.records += 1
+            self.cond.notify_all()
+            return self.seq
+
+    def commit(self):
+        """
+        @note: wait until all records appended so far are on disk
+        @raise IOError, OSError: if flushing these records failed
+        """
+        with self.cond:
+            target = self.seq
+            while self.synced_seq < target:
+                if self.flush_error and self.flush_error[0] >= target:
+                    raise self.flush_error[1]
+                self.cond.wait()
+
+    def _flush_loop(self):
+        while True:
+            with self.cond:
+                while self.synced_seq == self.seq:
+                    self.cond.wait()
+            # let concurrent requests join this commit
+            time.sleep(self.commit_interval)
+            try:
+                with self.cond:
+                    target = self.seq
+                    self.fd.flush()
+                    fileno = self.fd.fileno()
+                os.fsync(fileno)
+                with self.cond:
+                    self.synced_seq = target
+                    self.flush_error = None
+                    compact = self.records >= self.compact_records
+                    self.cond.notify_all()
+                if compact:
+                    self._compact()
+            except (IOError, OSError), e:
+                LOG.exception("Failed to commit journal")
+                with self.cond:
+                    self.flush_error = (target, e)
+                    self.cond.notify_all()
+                time.sleep(FLUSH_RETRY_INTERVAL)
+
+    def _fsync_dir(self):
+        dir_fd = os.open(self.state_dir, os.O_RDONLY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
+
+    def _compact(self):
+        """
+        @note: the snapshot is written without holding self.cond, records
+               appended meanwhile are moved to the new journal, which
+               replaces the current one under self.cond
+        """
+        with self.cond:
+            self.fd.flush()
+            offset = os.fstat(self.fd.fileno()).st_size
+            seq = self.seq
+            data = json.dumps({'seq':seq, 'state':self.state})
+        tmp_path = self.snapshot_path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write('%s\n%s' % (_checksum(data), data))
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmp_path, self.snapshot_path)
+        self._fsync_dir()
+        with self.cond:
+            self.fd.flush()
+            with open(self.journal_path, 'rb') as f:
+                f.seek(offset)
+                tail = f.read()
+            tmp_path = self.journal_path + '.tmp'
+            with open(tmp_path, 'wb') as f:
+                f.write(tail)
+                f.flush()
+                os.fsync(f.fileno())
+            os.rename(tmp_path, self.journal_path)
+            self._fsync_dir()
+            self.fd.close()
+            self.fd = open(self.journal_path, 'a+')
+            self.records = tail.count('\n')
+        LOG.debug("Journal compacted up to record %d", seq)
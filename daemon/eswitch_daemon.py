@@ -16,27 +16,93 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import collections
 import json
+import socket
 import sys
+import threading
+import time
 import zmq
 from nova.openstack.common import cfg
 from nova.openstack.common import log as logging
+from common import codec
 from common import config
+from db.journal import Journal
 import msg_handler as message
 from eswitch_handler import eSwitchHandler
+from event_publisher import EventPublisher
+from job_mngr import JobManager
+from utils import command_utils
+from utils import stats_utils
 
 LOG = logging.getLogger('mlnx_daemon')
+
+WORKERS_URL = "inproc://mlnx_daemon_workers"
+# first message of a worker, telling it is idle
+WORKER_READY = 'READY'
+EVENTS_URL = "inproc://mlnx_daemon_events"
    
 class MlxEswitchDaemon(object):   
     def __init__(self):
-        self.max_polling_count = cfg.CONF.DAEMON.max_polling_count
+        self.sync_interval = cfg.CONF.DAEMON.sync_interval
         self.default_timeout = cfg.CONF.DAEMON.default_timeout
+        self.workers = cfg.CONF.DAEMON.workers
         fabrics = self._parse_physical_mapping()
-        self.eswitch_handler = eSwitchHandler(fabrics)
-        self.dispatcher = message.MessageDispatch(self.eswitch_handler)
+        journal = self._init_journal()
+        self.eswitch_handler = eSwitchHandler(fabrics, journal)
+        self.job_mngr = JobManager(cfg.CONF.DAEMON.job_workers)
+        self.dispatcher = message.MessageDispatch(self.eswitch_handler,
+                                                  self.job_mngr,
+                                                  cfg.CONF.DAEMON.response_cache_size)
+        # PUSH sockets of the threads reporting events, per thread
+        self.event_sockets = threading.local()
+        # requests waiting for a worker and identities of idle workers
+        self.pending = collections.deque()
+        self.idle_workers = collections.deque()
+        self.uevents = False
        
     def start(self):  
+        command_utils.configure(cfg.CONF.DAEMON.command_timeout,
+                                cfg.CONF.DAEMON.command_retries,
+                                cfg.CONF.DAEMON.command_concurrency,
+                                cfg.CONF.DAEMON.command_pf_concurrency)
+        if cfg.CONF.DAEMON.privileged_helper:
+            try:
+                command_utils.start_helper(cfg.CONF.DAEMON.root_helper)
+            except OSError, e:
+                LOG.warning("Cannot start privileged helper, commands run "
+                            "with %s: %s", cfg.CONF.DAEMON.root_helper, e)
         self._init_connections()
+        self.job_mngr.start(self.publisher)
+        self.eswitch_handler.set_publisher(self.publisher)
+        if cfg.CONF.DAEMON.metrics_port:
+            stats_utils.start_metrics_server(cfg.CONF.DAEMON.metrics_host,
+                                             cfg.CONF.DAEMON.metrics_port)
+        if cfg.CONF.DAEMON.libvirt_events:
+            self.eswitch_handler.rm.start_domain_events(self._domain_event_cb)
+        if cfg.CONF.DAEMON.uevents:
+            try:
+                self.eswitch_handler.rm.start_uevents(self._uevent_cb)
+                self.uevents = True
+            except (socket.error, OSError), e:
+                LOG.warning("Cannot listen for uevents, devices are rescanned "
+                            "every %d sec: %s", self.sync_interval, e)
+        self._start_device_thread()
+
+    def _init_journal(self):
+        state_dir = cfg.CONF.DAEMON.state_dir
+        if not state_dir:
+            return None
+        journal = Journal(state_dir,
+                          cfg.CONF.DAEMON.journal_commit_interval,
+                          cfg.CONF.DAEMON.journal_compact_records)
+        try:
+            journal.load()
+        except (IOError, OSError, ValueError), e:
+            LOG.error("Failed to load state from %s - state is not persisted: %s",
+                      state_dir, e)
+            return None
+        return journal
 
     def _parse_physical_mapping(self):
         fabrics = []
@@ -57,44 +123,149 @@ class MlxEswitchDaemon(object):
         return fabrics
         
     def _init_connections(self):
-        context = zmq.Context()
-        self.socket_of  = context.socket(zmq.PULL)
-        self.socket_vif = context.socket(zmq.REP)
+        self.context = zmq.Context()
+        self.socket_of  = self.context.socket(zmq.PULL)
+        self.socket_vif = self.context.socket(zmq.ROUTER)
+        self.socket_workers = self.context.socket(zmq.ROUTER)
         self.socket_of.bind(cfg.CONF.DAEMON.socket_of)
         self.socket_vif.bind(cfg.CONF.DAEMON.socket_vif)
+        self.socket_workers.bind(WORKERS_URL)
+        self.socket_events = self.context.socket(zmq.PULL)
+        self.socket_events.bind(EVENTS_URL)
+        self.publisher = EventPublisher(self.context,
+                                        cfg.CONF.DAEMON.socket_events)
         self.poller = zmq.Poller()
         self.poller.register(self.socket_of, zmq.POLLIN)
         self.poller.register(self.socket_vif, zmq.POLLIN)
+        self.poller.register(self.socket_workers, zmq.POLLIN)
+        self._start_workers()
+
+    def _start_workers(self):
+        for i in range(self.workers):
+            worker = threading.Thread(target=self._worker_loop,
+                                      name='worker-%d' % i)
+            worker.daemon = True
+            worker.start()
+
+    def _worker_loop(self):
+        """
+        @note: every worker owns a REQ socket connected to the ROUTER
+               back end, it announces itself and then sends the reply of
+               every request, which tells the main loop it is idle again
+        """
+        socket = self.context.socket(zmq.REQ)
+        socket.connect(WORKERS_URL)
+        socket.send(WORKER_READY)
+        while True:
+            frames = socket.recv_multipart()
+            envelope, (source, received, msg) = frames[:-3], frames[-3:]
+            stats_utils.STATS.record(stats_utils.QUEUE, source,
+                                     time.time() - float(received))
+            socket.send_multipart(envelope + [self._handle_raw_msg(msg)])
+
+    def _start_device_thread(self):
+        device_thread = threading.Thread(target=self._device_loop,
+                                         name='device-events')
+        device_thread.daemon = True
+        device_thread.start()
+
+    def _device_loop(self):
+        """
+        @note: device events and periodic syncs are handled here, off the
+               main loop which forwards requests to the workers. The
+               thread owns socket_events from now on.
+        """
+        poller = zmq.Poller()
+        poller.register(self.socket_events, zmq.POLLIN)
+        last_sync = time.time()
+        while True:
+            timeout = max(0, last_sync + self.sync_interval - time.time())
+            if poller.poll(timeout * 1000):
+                self._handle_event(json.loads(self.socket_events.recv()))
+            if time.time() - last_sync >= self.sync_interval:
+                LOG.debug("Resync devices")
+                try:
+                    if not self.uevents:
+                        self.eswitch_handler.rescan_devices()
+                    self.eswitch_handler.sync_devices()
+                except Exception:
+                    LOG.exception("Failed to resync devices")
+                last_sync = time.time()
+
+    def _handle_event(self, event):
+        try:
+            if 'uevent' in event:
+                self.eswitch_handler.handle_uevent(event['uevent'])
+            else:
+                self.eswitch_handler.handle_domain_event(event['uuid'], event['event'])
+        except Exception:
+            LOG.exception("Failed to handle event %s", event)
+
+    def _domain_event_cb(self, uuid, event):
+        """
+        @note: runs in the libvirt event loop thread, the event is passed
+               to the device thread which owns the device state
+        """
+        self._push_event({'uuid':uuid, 'event':event})
+
+    def _uevent_cb(self, uevent):
+        """
+        @note: runs in the uevent monitor thread
+        """
+        self._push_event({'uevent':uevent})
+
+    def _push_event(self, event):
+        socket_events_push = getattr(self.event_sockets, 'socket', None)
+        if socket_events_push is None:
+            socket_events_push = self.context.socket(zmq.PUSH)
+            socket_events_push.connect(EVENTS_URL)
+            self.event_sockets.socket = socket_events_push
+        socket_events_push.send(json.dumps(event))
+
+    def _handle_raw_msg(self, msg):
+        encoding = codec.JSON
+        action = 'unknown'
+        try:
+            data, encoding = codec.decode(msg)
+            action = data.get('action', action)
+            result = self.dispatcher.handle_msg(data)
+        except Exception, e:
+            LOG.exception("Failed to handle message %r", msg)
+            result = {'action':action, 'status':'FAIL', 'reason':str(e)}
+        return codec.encode(result, encoding)
         
     def _get_msg(self):
-        data = None
+        """
+        @note: requests of both sockets are queued and handed to idle
+               workers only, so that a slow request never holds up
+               another one. A socket_of message has no client envelope,
+               its reply is dropped.
+        """
         conn = dict(self.poller.poll(self.default_timeout))
-        if conn:
-            if conn.get(self.socket_of) == zmq.POLLIN:
-                msg = self.socket_of.recv(zmq.NOBLOCK)
-                sender = self.socket_of
-            elif conn.get(self.socket_vif) == zmq.POLLIN:
-                msg = self.socket_vif.recv()
-                sender = self.socket_vif
+        if conn.get(self.socket_vif) == zmq.POLLIN:
+            frames = self.socket_vif.recv_multipart()
+            # stamp the request to measure its wait for a free worker
+            frames[-1:-1] = ['socket_vif', repr(time.time())]
+            self.pending.append(frames)
+        if conn.get(self.socket_of) == zmq.POLLIN:
+            msg = self.socket_of.recv(zmq.NOBLOCK)
             if msg:
-                data = json.loads(msg)
-            
-        if data:
-            result = self.dispatcher.handle_msg(data)     
-            msg = json.dumps(result)
-            sender.send(msg)
+                # PULL socket - no reply is sent back
+                self.pending.append(['socket_of', repr(time.time()), msg])
+        if conn.get(self.socket_workers) == zmq.POLLIN:
+            # [worker, '', WORKER_READY or client envelope + reply]
+            frames = self.socket_workers.recv_multipart()
+            self.idle_workers.append(frames[0])
+            if len(frames) > 3:
+                self.socket_vif.send_multipart(frames[2:])
+        while self.pending and self.idle_workers:
+            self.socket_workers.send_multipart([self.idle_workers.popleft(), ''] +
+                                               self.pending.popleft())
         
     def daemon_loop(self):
         LOG.info("Daemon Started!")
-        polling_counter = 0
         while True:
             self._get_msg()
-            if polling_counter == self.max_polling_count:
-                LOG.debug("Resync devices")
-            #    self.eswitch_handler.sync_devices()
-                polling_counter = 0
-            else:
-                polling_counter+=1
             
 def main():
     cfg.CONF(args=sys.argv, project='mlnx_daemon')
@@ -15,29 +15,85 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import threading
+import uuid
+
+from nova.openstack.common import cfg
 from nova.openstack.common import log as logging
-from utils import pci_utils
-from utils.command_utils import execute
+from utils import link_utils
+from utils.lock_utils import RWLock
 from db import eswitch_db
+from db import journal as journal_ops
 from resource_mngr import ResourceManager 
+from vlan_batcher import VlanBatcher
 
 LOG = logging.getLogger('mlnx_daemon')
 
+VNIC_TOPIC = 'vnic'
+
 class eSwitchHandler(object):
-    def __init__(self,fabrics=None):
+    def __init__(self,fabrics=None,journal=None,rm=None):
         self.eswitches = {}
-        self.pci_utils = pci_utils.pciUtils()
-        self.rm = ResourceManager()
+        self.journal = journal
+        self.locks = {}
+        self.default_lock = RWLock()
+        self.rm = rm or ResourceManager()
+        self.pci_utils = self.rm.pci_utils
+        self.link_backend = link_utils.get_backend(cfg.CONF.DAEMON.link_backend,
+                                                   self.rm.sysfs_root,
+                                                   cfg.CONF.DAEMON.root_helper,
+                                                   cfg.CONF.DAEMON.command_timeout)
+        self.vlan_batcher = VlanBatcher(self.link_backend,
+                                        cfg.CONF.DAEMON.vlan_batch_window,
+                                        self._commit)
         self.devices = set()
+        self.domains = {}
+        # generations are only comparable within the same epoch
+        self.epoch = uuid.uuid4().hex
+        # vNIC events are numbered within the epoch, see set_publisher
+        self.publisher = None
+        self.event_seq = 0
+        self.event_lock = threading.Lock()
         if fabrics:
             self.add_fabrics(fabrics)
     
     def add_fabrics(self,fabrics):
+        restored_state = self.journal.get_state() if self.journal else {}
         for fabric, pf in fabrics:
-            self.eswitches[fabric] = eswitch_db.eSwitchDB()
+            self.eswitches[fabric] = eswitch_db.eSwitchDB(fabric)
+            self.locks[fabric] = RWLock()
             self._add_fabric(fabric,pf)
+            self._restore_fabric(fabric, restored_state.get(fabric, {}))
+            self.eswitches[fabric].journal = self.journal
+            self.eswitches[fabric].listener = self._vnic_event
+        self._commit()
         self.sync_devices()  
           
+    def set_publisher(self, publisher):
+        """
+        @note: vNIC attach, detach and VLAN changes are published from now
+               on under VNIC_TOPIC, numbered by seq. A subscriber seeing a
+               seq gap or a new epoch must resync with get_vnics_since,
+               whose seq tells the events already covered by its answer.
+        """
+        self.publisher = publisher
+
+    def _vnic_event(self, fabric, event, vnic_mac, **fields):
+        with self.event_lock:
+            self.event_seq += 1
+            if self.publisher is None:
+                return
+            msg = {'event':event,
+                   'fabric':fabric,
+                   'vnic_mac':vnic_mac,
+                   'seq':self.event_seq,
+                   'epoch':self.epoch}
+            msg.update(fields)
+            try:
+                self.publisher.publish(VNIC_TOPIC, msg)
+            except Exception:
+                LOG.exception("Failed to publish %s event of %s", event, vnic_mac)
+
     def sync_devices(self):
         devices = self.rm.scan_attached_devices()
         added_devs = set(devices['direct'])-self.devices
@@ -45,9 +101,68 @@ class eSwitchHandler(object):
         self._treat_added_devices(added_devs)
         self._treat_removed_devices(removed_devs)
         self.devices = set(devices['direct'])
+        self.domains = dict((uuid, set(domain_devices)) for uuid, domain_devices
+                            in devices['domains'].iteritems())
+
+    def handle_domain_event(self, uuid, event):
+        """
+        @note: incremental sync of a single domain's devices
+        @param uuid: domain UUID
+        @param event: 'started' or 'stopped'
+        """
+        LOG.debug("Domain %s %s", uuid, event)
+        if event == 'started':
+            domain_devs = set(self.rm.get_domain_devices(uuid))
+            self._treat_added_devices(domain_devs - self.devices)
+            self.devices |= domain_devs
+            self.domains[uuid] = domain_devs
+        elif event == 'stopped':
+            domain_devs = self.domains.pop(uuid, set())
+            self._treat_removed_devices(domain_devs & self.devices)
+            self.devices -= domain_devs
+
+    def handle_uevent(self, uevent):
+        """
+        @param uevent: kernel uevent, None if events were lost
+        """
+        if uevent is None:
+            self.rescan_devices()
+            return
+        LOG.debug("uevent %s", uevent)
+        self.pci_utils.invalidate()
+        self._apply_device_changes(self.rm.get_uevent_changes(uevent))
+
+    def rescan_devices(self):
+        self.pci_utils.invalidate()
+        for fabric in self.eswitches.keys():
+            self._apply_device_changes(self.rm.get_rescan_changes(fabric))
+
+    def _apply_device_changes(self, changes):
+        # VFs of changed PFs may have been reset
+        for fabric in set(change[1] for change in changes):
+            self.vlan_batcher.load_pf(self.rm.get_fabric_pf(fabric))
+        for op, fabric, dev_type, dev, new_dev in changes:
+            eswitch = self.eswitches[fabric]
+            with self._fabric_lock(fabric).write_lock():
+                if op == 'add':
+                    LOG.info("Device %s added to fabric %s", dev, fabric)
+                    self.rm.add_device(fabric, dev_type, dev)
+                    eswitch.create_port(dev, dev_type)
+                elif op == 'remove':
+                    LOG.info("Device %s removed from fabric %s", dev, fabric)
+                    if not self.rm.remove_device(fabric, dev_type, dev):
+                        LOG.warning("Removed device %s was in use", dev)
+                    eswitch.remove_port(dev)
+                elif op == 'rename':
+                    LOG.info("Device %s renamed to %s", dev, new_dev)
+                    self.rm.rename_device(fabric, dev_type, dev, new_dev)
+                    eswitch.rename_port(dev, new_dev)
+        if changes:
+            self._commit()
 
     def _add_fabric(self,fabric,pf):
         self.rm.add_fabric(fabric,pf)
+        self.vlan_batcher.load_pf(pf)
         vfs = self.rm.get_free_vfs(fabric)
         eths = self.rm.get_free_eths(fabric)
         for vf in vfs:
@@ -55,20 +170,54 @@ class eSwitchHandler(object):
         for eth in eths:
             self.eswitches[fabric].create_port(eth, 'direct')
 
+    def _restore_fabric(self, fabric, vnics):
+        """
+        @note: re-apply journaled vNIC bindings and VLANs on top of the
+               freshly discovered fabric devices. Attached vNICs whose
+               device is gone or taken are released from the journal.
+        """
+        eswitch = self.eswitches[fabric]
+        for vnic_mac, vnic in vnics.iteritems():
+            dev = vnic['dev']
+            if vnic['attached']:
+                if not (dev in eswitch.get_ports() and
+                        self.rm.allocate_device(fabric,
+                                                eswitch.get_port_type(dev),
+                                                dev)):
+                    LOG.warning("Cannot restore vNIC %s on device %s - "
+                                "released", vnic_mac, dev)
+                    if self.journal:
+                        self.journal.append(fabric, journal_ops.OP_RELEASE,
+                                            mac=vnic_mac)
+                    continue
+                eswitch.attach_vnic(dev, vnic['device_id'], vnic_mac)
+            if vnic['vlan'] is not None:
+                eswitch.set_vlan(vnic_mac, vnic['vlan'])
+
+    def _commit(self):
+        if self.journal:
+            self.journal.commit()
+
     def _treat_added_devices(self, devices):
         for dev, mac, fabric in devices:
             if fabric:
-                self.rm.allocate_device(fabric, dev_type='direct', dev=dev)
-                self.eswitches[fabric].attach_vnic(port_name=dev, device_id=None, vnic_mac=mac)
+                eswitch = self.eswitches[fabric]
+                with self._fabric_lock(fabric).write_lock():
+                    # allocated by create_port or restored from the journal
+                    if eswitch.dev_vnic.get(dev) == mac:
+                        continue
+                    self.rm.allocate_device(fabric, dev_type='direct', dev=dev)
+                    eswitch.attach_vnic(port_name=dev, device_id=None, vnic_mac=mac)
             else:
                 LOG.debug("No Fabric defined for device %s", dev)
                 
     def _treat_removed_devices(self,devices):
-        for dev, mac in devices:
+        for dev, mac, fabric in devices:
             fabric = self.rm.get_fabric_for_dev(dev)
             if fabric:
-                self.rm.deallocate_device(fabric, dev_type='direct', dev=dev)
-                self.eswitches[fabric].detach_vnic(vnic_mac=mac)
+                with self._fabric_lock(fabric).write_lock():
+                    self.rm.deallocate_device(fabric, dev_type='direct', dev=dev)
+                    self.eswitches[fabric].detach_vnic(vnic_mac=mac)
             else:
                 LOG.debug("No Fabric defined for device %s", dev)
 
@@ -90,25 +239,68 @@ class eSwitchHandler(object):
         for fabric in fabrics:
             eswitch = self._get_vswitch_for_fabric(fabric)
             if eswitch:
-                vnics_for_eswitch = eswitch.get_attached_vnics()
+                with self._fabric_lock(fabric).read_lock():
+                    vnics_for_eswitch = eswitch.get_attached_vnics()
                 vnics.update(vnics_for_eswitch)
             else:
                 LOG.error("No eSwitch found for Fabric %s",fabric)
                 continue
         LOG.debug("vnics are %s",vnics)
         return vnics  
+
+    def get_vnics_since(self, fabrics, generations, epoch):
+        """
+        @param generations: {fabric: generation} of the caller's last call
+        @param epoch: epoch of the caller's last call
+        @return: {'epoch', 'seq', 'generation', 'full', 'added', 'removed'}
+        @note: if any fabric's changes are no longer available (or the
+               epoch changed) a full snapshot is returned with full set
+        """
+        full = epoch != self.epoch
+        # events published from here on may already be covered
+        seq = self.event_seq
+        added = {}
+        removed = []
+        current = {}
+        for fabric in fabrics:
+            eswitch = self._get_vswitch_for_fabric(fabric)
+            if not eswitch:
+                LOG.error("No eSwitch found for Fabric %s",fabric)
+                continue
+            with self._fabric_lock(fabric).read_lock():
+                current[fabric] = eswitch.generation
+                if full or fabric not in generations:
+                    delta = None
+                else:
+                    delta = eswitch.get_vnics_since(generations[fabric])
+                if delta is None:
+                    full = True
+                elif not full:
+                    added.update(delta[0])
+                    removed.extend(delta[1])
+        if full:
+            added = self.get_vnics(current.keys())
+            removed = []
+        return {'epoch':self.epoch,
+                'seq':seq,
+                'generation':current,
+                'full':full,
+                'added':added,
+                'removed':removed}
     
     def create_port(self, fabric, vnic_type, device_id, vnic_mac):
         dev = None
         eswitch = self._get_vswitch_for_fabric(fabric)
         if eswitch:
-            dev = eswitch.get_dev_for_vnic(vnic_mac)
-            if not dev:
-                dev = self.rm.allocate_device(fabric, vnic_type)
-                if dev:
-                    if not eswitch.attach_vnic(dev, device_id, vnic_mac):
-                        self.rm.deallocate_device(fabric,vnic_type,dev)
-                        dev = None
+            with self._fabric_lock(fabric).write_lock():
+                dev = eswitch.get_dev_for_vnic(vnic_mac)
+                if not dev:
+                    dev = self.rm.allocate_device(fabric, vnic_type)
+                    if dev:
+                        if not eswitch.attach_vnic(dev, device_id, vnic_mac):
+                            self.rm.deallocate_device(fabric,vnic_type,dev)
+                            dev = None
+            self._commit()
         else:
             LOG.error("No eSwitch found for Fabric %s",fabric)
         return dev
@@ -117,10 +309,12 @@ class eSwitchHandler(object):
         dev = None
         eswitch = self._get_vswitch_for_fabric(fabric)
         if eswitch:
-            dev = eswitch.detach_vnic(vnic_mac)
-            if dev:
-                dev_type = eswitch.get_dev_type(dev)
-                self.rm.deallocate_device(fabric,dev_type,dev)
+            with self._fabric_lock(fabric).write_lock():
+                dev = eswitch.detach_vnic(vnic_mac)
+                if dev:
+                    dev_type = eswitch.get_dev_type(dev)
+                    self.rm.deallocate_device(fabric,dev_type,dev)
+            self._commit()
         else:
             LOG.error("No eSwitch found for Fabric %s",fabric)
         return dev  
@@ -130,39 +324,56 @@ class eSwitchHandler(object):
         return ret
     
     def set_vlan(self, fabric, vnic_mac, vlan):
-        eswitch = self._get_vswitch_for_fabric(fabric)
-        if eswitch:
-            eswitch.set_vlan(vnic_mac, vlan)
-            dev = eswitch.get_dev_for_vnic(vnic_mac)
-            if dev:
-                vnic_type = eswitch.get_port_type(dev)
-                pf = self.rm.get_fabric_pf(fabric)
-                vf_index = self.pci_utils.get_vf_index(dev, vnic_type)
-                if pf and vf_index:
-                    try:
-                        self._config_vlan_priority(pf, vf_index, dev, vlan)
-                        return True
-                    except RuntimeError:
-                        LOG.error('Set VLAN operation failed')    
-                else:
-                    LOG.error('Invalid VF/PF index for device %s',dev)         
-        return False
+        return self.set_vlans([(fabric, vnic_mac, vlan)])[0]
+
+    def set_vlans(self, requests):
+        """
+        @param requests: [(fabric, vnic_mac, vlan)...]
+        @return: [succeeded...] per request
+        @note: the VF changes are queued under the fabric lock, so they
+               reach the hardware in the order of the DB updates, and
+               applied after it is released so that concurrent requests
+               join the same per PF batch
+        """
+        results = [False] * len(requests)
+        tickets = []
+        for index, (fabric, vnic_mac, vlan) in enumerate(requests):
+            eswitch = self._get_vswitch_for_fabric(fabric)
+            if not eswitch:
+                continue
+            with self._fabric_lock(fabric).write_lock():
+                eswitch.set_vlan(vnic_mac, vlan)
+                dev = eswitch.get_dev_for_vnic(vnic_mac)
+                if dev:
+                    vnic_type = eswitch.get_port_type(dev)
+                    pf = self.rm.get_fabric_pf(fabric)
+                    vf_index = self.pci_utils.get_vf_index(dev, vnic_type)
+                    if pf and vf_index:
+                        change = (vf_index, dev, vlan, '0',
+                                  cfg.CONF.DAEMON.vlan_link_bounce)
+                        tickets.append((index,
+                                        self.vlan_batcher.submit(pf, [change])))
+                    else:
+                        LOG.error('Invalid VF/PF index for device %s',dev)         
+        self._commit()
+        ticket_results = self.vlan_batcher.wait([ticket for index, ticket
+                                                 in tickets])
+        for (index, ticket), (result,) in zip(tickets, ticket_results):
+            if not result:
+                LOG.error('Set VLAN operation failed')
+            results[index] = result
+        return results
         
     def _get_vswitch_for_fabric(self, fabric):
         if fabric in self.eswitches:
             return self.eswitches[fabric]
         else:
             return 
-        
-    def _config_vlan_priority(self, pf, vf_index, dev, vlan, priority='0'):
-        cmd = ['ip', 'link', 'set', dev, 'down']       
-        execute(cmd, root_helper='sudo')
-    
-        cmd = ['ip', 'link','set',pf, 'vf', vf_index , 'vlan', vlan, 'qos', priority]
-        execute(cmd, root_helper='sudo')
-    
-        cmd = ['ip', 'link', 'set', dev, 'up']       
-        execute(cmd, root_helper='sudo')
-
 
-    
+    def _fabric_lock(self, fabric):
+        """
+        @param fabric: fabric name
+        @return: RWLock serializing changes to the fabric's PF
+        """
+        return self.locks.get(fabric, self.default_lock)
+        
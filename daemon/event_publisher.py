@@ -0,0 +1,43 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+#
+# Copyright 2013 Mellanox Technologies, Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import threading
+import zmq
+
+from nova.openstack.common import log as logging
+from common import codec
+
+LOG = logging.getLogger('mlnx_daemon')
+
+class EventPublisher(object):
+    """
+    Publishes daemon notifications on a PUB socket.
+    Every notification is sent as [topic, JSON message] so subscribers
+    can filter by topic. Publishing is serialized since zmq sockets must
+    not be shared between threads concurrently.
+    """
+    def __init__(self, context, url):
+        self.socket = context.socket(zmq.PUB)
+        self.socket.bind(url)
+        self.lock = threading.Lock()
+
+    def publish(self, topic, msg):
+        msg['ver'] = codec.PROTOCOL_VERSION
+        data = codec.encode(msg, codec.JSON)
+        with self.lock:
+            self.socket.send_multipart([topic, data])
+        LOG.debug("Published %s event %s", topic, msg)
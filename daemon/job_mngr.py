@@ -0,0 +1,96 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+#
+# Copyright 2013 Mellanox Technologies, Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import collections
+import threading
+import uuid
+import Queue
+
+from nova.openstack.common import log as logging
+
+LOG = logging.getLogger('mlnx_daemon')
+
+JOB_TOPIC = 'job'
+
+PENDING = 'PENDING'
+DONE = 'DONE'
+
+class JobManager(object):
+    """
+    Runs slow requests in the background.
+    The outcome of every job is published on the events socket under
+    JOB_TOPIC and kept for the last max_jobs jobs for get_job queries.
+    """
+    def __init__(self, workers, max_jobs=1024):
+        self.workers = workers
+        self.max_jobs = max_jobs
+        self.publisher = None
+        self.queue = Queue.Queue()
+        self.jobs = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def start(self, publisher):
+        self.publisher = publisher
+        for i in range(self.workers):
+            worker = threading.Thread(target=self._worker_loop,
+                                      name='job-worker-%d' % i)
+            worker.daemon = True
+            worker.start()
+
+    def submit(self, action, func):
+        """
+        @param action: action name reported with the job result
+        @param func: callable returning the action response message
+        @return: job id
+        """
+        job_id = uuid.uuid4().hex
+        with self.lock:
+            self.jobs[job_id] = {'job_id':job_id,
+                                 'action':action,
+                                 'state':PENDING}
+            while len(self.jobs) > self.max_jobs:
+                self.jobs.popitem(last=False)
+        self.queue.put((job_id, func))
+        return job_id
+
+    def get_job(self, job_id):
+        with self.lock:
+            job = self.jobs.get(job_id)
+            return dict(job) if job else None
+
+    def _worker_loop(self):
+        while True:
+            job_id, func = self.queue.get()
+            try:
+                result = func()
+            except Exception, e:
+                LOG.exception("Job %s failed", job_id)
+                result = {'status':'FAIL', 'reason':str(e)}
+            self._complete(job_id, result)
+
+    def _complete(self, job_id, result):
+        with self.lock:
+            job = self.jobs.get(job_id)
+            if job:
+                job['state'] = DONE
+                job['result'] = result
+        notification = {'job_id':job_id, 'result':result}
+        if self.publisher:
+            try:
+                self.publisher.publish(JOB_TOPIC, notification)
+            except Exception:
+                LOG.exception("Failed to publish result of job %s", job_id)
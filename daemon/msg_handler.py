@@ -15,12 +15,28 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import collections
+import functools
+import threading
+import time
+
+from nova.openstack.common import cfg
 from nova.openstack.common import log as logging
+from common import codec
+from utils import stats_utils
 
 LOG = logging.getLogger('mlnx_daemon')
 
+MAX_VLAN = 4095
+
 class BasicMessageHandler(object):
     MSG_ATTRS_VALID_MAP = set()
+    # action may be run as a background job on 'async' request
+    ASYNC_CAPABLE = False
+    # consecutive batch messages of the action may run through execute_bulk
+    BULK_CAPABLE = False
+    # MessageDispatch executing the message
+    dispatcher = None
     def __init__(self, msg):
         self.msg = msg
         
@@ -73,14 +89,44 @@ class DetachVnic(BasicMessageHandler):
         
 class SetVLAN(BasicMessageHandler):
     MSG_ATTRS_VALID_MAP = set(['fabric','vnic_mac','vlan'])
+    ASYNC_CAPABLE = True
+    BULK_CAPABLE = True
     def __init__(self,msg):
         BasicMessageHandler.__init__(self,msg)
+
+    def validate(self):
+        """
+        @note: the VLAN is converted to int in place
+        """
+        if not BasicMessageHandler.validate(self):
+            return False
+        try:
+            vlan = int(self.msg['vlan'])
+        except (TypeError, ValueError):
+            return False
+        if not 0 <= vlan <= MAX_VLAN:
+            return False
+        self.msg['vlan'] = vlan
+        return True
         
     def execute(self, eSwitchHandler):
         fabric     = self.msg['fabric']
         vnic_mac   = self.msg['vnic_mac']
         vlan   = self.msg['vlan']
         ret = eSwitchHandler.set_vlan(fabric, vnic_mac, vlan)
+        return self._build_set_vlan_response(ret)
+
+    @classmethod
+    def execute_bulk(cls, eSwitchHandler, msgs):
+        """
+        @note: the VLANs are programmed in one batch per PF
+        """
+        rets = eSwitchHandler.set_vlans([(msg['fabric'], msg['vnic_mac'],
+                                          msg['vlan']) for msg in msgs])
+        return [cls(msg)._build_set_vlan_response(ret)
+                for msg, ret in zip(msgs, rets)]
+
+    def _build_set_vlan_response(self, ret):
         reason = None
         if not ret:
             reason ='Set VLAN Failed'
@@ -104,8 +150,29 @@ class GetVnics(BasicMessageHandler):
         vnics = eSwitchHandler.get_vnics(fabrics)
         return self.build_response(True, response =vnics)
 
+class GetVnicsSince(BasicMessageHandler):
+    MSG_ATTRS_VALID_MAP = set(['fabric'])
+    def __init__(self,msg):
+        BasicMessageHandler.__init__(self,msg)
+
+    def execute(self, eSwitchHandler):
+        """
+        @note: generation and epoch are those of the previous response,
+               omitted on the first call
+        """
+        fabric   = self.msg['fabric']
+        if fabric == '*':
+            fabrics = eSwitchHandler.eswitches.keys()
+        else:
+            fabrics = [fabric]
+        vnics = eSwitchHandler.get_vnics_since(fabrics,
+                                               self.msg.get('generation') or {},
+                                               self.msg.get('epoch'))
+        return self.build_response(True, response = vnics)
+
 class PortRelease(BasicMessageHandler):
     MSG_ATTRS_VALID_MAP = set(['fabric','ref_by','mac'])
+    ASYNC_CAPABLE = True
     def __init__(self,msg):
         BasicMessageHandler.__init__(self,msg)
         
@@ -164,6 +231,96 @@ class PortDown(BasicMessageHandler):
         ref_by   = self.msg['ref_by']
         mac   = self.msg['mac']
         return self.build_response(True, response = {})
+
+class Negotiate(BasicMessageHandler):
+    MSG_ATTRS_VALID_MAP = set(['encodings'])
+    def __init__(self,msg):
+        BasicMessageHandler.__init__(self,msg)
+
+    def execute(self, eSwitchHandler):
+        encoding = codec.select_encoding(self.msg['encodings'],
+                                         cfg.CONF.DAEMON.encodings)
+        return self.build_response(True, response = {'encoding':encoding,
+                                                     'ver':codec.PROTOCOL_VERSION})
+
+class GetJob(BasicMessageHandler):
+    MSG_ATTRS_VALID_MAP = set(['job_id'])
+    def __init__(self,msg):
+        BasicMessageHandler.__init__(self,msg)
+
+    def execute(self, eSwitchHandler):
+        job = self.dispatcher.job_mngr.get_job(self.msg['job_id'])
+        if job:
+            return self.build_response(True, response = job)
+        return self.build_response(False, reason = 'Unknown job')
+
+class GetStats(BasicMessageHandler):
+    MSG_ATTRS_VALID_MAP = set()
+    def __init__(self,msg):
+        BasicMessageHandler.__init__(self,msg)
+
+    def execute(self, eSwitchHandler):
+        return self.build_response(True, response = stats_utils.STATS.snapshot())
+
+class Batch(BasicMessageHandler):
+    MSG_ATTRS_VALID_MAP = set(['msgs'])
+    def __init__(self,msg):
+        BasicMessageHandler.__init__(self,msg)
+
+    def validate(self):
+        if not BasicMessageHandler.validate(self):
+            return False
+        msgs = self.msg['msgs']
+        if not isinstance(msgs, list):
+            return False
+        for sub_msg in msgs:
+            if not isinstance(sub_msg, dict) or 'action' not in sub_msg:
+                return False
+            if sub_msg['action'] == 'batch':
+                return False
+        return True
+
+    def execute(self, eSwitchHandler):
+        """
+        @note: sub messages are executed in order, the response holds one
+               result per sub message. If stop_on_failure is set, the
+               sub messages following a failure are reported as SKIPPED
+        """
+        stop_on_failure = self.msg.get('stop_on_failure', False)
+        results = []
+        failed = False
+        for action, sub_msgs in self._group(stop_on_failure):
+            if failed and stop_on_failure:
+                results.extend({'action':action, 'status':'SKIPPED'}
+                               for sub_msg in sub_msgs)
+                continue
+            if len(sub_msgs) > 1:
+                sub_results = self.dispatcher.execute_bulk(action, sub_msgs)
+            else:
+                sub_results = [self.dispatcher.execute_action(action,
+                                                              sub_msgs[0])]
+            if [result for result in sub_results if result['status'] != 'OK']:
+                failed = True
+            results.extend(sub_results)
+        return self.build_response(True, response = {'results':results})
+
+    def _group(self, stop_on_failure):
+        """
+        @return: [(action, [sub message...])...] in order, consecutive sub
+                 messages of a BULK_CAPABLE action are grouped unless the
+                 batch stops on failure
+        """
+        groups = []
+        for sub_msg in self.msg['msgs']:
+            sub_msg = dict(sub_msg)
+            action = sub_msg.pop('action')
+            handler_cls = MessageDispatch.MSG_MAP.get(action)
+            if (groups and groups[-1][0] == action and not stop_on_failure and
+                handler_cls and handler_cls.BULK_CAPABLE):
+                groups[-1][1].append(sub_msg)
+            else:
+                groups.append((action, [sub_msg]))
+        return groups
        
 class MessageDispatch(object):
     MSG_MAP = {
@@ -171,20 +328,140 @@ class MessageDispatch(object):
                'delete_port':DetachVnic,
                'set_vlan':SetVLAN,
                'get_vnics':GetVnics,
+               'get_vnics_since':GetVnicsSince,
                'port_release':PortRelease,
                'port_up':PortUp,
                'port_down':PortDown,
                'define_fabric_mapping':SetFabricMapping,
+               'batch':Batch,
+               'negotiate':Negotiate,
+               'get_job':GetJob,
+               'get_stats':GetStats,
                }
-    def __init__(self,eSwitchHandler):
+    def __init__(self,eSwitchHandler,job_mngr,cache_size=1024):
         self.eSwitchHandler = eSwitchHandler
+        self.job_mngr = job_mngr
+        # responses of recent requests by client request id
+        self.cache_size = cache_size
+        self.responses = collections.OrderedDict()
+        self.in_flight = {}
+        self.cache_lock = threading.Lock()
     
     def handle_msg(self, msg):
-        result = {}
-        print "MSG=",msg
+        LOG.debug("MSG=%s", msg)
+        req_id = msg.pop('req_id', None)
+        if req_id is None:
+            return self._handle_msg(msg)
+        result = self._get_cached_response(req_id)
+        if result is None:
+            try:
+                result = self._handle_msg(msg)
+            finally:
+                self._cache_response(req_id, result)
+        result = dict(result)
+        result['req_id'] = req_id
+        return result
+
+    def _get_cached_response(self, req_id):
+        """
+        @return: response of an earlier request with the same id, None if
+                 the caller should execute the request
+        @note: a duplicate of a request still in progress waits for it
+        """
+        with self.cache_lock:
+            if req_id in self.responses:
+                result = self.responses.pop(req_id)
+                self.responses[req_id] = result
+                stats_utils.STATS.increment(stats_utils.ACTION,
+                                            result['action'], 'cached')
+                return result
+            done = self.in_flight.get(req_id)
+            if done is None:
+                self.in_flight[req_id] = threading.Event()
+                return None
+        done.wait()
+        return self._get_cached_response(req_id)
+
+    def _cache_response(self, req_id, result):
+        with self.cache_lock:
+            if result is not None:
+                self.responses[req_id] = result
+                while len(self.responses) > self.cache_size:
+                    self.responses.popitem(last=False)
+            self.in_flight.pop(req_id).set()
+
+    def _handle_msg(self, msg):
         action = msg.pop('action')
-        if action in MessageDispatch.MSG_MAP.keys():
+        ver = msg.pop('ver', codec.PROTOCOL_VERSION)
+        if ver > codec.PROTOCOL_VERSION:
+            result = {'action':action, 'status':'FAIL',
+                      'reason':'unsupported protocol version %s' % ver}
+        elif msg.pop('async', False):
+            result = self.submit_job(action, msg)
+        else:
+            result = self.execute_action(action, msg)
+        result['ver'] = codec.PROTOCOL_VERSION
+        return result
+
+    def submit_job(self, action, msg):
+        """
+        @note: the message is validated right away, the job id is returned
+               and the result is published once the job is done
+        """
+        handler_cls = MessageDispatch.MSG_MAP.get(action)
+        if not handler_cls or not handler_cls.ASYNC_CAPABLE:
+            result = {'status':'FAIL','reason':'action cannot run asynchronously'}
+        elif not handler_cls(msg).validate():
+            LOG.error('Invalid message - cannot handle')
+            result = {'status':'FAIL','reason':'validation failed'}
+        else:
+            job_id = self.job_mngr.submit(action,
+                                          functools.partial(self.execute_action,
+                                                            action, msg))
+            result = {'status':'OK','response':{'job_id':job_id}}
+        result['action'] = action
+        return result
+
+    def execute_action(self, action, msg):
+        start = time.time()
+        result = self._execute_action(action, msg)
+        stats_utils.STATS.record(stats_utils.ACTION, action,
+                                 time.time() - start,
+                                 failed=result['status'] != 'OK')
+        return result
+
+    def execute_bulk(self, action, msgs):
+        """
+        @param msgs: messages of a BULK_CAPABLE action
+        @return: result per message
+        @note: the bulk latency is divided across its messages so that the
+               latency sum of the action matches the time spent on it
+        """
+        start = time.time()
+        handler_cls = MessageDispatch.MSG_MAP[action]
+        valid = [handler_cls(msg).validate() for msg in msgs]
+        responses = iter(handler_cls.execute_bulk(
+            self.eSwitchHandler,
+            [msg for msg, is_valid in zip(msgs, valid) if is_valid]))
+        latency = (time.time() - start) / max(len(msgs), 1)
+        results = []
+        for is_valid in valid:
+            if is_valid:
+                result = responses.next()
+            else:
+                LOG.error('Invalid message - cannot handle')
+                result = {'status':'FAIL','reason':'validation failed'}
+            result['action'] = action
+            stats_utils.STATS.record(stats_utils.ACTION, action, latency,
+                                     failed=result['status'] != 'OK')
+            results.append(result)
+        return results
+
+    def _execute_action(self, action, msg):
+        result = {}
+        if action in MessageDispatch.MSG_MAP:
             msg_handler = MessageDispatch.MSG_MAP[action](msg)
+            msg_handler.dispatcher = self
             if msg_handler.validate():
                 result = msg_handler.execute(self.eSwitchHandler)
             else:
@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+#
+# Copyright 2013 Mellanox Technologies, Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Privileged helper of the daemon.
+
+Started once by the daemon through its root helper (sudo), the helper
+runs allowed commands on behalf of the daemon so that no sudo process
+is created per command. The daemon end of a socket pair is the only
+client: requests are read from stdin, which is that socket, and
+executed concurrently.
+"""
+
+import os
+import socket
+import subprocess
+import sys
+import threading
+
+from utils import helper_utils
+
+
+class PrivilegedHelper(object):
+    def __init__(self, sock):
+        self.sock = sock
+        self.send_lock = threading.Lock()
+
+    def run(self):
+        while True:
+            try:
+                request = helper_utils.recv_frame(self.sock)
+            except EOFError:
+                # the daemon exited
+                return
+            thread = threading.Thread(target=self._handle, args=(request,))
+            thread.daemon = True
+            thread.start()
+
+    def _handle(self, request):
+        """
+        @note: a response is sent for every request, the daemon waits for it
+        """
+        if not isinstance(request, dict):
+            request = {}
+        cmd = request.get('cmd')
+        process_input = request.get('input')
+        response = {'id':request.get('id')}
+        try:
+            if not helper_utils.is_allowed(cmd, process_input):
+                response.update({'returncode':126,
+                                 'stdout':'',
+                                 'stderr':'command not allowed: %r' % (cmd,)})
+            else:
+                response.update(self._execute(cmd, process_input,
+                                              request.get('timeout')))
+        except Exception, e:
+            response.update({'returncode':125,
+                             'stdout':'',
+                             'stderr':'helper failed: %s' % e})
+        with self.send_lock:
+            helper_utils.send_frame(self.sock, response)
+
+    def _execute(self, cmd, process_input, timeout):
+        try:
+            obj = subprocess.Popen(cmd, shell=False, stdin=subprocess.PIPE,
+                                   stdout=subprocess.PIPE,
+                                   stderr=subprocess.PIPE, close_fds=True,
+                                   env={'PATH':helper_utils.SAFE_PATH})
+        except OSError, e:
+            return {'returncode':127, 'stdout':'', 'stderr':str(e)}
+        timed_out = []
+        timer = None
+        if timeout:
+            timer = threading.Timer(timeout, self._kill, (obj, timed_out))
+            timer.start()
+        try:
+            stdout, stderr = obj.communicate(process_input)
+        finally:
+            if timer:
+                timer.cancel()
+        # output is sent as JSON text, undecodable bytes are replaced
+        return {'returncode':obj.returncode,
+                'stdout':stdout.decode('utf-8', 'replace'),
+                'stderr':stderr.decode('utf-8', 'replace'),
+                'timed_out':bool(timed_out)}
+
+    def _kill(self, obj, timed_out):
+        timed_out.append(True)
+        try:
+            obj.kill()
+        except OSError:
+            pass
+
+
+def main():
+    sock = socket.fromfd(0, socket.AF_UNIX, socket.SOCK_STREAM)
+    # stdin/stdout are the daemon socket, keep them off the children
+    devnull = os.open(os.devnull, os.O_RDWR)
+    os.dup2(devnull, 0)
+    os.dup2(devnull, 1)
+    PrivilegedHelper(sock).run()
+
+
+if __name__ == '__main__':
+    main()
@@ -16,43 +16,175 @@
 # limitations under the License.
 
 import os
-import glob
+import hashlib
+import threading
 import libvirt
 from lxml import etree
+from multiprocessing.pool import ThreadPool
+from nova.openstack.common import cfg
 from nova.openstack.common import log as logging
 from utils.pci_utils import pciUtils
+from utils.uevent_utils import UeventMonitor
 from db import device_db
 
 LOG = logging.getLogger('mlnx_daemon')
 
-PCI_PATH = "/sys/bus/pci/devices/"
+# relative to DAEMON.sysfs_root
+PCI_PATH = "bus/pci/devices/"
+LIBVIRT_URI = 'qemu:///system'
+
+DOMAIN_EVENTS = {libvirt.VIR_DOMAIN_EVENT_STARTED: 'started',
+                 libvirt.VIR_DOMAIN_EVENT_STOPPED: 'stopped'}
 
 class ResourceManager:    
-    def __init__(self):
-        self.pci_utils = pciUtils()
+    def __init__(self, sysfs_root=None, libvirt_factory=None):
+        """
+        @param sysfs_root: overrides DAEMON.sysfs_root
+        @param libvirt_factory: callable(uri) returning a libvirt
+                                connection, libvirt.open by default and
+                                libvirt.openReadOnly for domain events
+        """
+        self.sysfs_root = sysfs_root or cfg.CONF.DAEMON.sysfs_root
+        self.libvirt_factory = libvirt_factory or libvirt.open
+        self.libvirt_events_factory = libvirt_factory or libvirt.openReadOnly
+        # injected connections deliver their events by themselves
+        self.default_event_loop = libvirt_factory is None
+        self.pci_utils = pciUtils(self.sysfs_root)
         self.device_db = device_db.DeviceDB()
+        self.libvirt_conn = None
+        self.event_conn = None
+        # {domain uuid: (XML digest, [(dev,mac,fabric)...])}
+        self.domain_cache = {}
+        self.pool = None
+        if cfg.CONF.DAEMON.libvirt_workers > 1:
+            self.pool = ThreadPool(cfg.CONF.DAEMON.libvirt_workers)
+
+    def _get_libvirt_conn(self):
+        """
+        @return: long lived libvirt connection, reopened once it is dead
+        """
+        if self.libvirt_conn is not None:
+            try:
+                if self.libvirt_conn.isAlive():
+                    return self.libvirt_conn
+            except libvirt.libvirtError:
+                pass
+            LOG.warning("libvirt connection lost - reconnecting")
+            try:
+                self.libvirt_conn.close()
+            except libvirt.libvirtError:
+                pass
+            self.libvirt_conn = None
+        self.libvirt_conn = self.libvirt_factory(LIBVIRT_URI)
+        return self.libvirt_conn
         
     def scan_attached_devices(self):
-        devices = {'direct':[]}   
-        conn = self.libvirtconn = libvirt.open('qemu:///system')
+        """
+        @return: {'direct': [(dev,mac,fabric)...],
+                  'domains': {domain uuid: [(dev,mac,fabric)...]}}
+        """
+        devices = {'direct':[], 'domains':{}}   
+        conn = self._get_libvirt_conn()
         domains = conn.listDomainsID()
-        for domid in domains:
-            domain = conn.lookupByID(domid)
-            raw_xml = domain.XMLDesc(0)
-            tree = etree.XML(raw_xml)
-            interfaces = tree.xpath("devices/interface")
-
-            for interface in interfaces:
-                mac = interface.find('mac').get('address')
-                dev = interface.find('source').get('dev')
-                fabric = self.get_fabric_for_dev(dev)
-                if fabric:
-                    devices['direct'].append((dev,mac,fabric))
-                else:
-                    LOG.debug("No Fabric defined for device %s",dev)
+        get_domain_xml = lambda domid: self._get_domain_xml(conn, domid)
+        if self.pool:
+            domains_xml = self.pool.map(get_domain_xml, domains)
+        else:
+            domains_xml = map(get_domain_xml, domains)
+        cache = {}
+        for uuid, raw_xml in domains_xml:
+            if uuid is None:
+                continue
+            domain_devices = self._parse_domain_devices(uuid, raw_xml, cache)
+            devices['domains'][uuid] = domain_devices
+            devices['direct'].extend(domain_devices)
+        # forget domains which are no longer running
+        self.domain_cache = cache
         return devices 
+
+    def _get_domain_xml(self, conn, domid):
+        """
+        @return: (uuid, XML) of the domain, (None, None) if it is gone
+        """
+        try:
+            domain = conn.lookupByID(domid)
+            return domain.UUIDString(), domain.XMLDesc(0)
+        except libvirt.libvirtError, e:
+            LOG.debug("Failed to get domain %s: %s", domid, e)
+            return None, None
+
+    def get_domain_devices(self, uuid):
+        """
+        @param uuid: domain UUID
+        @return: [(dev,mac,fabric)...] of a running domain
+        """
+        try:
+            domain = self._get_libvirt_conn().lookupByUUIDString(uuid)
+            return self._parse_domain_devices(uuid, domain.XMLDesc(0),
+                                              self.domain_cache)
+        except libvirt.libvirtError, e:
+            LOG.warning("Failed to get devices of domain %s: %s", uuid, e)
+            return []
+
+    def _parse_domain_devices(self, uuid, raw_xml, cache):
+        """
+        @note: the XML is parsed only if it changed since the last scan
+        """
+        digest = hashlib.sha1(raw_xml).digest()
+        cached = self.domain_cache.get(uuid)
+        if cached and cached[0] == digest:
+            devices = cached[1]
+        else:
+            devices = self._get_domain_devices(raw_xml)
+        cache[uuid] = (digest, devices)
+        return devices
+
+    def _get_domain_devices(self, raw_xml):
+        devices = []
+        if '<interface' not in raw_xml:
+            return devices
+        tree = etree.XML(raw_xml)
+        sources = tree.xpath("devices/interface/source[@dev]")
+
+        for source in sources:
+            dev = source.get('dev')
+            fabric = self.get_fabric_for_dev(dev)
+            if fabric:
+                mac = source.getparent().find('mac').get('address')
+                devices.append((dev,mac,fabric))
+            else:
+                LOG.debug("No Fabric defined for device %s",dev)
+        return devices
+
+    def start_domain_events(self, callback):
+        """
+        @param callback: callable(uuid, event) invoked from the libvirt
+                         event loop thread, event is 'started' or 'stopped'
+        """
+        if self.default_event_loop:
+            libvirt.virEventRegisterDefaultImpl()
+            event_thread = threading.Thread(target=self._run_event_loop,
+                                            name='libvirt-events')
+            event_thread.daemon = True
+            event_thread.start()
+        self.event_conn = self.libvirt_events_factory(LIBVIRT_URI)
+        self.event_conn.domainEventRegisterAny(None,
+                                               libvirt.VIR_DOMAIN_EVENT_ID_LIFECYCLE,
+                                               self._domain_lifecycle_cb,
+                                               callback)
+
+    def _run_event_loop(self):
+        while True:
+            libvirt.virEventRunDefaultImpl()
+
+    def _domain_lifecycle_cb(self, conn, domain, event, detail, callback):
+        if event in DOMAIN_EVENTS:
+            callback(domain.UUIDString(), DOMAIN_EVENTS[event])
     
     def _get_pf_details(self,pf):
+        if self.pci_utils.get_eth_vf(pf) is None:
+            # PF may have appeared after the topology was read
+            self.pci_utils.invalidate()
         hca_port = self.pci_utils.get_eth_port(pf)
         pci_id  = self.pci_utils.get_pf_pci(pf)
         return (pci_id,hca_port)
@@ -60,31 +192,138 @@ class ResourceManager:
     def get_fabric_pf(self,fabric):
         return self.device_db.get_pf(fabric)
 
-    def discover_devices(self,pci_id,hca_port): 
+    def discover_devices(self,pf,hca_port): 
+        """
+        @return: (eths, vfs) - VF netdevs of the HCA port and VFs without
+                 a netdev, read from the cached PF to VF map
+        """
         eths = list()
         vfs = list()    
-        vfs_paths = glob.glob(PCI_PATH + pci_id + ".[!0]*")   
-        for vf_path in vfs_paths:
-            path = vf_path+'/net'
-            if os.path.isdir(path):
-                eth_dirs = os.listdir(path)
-                for eth in eth_dirs:
-                    port_path = "/".join([path,eth,"dev_id"])
-                    fd = open(port_path)
-                    dev_id = int(fd.read(),0)
-
-                    if int(dev_id) == int(hca_port)-1:
+        for vf_index, vf in sorted(self.pci_utils.get_pf_vfs(pf).items()):
+            netdevs = self.pci_utils.get_pci_netdevs(vf)
+            if netdevs:
+                for eth in netdevs:
+                    if self.pci_utils.get_eth_port(eth) == int(hca_port):
                         eths.append(eth)
             else:
-                vf = vf_path.split('/')[-1]
                 vfs.append(vf) 
         return (eths,vfs)
+
+    def _is_port_eth(self, vf_path, eth, hca_port):
+        port_path = "/".join([vf_path, 'net', eth, 'dev_id'])
+        try:
+            with open(port_path) as f:
+                dev_id = int(f.read(),0)
+        except (IOError, ValueError):
+            return False
+        return dev_id == int(hca_port)-1
+
+    def _vf_has_netdev(self, vf):
+        return os.path.isdir(os.path.join(self.sysfs_root, PCI_PATH, vf, 'net'))
+
+    def _get_vf_fabric(self, vf):
+        pci_id, sep, function = vf.rpartition('.')
+        if not sep or function == '0':
+            return None
+        return self.device_db.get_pci_fabric(pci_id)
+
+    def start_uevents(self, callback):
+        """
+        @param callback: see UeventMonitor
+        """
+        UeventMonitor(callback).start()
+
+    def get_uevent_changes(self, uevent):
+        """
+        @param uevent: kernel uevent of the net or pci subsystem
+        @return: [(op, fabric, dev_type, dev, new_dev)...] device changes
+                 to apply, op is 'add', 'remove' or 'rename'
+        """
+        changes = []
+        action = uevent['ACTION']
+        devpath = uevent['DEVPATH'].rstrip('/').split('/')
+        if uevent.get('SUBSYSTEM') == 'pci':
+            vf = devpath[-1]
+            fabric = self._get_vf_fabric(vf)
+            if not fabric:
+                return changes
+            has_vf = self.device_db.has_device(fabric, False, vf)
+            if action == 'add' and not has_vf and not self._vf_has_netdev(vf):
+                changes.append(('add', fabric, 'hostdev', vf, None))
+            elif action == 'remove' and has_vf:
+                changes.append(('remove', fabric, 'hostdev', vf, None))
+        elif uevent.get('SUBSYSTEM') == 'net':
+            if len(devpath) < 3 or devpath[-2] != 'net':
+                return changes
+            vf, eth = devpath[-3], devpath[-1]
+            fabric = self._get_vf_fabric(vf)
+            if not fabric:
+                return changes
+            has_vf = self.device_db.has_device(fabric, False, vf)
+            if action == 'add':
+                hca_port = self.device_db.get_hca_port(fabric)
+                if (not self.device_db.has_device(fabric, True, eth) and
+                    self._is_port_eth(os.path.join(self.sysfs_root, PCI_PATH, vf),
+                                      eth, hca_port)):
+                    changes.append(('add', fabric, 'direct', eth, None))
+                # a VF with a netdev is used through it
+                if has_vf:
+                    changes.append(('remove', fabric, 'hostdev', vf, None))
+            elif action == 'remove':
+                if self.device_db.has_device(fabric, True, eth):
+                    changes.append(('remove', fabric, 'direct', eth, None))
+                if (not has_vf and
+                    os.path.isdir(os.path.join(self.sysfs_root, PCI_PATH, vf)) and
+                    not self._vf_has_netdev(vf)):
+                    changes.append(('add', fabric, 'hostdev', vf, None))
+            elif action == 'move':
+                old_eth = uevent.get('DEVPATH_OLD', '').rstrip('/').split('/')[-1]
+                if self.device_db.has_device(fabric, True, old_eth):
+                    changes.append(('rename', fabric, 'direct', old_eth, eth))
+        return changes
+
+    def get_rescan_changes(self, fabric):
+        """
+        @note: full rediscovery of the fabric devices, the fallback when
+               uevents are not available or were lost
+        """
+        changes = []
+        pf = self.get_fabric_pf(fabric)
+        pci_id, hca_port = self._get_pf_details(pf)
+        eths, vfs = self.discover_devices(pf, hca_port)
+        for dev_type, is_device, found in (('direct', True, set(eths)),
+                                           ('hostdev', False, set(vfs))):
+            known = self.device_db.get_devices(fabric, is_device)
+            for dev in sorted(known - found):
+                changes.append(('remove', fabric, dev_type, dev, None))
+            for dev in sorted(found - known):
+                changes.append(('add', fabric, dev_type, dev, None))
+        return changes
+
+    def add_device(self, fabric, dev_type, dev):
+        self.device_db.add_device(fabric, dev_type == 'direct', dev)
+        # cached domain devices are resolved against the known devices
+        self.domain_cache = {}
+
+    def remove_device(self, fabric, dev_type, dev):
+        """
+        @return: True if the device was free
+        """
+        self.domain_cache = {}
+        return self.device_db.remove_device(fabric, dev_type == 'direct', dev)
+
+    def rename_device(self, fabric, dev_type, dev, new_dev):
+        self.domain_cache = {}
+        return self.device_db.rename_device(fabric, dev_type == 'direct',
+                                            dev, new_dev)
               
     def add_fabric(self, fabric, pf):
         pci_id,hca_port = self._get_pf_details(pf)
         self.device_db.add_fabric(fabric,pf,pci_id,hca_port)
-        eths,vfs = self.discover_devices(pci_id,hca_port)
+        eths,vfs = self.discover_devices(pf,hca_port)
         self.device_db.set_fabric_devices(fabric,eths,vfs)
+        # cached domain devices may belong to the new fabric
+        self.domain_cache = {}
         
     def get_free_eths(self, fabric):
         return self.device_db.get_free_eths(fabric)
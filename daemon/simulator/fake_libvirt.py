@@ -0,0 +1,150 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+#
+# Copyright 2013 Mellanox Technologies, Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+In memory libvirt connection with running domains using direct
+interfaces, pluggable through ResourceManager's libvirt_factory.
+"""
+
+import uuid
+
+import libvirt
+
+DOMAIN_XML = """<domain type='kvm'>
+  <name>%(name)s</name>
+  <uuid>%(uuid)s</uuid>
+  <devices>
+    <disk type='file' device='disk'>
+      <source file='/var/lib/nova/instances/%(uuid)s/disk'/>
+      <target dev='vda' bus='virtio'/>
+    </disk>
+%(interfaces)s
+  </devices>
+</domain>"""
+
+INTERFACE_XML = """    <interface type='direct'>
+      <mac address='%(mac)s'/>
+      <source dev='%(dev)s' mode='passthrough'/>
+      <model type='virtio'/>
+    </interface>"""
+
+
+def make_mac(index):
+    return 'fa:16:3e:%02x:%02x:%02x' % ((index >> 16) & 0xff,
+                                        (index >> 8) & 0xff,
+                                        index & 0xff)
+
+
+class FakeDomain(object):
+    def __init__(self, domid, devices):
+        """
+        @param devices: [(dev, mac)...] direct interfaces of the domain
+        """
+        self.domid = domid
+        self.uuid = str(uuid.uuid4())
+        self.devices = list(devices)
+
+    def ID(self):
+        return self.domid
+
+    def UUIDString(self):
+        return self.uuid
+
+    def XMLDesc(self, flags):
+        interfaces = '\n'.join(INTERFACE_XML % {'mac':mac, 'dev':dev}
+                               for dev, mac in self.devices)
+        return DOMAIN_XML % {'name':'instance-%08x' % self.domid,
+                             'uuid':self.uuid,
+                             'interfaces':interfaces}
+
+
+class FakeConnection(object):
+    def __init__(self):
+        self.domains = {}
+        self.next_id = 1
+        self.alive = True
+        # [(callback, opaque)...] of lifecycle event registrations
+        self.event_callbacks = []
+
+    def __call__(self, uri):
+        """
+        @note: the connection is its own libvirt_factory
+        """
+        self.alive = True
+        return self
+
+    def create_domain(self, devices):
+        domain = FakeDomain(self.next_id, devices)
+        self.domains[domain.domid] = domain
+        self.next_id += 1
+        self._emit(domain, libvirt.VIR_DOMAIN_EVENT_STARTED)
+        return domain
+
+    def create_domains(self, count, devs, interfaces=1):
+        """
+        @param devs: direct devices handed out to the domains in order
+        @return: domains created, each using interfaces devices
+        """
+        domains = []
+        devs = list(devs)
+        for index in range(count):
+            domain_devs = devs[index * interfaces:(index + 1) * interfaces]
+            if not domain_devs:
+                break
+            domains.append(self.create_domain(
+                [(dev, make_mac(self.next_id * 256 + i))
+                 for i, dev in enumerate(domain_devs)]))
+        return domains
+
+    def destroy_domain(self, domid):
+        domain = self.domains.pop(domid)
+        self._emit(domain, libvirt.VIR_DOMAIN_EVENT_STOPPED)
+        return domain
+
+    def _emit(self, domain, event):
+        for callback, opaque in self.event_callbacks:
+            callback(self, domain, event, 0, opaque)
+
+    def domainEventRegisterAny(self, domain, event_id, callback, opaque):
+        """
+        @note: lifecycle events are delivered synchronously by
+               create_domain and destroy_domain
+        """
+        self.event_callbacks.append((callback, opaque))
+        return len(self.event_callbacks) - 1
+
+    def isAlive(self):
+        return self.alive
+
+    def close(self):
+        self.alive = False
+
+    def listDomainsID(self):
+        return sorted(self.domains)
+
+    def lookupByID(self, domid):
+        if domid not in self.domains:
+            raise libvirt.libvirtError('Domain not found: no domain with '
+                                       'matching id %d' % domid)
+        return self.domains[domid]
+
+    def lookupByUUIDString(self, uuid_string):
+        for domain in self.domains.itervalues():
+            if domain.uuid == uuid_string:
+                return domain
+        raise libvirt.libvirtError('Domain not found: no domain with '
+                                   'matching uuid %s' % uuid_string)
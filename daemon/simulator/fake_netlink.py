@@ -0,0 +1,106 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+#
+# Copyright 2013 Mellanox Technologies, Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+In process rtnetlink endpoint for NetlinkBackend.
+
+Understands the RTM_SETLINK requests the backend sends: link up/down and
+IFLA_VFINFO_LIST VF VLAN/QoS. Pass the endpoint as the backend's
+socket_factory.
+"""
+
+import collections
+import errno
+import socket
+import struct
+
+from utils import link_utils
+
+
+class FakeNetlinkSocket(object):
+    def __init__(self, ifindexes=None):
+        """
+        @param ifindexes: valid ifindexes, any ifindex if None
+        """
+        self.ifindexes = ifindexes
+        # {ifindex: up}
+        self.links = {}
+        # {(ifindex, vf index): (vlan, qos)}
+        self.vf_vlans = {}
+        self.requests = []
+        self.replies = collections.deque()
+        self.closed = False
+        self.timeout = None
+
+    def __call__(self):
+        self.closed = False
+        return self
+
+    def close(self):
+        self.closed = True
+
+    def settimeout(self, timeout):
+        self.timeout = timeout
+
+    def send(self, data):
+        reply = ''
+        for msg_type, seq, payload in link_utils.parse_msgs(data):
+            self.requests.append((msg_type, seq, payload))
+            error = self._handle(msg_type, payload)
+            ack = struct.pack('=i', -error) + data[:link_utils.NLMSG_HDR.size]
+            reply += link_utils.pack_msg(link_utils.NLMSG_ERROR, seq, ack, 0)
+        self.replies.append(reply)
+        return len(data)
+
+    def recv(self, bufsize):
+        if not self.replies:
+            # a lost acknowledgement
+            raise socket.timeout('timed out')
+        return self.replies.popleft()
+
+    def _handle(self, msg_type, payload):
+        if msg_type != link_utils.RTM_SETLINK:
+            return errno.EOPNOTSUPP
+        (family, dev_type, ifindex, flags,
+         change) = link_utils.IFINFOMSG.unpack_from(payload)
+        if self.ifindexes is not None and ifindex not in self.ifindexes:
+            return errno.ENODEV
+        if change & link_utils.IFF_UP:
+            self.links[ifindex] = bool(flags & link_utils.IFF_UP)
+        attrs = payload[link_utils.IFINFOMSG.size:]
+        for vf_info in self._attrs(attrs, link_utils.IFLA_VFINFO_LIST):
+            for vf_vlan in self._attrs(vf_info, link_utils.IFLA_VF_INFO):
+                for data in self._attrs(vf_vlan, link_utils.IFLA_VF_VLAN):
+                    vf, vlan, qos = link_utils.IFLA_VF_VLAN_STRUCT.unpack(data)
+                    self.vf_vlans[(ifindex, vf)] = (vlan, qos)
+        return 0
+
+    def _attrs(self, data, attr_type):
+        """
+        @return: payloads of the attr_type attributes in data
+        """
+        payloads = []
+        offset = 0
+        while offset + link_utils.RTATTR_HDR.size <= len(data):
+            length, current_type = link_utils.RTATTR_HDR.unpack_from(data, offset)
+            if length < link_utils.RTATTR_HDR.size:
+                break
+            if current_type == attr_type:
+                payloads.append(data[offset + link_utils.RTATTR_HDR.size:
+                                     offset + length])
+            offset += link_utils._align(length)
+        return payloads
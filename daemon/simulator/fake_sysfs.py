@@ -0,0 +1,131 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+#
+# Copyright 2013 Mellanox Technologies, Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Synthetic sysfs tree of ConnectX PFs and their VFs.
+
+Layout created under root for every PF:
+    bus/pci/devices/<pci_id>.0/net/<pf>/{dev_id,ifindex,device}
+    bus/pci/devices/<pci_id>.0/virtfn<N> -> ../<pci_id>.<N+1>
+    bus/pci/devices/<pci_id>.<N+1>/net/<pf>v<N>/{dev_id,ifindex,device}
+    class/net/<netdev> -> ../../bus/pci/devices/<pci>/net/<netdev>
+VFs are numbered as consecutive PCI functions of the PF slot, as the
+daemon's discovery expects. VFs without a netdev are the hostdev VFs.
+"""
+
+import os
+import shutil
+import tempfile
+
+
+class FakeSysfs(object):
+    def __init__(self, root=None):
+        """
+        @param root: directory of the tree, a temporary one by default
+        """
+        self.root = root or tempfile.mkdtemp(prefix='mlnx_sysfs_')
+        self.pci_path = os.path.join(self.root, 'bus', 'pci', 'devices')
+        self.net_path = os.path.join(self.root, 'class', 'net')
+        for path in (self.pci_path, self.net_path):
+            if not os.path.isdir(path):
+                os.makedirs(path)
+        self.pfs = {}
+        self.next_ifindex = 2
+
+    def cleanup(self):
+        shutil.rmtree(self.root, ignore_errors=True)
+
+    def add_pf(self, pf, pci_id, vfs=0, hostdev_vfs=0, port=1):
+        """
+        @param pf: PF netdev name
+        @param pci_id: PCI bus:slot of the PF, e.g. '0000:03:00'
+        @param vfs: VFs with a netdev (direct devices)
+        @param hostdev_vfs: VFs without a netdev
+        @param port: HCA port of the PF and its VF netdevs
+        @return: (eths, vfs) created
+        """
+        self.add_pci_device('%s.0' % pci_id)
+        self.add_netdev('%s.0' % pci_id, pf, port)
+        eths = []
+        hostdevs = []
+        for index in range(vfs + hostdev_vfs):
+            vf_pci = self.add_vf(pci_id, index)
+            if index < vfs:
+                eth = '%sv%d' % (pf, index)
+                self.add_netdev(vf_pci, eth, port)
+                eths.append(eth)
+            else:
+                hostdevs.append(vf_pci)
+        self.pfs[pf] = pci_id
+        return eths, hostdevs
+
+    def add_pci_device(self, pci):
+        path = os.path.join(self.pci_path, pci)
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        return path
+
+    def add_vf(self, pci_id, index):
+        vf_pci = '%s.%d' % (pci_id, index + 1)
+        self.add_pci_device(vf_pci)
+        os.symlink('../%s' % vf_pci,
+                   os.path.join(self.pci_path, '%s.0' % pci_id,
+                                'virtfn%d' % index))
+        return vf_pci
+
+    def remove_vf(self, pci_id, index):
+        vf_pci = '%s.%d' % (pci_id, index + 1)
+        for netdev in self.get_netdevs(vf_pci):
+            self.remove_netdev(vf_pci, netdev)
+        os.unlink(os.path.join(self.pci_path, '%s.0' % pci_id,
+                               'virtfn%d' % index))
+        shutil.rmtree(os.path.join(self.pci_path, vf_pci))
+        return vf_pci
+
+    def add_netdev(self, pci, netdev, port=1):
+        path = os.path.join(self.pci_path, pci, 'net', netdev)
+        os.makedirs(path)
+        with open(os.path.join(path, 'dev_id'), 'w') as f:
+            f.write('0x%x\n' % (port - 1))
+        with open(os.path.join(path, 'ifindex'), 'w') as f:
+            f.write('%d\n' % self.next_ifindex)
+        self.next_ifindex += 1
+        os.symlink('../../../%s' % pci, os.path.join(path, 'device'))
+        os.symlink('../../bus/pci/devices/%s/net/%s' % (pci, netdev),
+                   os.path.join(self.net_path, netdev))
+        return path
+
+    def remove_netdev(self, pci, netdev):
+        os.unlink(os.path.join(self.net_path, netdev))
+        shutil.rmtree(os.path.join(self.pci_path, pci, 'net', netdev))
+        net_path = os.path.join(self.pci_path, pci, 'net')
+        if not os.listdir(net_path):
+            os.rmdir(net_path)
+
+    def rename_netdev(self, pci, netdev, new_netdev):
+        net_path = os.path.join(self.pci_path, pci, 'net')
+        os.rename(os.path.join(net_path, netdev),
+                  os.path.join(net_path, new_netdev))
+        os.unlink(os.path.join(self.net_path, netdev))
+        os.symlink('../../bus/pci/devices/%s/net/%s' % (pci, new_netdev),
+                   os.path.join(self.net_path, new_netdev))
+
+    def get_netdevs(self, pci):
+        net_path = os.path.join(self.pci_path, pci, 'net')
+        if not os.path.isdir(net_path):
+            return []
+        return os.listdir(net_path)
@@ -0,0 +1,58 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+#
+# Copyright 2013 Mellanox Technologies, Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Synthetic kernel uevent stream for UeventMonitor.
+"""
+
+import collections
+
+
+def make_uevent(action, devpath, subsystem, **keys):
+    """
+    @return: raw uevent as sent by the kernel
+    """
+    fields = ['%s@%s' % (action, devpath),
+              'ACTION=%s' % action,
+              'DEVPATH=%s' % devpath,
+              'SUBSYSTEM=%s' % subsystem]
+    fields.extend('%s=%s' % item for item in sorted(keys.items()))
+    return '\0'.join(fields) + '\0'
+
+
+def vf_devpath(vf_pci, netdev=None):
+    devpath = '/devices/pci0000:00/0000:00:03.0/%s' % vf_pci
+    if netdev:
+        devpath += '/net/%s' % netdev
+    return devpath
+
+
+class FakeUeventSocket(object):
+    """
+    Replays queued uevents, recv() returns '' once they are consumed
+    which stops the monitor.
+    """
+    def __init__(self, uevents=()):
+        self.uevents = collections.deque(uevents)
+
+    def add(self, uevent):
+        self.uevents.append(uevent)
+
+    def recv(self, bufsize):
+        if self.uevents:
+            return self.uevents.popleft()
+        return ''
@@ -0,0 +1,63 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+#
+# Copyright 2013 Mellanox Technologies, Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import unittest
+
+from common import codec
+
+MSG = {'action':'set_vlan', 'fabric':'fabric1',
+       'vnic_mac':'fa:16:3e:00:00:01', 'vlan':10,
+       'msgs':[{'action':'port_up', 'ref_by':'mac_address'}],
+       'not_a_field':{'dev':'0000:03:00.1'}}
+
+
+class CodecTest(unittest.TestCase):
+    def test_json_round_trip(self):
+        data = codec.encode(MSG, codec.JSON)
+        self.assertEqual(codec.decode(data), (MSG, codec.JSON))
+
+    def test_json_without_msgpack(self):
+        msgpack = codec.msgpack
+        codec.msgpack = None
+        self.addCleanup(setattr, codec, 'msgpack', msgpack)
+        self.assertEqual(codec.available_encodings(), [codec.JSON])
+        self.assertEqual(codec.select_encoding([codec.MSGPACK, codec.JSON],
+                                               [codec.MSGPACK, codec.JSON]),
+                         codec.JSON)
+        data = codec.encode(MSG)
+        self.assertEqual(codec.decode(data), (MSG, codec.JSON))
+
+    @unittest.skipUnless(codec.msgpack, 'msgpack is not installed')
+    def test_msgpack_round_trip(self):
+        data = codec.encode(MSG, codec.MSGPACK)
+        self.assertNotEqual(data[:1], '{')
+        self.assertEqual(codec.decode(data), (MSG, codec.MSGPACK))
+
+    @unittest.skipUnless(codec.msgpack, 'msgpack is not installed')
+    def test_msgpack_short_keys(self):
+        data = codec.encode({'action':'get_vnics'}, codec.MSGPACK)
+        self.assertEqual(codec.msgpack.unpackb(data, **codec.UNPACK_OPTIONS),
+                         {codec.SHORT_KEYS['action']:'get_vnics'})
+
+    def test_select_encoding(self):
+        self.assertEqual(codec.select_encoding(['xml', codec.JSON],
+                                               [codec.MSGPACK, codec.JSON]),
+                         codec.JSON)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,140 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+#
+# Copyright 2013 Mellanox Technologies, Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import threading
+import unittest
+
+from utils import command_utils
+
+
+class FakeSubprocess(object):
+    """
+    Stands in for the subprocess module, commands hang until killed
+    unless their run time is set.
+    """
+    PIPE = -1
+
+    def __init__(self, run_time=None):
+        self.run_time = run_time
+        self.started = 0
+        self.running = 0
+        self.max_running = 0
+        self.lock = threading.Lock()
+
+    def Popen(self, cmd, **kwargs):
+        with self.lock:
+            self.started += 1
+        return FakePopen(self)
+
+
+class FakePopen(object):
+    def __init__(self, subprocess):
+        self.subprocess = subprocess
+        self.killed = threading.Event()
+        self.returncode = None
+        self.pid = 1234
+        self.stdin = self
+
+    def communicate(self, process_input=None):
+        subprocess = self.subprocess
+        with subprocess.lock:
+            subprocess.running += 1
+            subprocess.max_running = max(subprocess.max_running,
+                                         subprocess.running)
+        self.killed.wait(subprocess.run_time or 5)
+        with subprocess.lock:
+            subprocess.running -= 1
+        self.returncode = self.killed.is_set() and -9 or 0
+        return 'out', ''
+
+    def kill(self):
+        self.killed.set()
+
+    def close(self):
+        pass
+
+
+class ExecuteTest(unittest.TestCase):
+    def setUp(self):
+        self.addCleanup(setattr, command_utils, 'subprocess',
+                        command_utils.subprocess)
+        self.addCleanup(setattr, command_utils, 'LIMITS',
+                        command_utils.LIMITS)
+        stats_utils = command_utils.stats_utils
+        self.addCleanup(setattr, stats_utils, 'STATS', stats_utils.STATS)
+        stats_utils.STATS = stats_utils.StatsCollector()
+
+    def _fake(self, run_time=None):
+        command_utils.subprocess = FakeSubprocess(run_time)
+        return command_utils.subprocess
+
+    def _counters(self):
+        stats = command_utils.stats_utils.STATS.snapshot()
+        return stats[command_utils.stats_utils.COMMAND]['ip link']
+
+    def test_output(self):
+        self._fake(run_time=0.01)
+        self.assertEqual(command_utils.execute(['ip', 'link', 'show']), 'out')
+        self.assertEqual(self._counters()['count'], 1)
+
+    def test_timeout(self):
+        subprocess = self._fake()
+        command_utils.configure(timeout=0.05, retries=2, concurrency=0,
+                                key_concurrency=0)
+        self.assertRaises(command_utils.CommandTimeout,
+                          command_utils.execute, ['ip', 'link', 'show'])
+        # every attempt was killed and run again
+        self.assertEqual(subprocess.started, 3)
+        self.assertEqual(subprocess.running, 0)
+        counters = self._counters()
+        self.assertEqual(counters['timeouts'], 3)
+        self.assertEqual(counters['retries'], 2)
+        self.assertEqual(counters['errors'], 1)
+
+    def test_no_retries(self):
+        subprocess = self._fake()
+        command_utils.configure(timeout=0.05, retries=0, concurrency=0,
+                                key_concurrency=0)
+        self.assertRaises(command_utils.CommandTimeout,
+                          command_utils.execute, ['ip', 'link', 'show'])
+        self.assertEqual(subprocess.started, 1)
+        self.assertNotIn('retries', self._counters())
+
+    def _run_concurrently(self, keys):
+        threads = [threading.Thread(target=command_utils.execute,
+                                    args=(['ip', 'link', 'show'],),
+                                    kwargs={'limit_key':key})
+                   for key in keys]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(5)
+
+    def test_key_concurrency(self):
+        subprocess = self._fake(run_time=0.05)
+        command_utils.configure(timeout=0, retries=0, concurrency=0,
+                                key_concurrency=1)
+        self._run_concurrently(['eth0'] * 3)
+        self.assertEqual(subprocess.started, 3)
+        self.assertEqual(subprocess.max_running, 1)
+
+    def test_key_concurrency_per_key(self):
+        subprocess = self._fake(run_time=0.2)
+        command_utils.configure(timeout=0, retries=0, concurrency=0,
+                                key_concurrency=1)
+        self._run_concurrently(['eth0', 'eth1'])
+        self.assertEqual(subprocess.max_running, 2)
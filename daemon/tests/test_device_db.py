@@ -0,0 +1,95 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+#
+# Copyright 2013 Mellanox Technologies, Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import unittest
+
+from db import device_db
+
+FABRIC = 'fabric1'
+EPS = ['eth1', 'eth2', 'eth3']
+VFS = ['0000:0a:00.1', '0000:0a:00.2', '0000:0a:00.3']
+
+
+class DeviceDBTest(unittest.TestCase):
+    def setUp(self):
+        self.db = device_db.DeviceDB()
+        self.db.add_fabric(FABRIC, 'eth0', '0a:00', 1)
+        self.db.set_fabric_devices(FABRIC, list(EPS), list(VFS))
+
+    def test_free_pools_keep_order(self):
+        self.assertEqual(self.db.get_free_eths(FABRIC), EPS)
+        self.assertEqual(self.db.get_free_vfs(FABRIC), VFS)
+        self.assertEqual(self.db.get_free_devices(FABRIC), VFS + EPS)
+
+    def test_allocate_any_is_last_freed(self):
+        self.assertEqual(self.db.allocate_device(FABRIC, True), 'eth3')
+        self.assertEqual(self.db.allocate_device(FABRIC, True), 'eth2')
+        self.db.deallocate_device(FABRIC, True, 'eth3')
+        self.assertEqual(self.db.allocate_device(FABRIC, True), 'eth3')
+        self.assertEqual(self.db.allocate_device(FABRIC, False), VFS[-1])
+
+    def test_allocate_given_device(self):
+        self.assertEqual(self.db.allocate_device(FABRIC, True, 'eth2'), 'eth2')
+        self.assertEqual(self.db.get_free_eths(FABRIC), ['eth1', 'eth3'])
+        self.assertEqual(self.db.allocate_device(FABRIC, True, 'eth2'), None)
+
+    def test_deallocate_moves_device_to_pool_end(self):
+        self.db.allocate_device(FABRIC, True, 'eth1')
+        self.assertEqual(self.db.deallocate_device(FABRIC, True, 'eth1'),
+                         'eth1')
+        self.assertEqual(self.db.get_free_eths(FABRIC),
+                         ['eth2', 'eth3', 'eth1'])
+        # deallocating a free device does not duplicate it
+        self.db.deallocate_device(FABRIC, True, 'eth1')
+        self.assertEqual(self.db.get_free_eths(FABRIC),
+                         ['eth2', 'eth3', 'eth1'])
+
+    def test_deallocate_unknown_device(self):
+        self.assertEqual(self.db.deallocate_device(FABRIC, True, 'eth9'),
+                         None)
+        self.assertEqual(self.db.get_free_eths(FABRIC), EPS)
+
+    def test_allocate_exhausted_pool(self):
+        for _i in EPS:
+            self.db.allocate_device(FABRIC, True)
+        self.assertEqual(self.db.allocate_device(FABRIC, True), None)
+
+    def test_dev_fabric_index(self):
+        self.assertEqual(self.db.get_dev_fabric('eth2'), FABRIC)
+        self.assertEqual(self.db.get_dev_fabric(VFS[0]), FABRIC)
+        self.db.set_fabric_devices(FABRIC, ['eth4'], [])
+        self.assertEqual(self.db.get_dev_fabric('eth2'), None)
+        self.assertEqual(self.db.get_dev_fabric(VFS[0]), None)
+        self.assertEqual(self.db.get_dev_fabric('eth4'), FABRIC)
+
+    def test_add_remove_rename_device(self):
+        self.db.add_device(FABRIC, True, 'eth4')
+        self.assertEqual(self.db.get_free_eths(FABRIC), EPS + ['eth4'])
+        self.assertEqual(self.db.get_dev_fabric('eth4'), FABRIC)
+        self.db.allocate_device(FABRIC, True, 'eth1')
+        self.assertFalse(self.db.remove_device(FABRIC, True, 'eth1'))
+        self.assertTrue(self.db.remove_device(FABRIC, True, 'eth2'))
+        self.assertEqual(self.db.get_dev_fabric('eth2'), None)
+        self.assertTrue(self.db.rename_device(FABRIC, True, 'eth3', 'eth5'))
+        self.assertEqual(self.db.get_free_eths(FABRIC), ['eth4', 'eth5'])
+        self.assertEqual(self.db.get_devices(FABRIC, True),
+                         set(['eth4', 'eth5']))
+        self.assertFalse(self.db.rename_device(FABRIC, True, 'eth3', 'eth6'))
+
+
+if __name__ == '__main__':
+    unittest.main()
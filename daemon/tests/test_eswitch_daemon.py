@@ -0,0 +1,140 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+#
+# Copyright 2013 Mellanox Technologies, Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import collections
+import threading
+import time
+import unittest
+import uuid
+import zmq
+
+from nova.openstack.common import cfg
+from common import codec
+from common import config
+import eswitch_daemon
+
+
+class FakeDispatcher(object):
+    def __init__(self):
+        self.threads = []
+        self.release = threading.Event()
+
+    def handle_msg(self, msg):
+        self.threads.append(threading.current_thread().name)
+        if msg['action'] == 'crash':
+            raise ValueError('crashed')
+        if msg['action'] == 'slow':
+            self.release.wait(5)
+        return {'action':msg['action'], 'status':'OK', 'response':{}}
+
+
+class MessageForwardingTest(unittest.TestCase):
+    def setUp(self):
+        cfg.CONF(args=[], project='mlnx_daemon', default_config_files=[])
+        prefix = 'inproc://test-%s-' % uuid.uuid4().hex
+        for name in ('socket_of', 'socket_vif', 'socket_events'):
+            cfg.CONF.set_override(name, prefix + name, 'DAEMON')
+            self.addCleanup(cfg.CONF.clear_override, name, 'DAEMON')
+        self.daemon = eswitch_daemon.MlxEswitchDaemon.__new__(
+            eswitch_daemon.MlxEswitchDaemon)
+        self.daemon.workers = 2
+        self.daemon.default_timeout = 10
+        self.daemon.dispatcher = FakeDispatcher()
+        self.daemon.pending = collections.deque()
+        self.daemon.idle_workers = collections.deque()
+        self.daemon._init_connections()
+        self.client = self.daemon.context.socket(zmq.REQ)
+        self.client.connect(cfg.CONF.DAEMON.socket_vif)
+        self.notifier = self.daemon.context.socket(zmq.PUSH)
+        self.notifier.connect(cfg.CONF.DAEMON.socket_of)
+
+    def tearDown(self):
+        self.daemon.dispatcher.release.set()
+
+    def _pump(self, done, timeout=5):
+        deadline = time.time() + timeout
+        while not done() and time.time() < deadline:
+            self.daemon._get_msg()
+        return done()
+
+    def _request(self, action):
+        self.client.send(codec.encode({'action':action}, codec.JSON))
+        self.assertTrue(self._pump(lambda: self.client.poll(0)))
+        return codec.decode(self.client.recv())[0]
+
+    def test_requests_wait_for_idle_worker(self):
+        for i in range(2):
+            self.notifier.send(codec.encode({'action':'slow'}, codec.JSON))
+        dispatcher = self.daemon.dispatcher
+        self.assertTrue(self._pump(lambda: len(dispatcher.threads) == 2))
+        self.client.send(codec.encode({'action':'get_vnics'}, codec.JSON))
+        self._pump(lambda: False, timeout=0.1)
+        self.assertEqual(len(self.daemon.pending), 1)
+        dispatcher.release.set()
+        self.assertTrue(self._pump(lambda: self.client.poll(0)))
+        self.assertEqual(codec.decode(self.client.recv())[0]['status'], 'OK')
+
+    def test_request_reply(self):
+        self.assertEqual(self._request('get_vnics')['status'], 'OK')
+        self.assertTrue(self.daemon.dispatcher.threads[0].startswith('worker-'))
+
+    def test_notification_runs_on_worker(self):
+        self.notifier.send(codec.encode({'action':'slow'}, codec.JSON))
+        dispatcher = self.daemon.dispatcher
+        self.assertTrue(self._pump(lambda: dispatcher.threads))
+        # the slow notification does not hold up requests
+        start = time.time()
+        for i in range(3):
+            self.assertEqual(self._request('get_vnics')['action'],
+                             'get_vnics')
+        self.assertTrue(time.time() - start < 1)
+        self.assertFalse(dispatcher.release.is_set())
+        dispatcher.release.set()
+        # the notification's reply is not routed to any client
+        self._pump(lambda: False, timeout=0.1)
+        self.assertFalse(self.client.poll(0))
+        self.assertTrue(all(name.startswith('worker-')
+                            for name in dispatcher.threads))
+
+
+class HandleRawMsgTest(unittest.TestCase):
+    def setUp(self):
+        self.daemon = eswitch_daemon.MlxEswitchDaemon.__new__(
+            eswitch_daemon.MlxEswitchDaemon)
+        self.daemon.dispatcher = FakeDispatcher()
+
+    def _handle(self, data):
+        return codec.decode(self.daemon._handle_raw_msg(data))[0]
+
+    def test_reply(self):
+        result = self._handle(codec.encode({'action':'get_vnics'}))
+        self.assertEqual(result['status'], 'OK')
+
+    def test_failure_keeps_action(self):
+        result = self._handle(codec.encode({'action':'crash'}))
+        self.assertEqual(result, {'action':'crash', 'status':'FAIL',
+                                  'reason':'crashed'})
+
+    def test_undecodable(self):
+        for data in ('{not json', '[]'):
+            result = self._handle(data)
+            self.assertEqual(result['action'], 'unknown')
+            self.assertEqual(result['status'], 'FAIL')
+
+
+if __name__ == '__main__':
+    unittest.main()
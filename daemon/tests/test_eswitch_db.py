@@ -0,0 +1,175 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+#
+# Copyright 2013 Mellanox Technologies, Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import collections
+import unittest
+
+from db import eswitch_db
+
+MAC_1 = 'fa:16:3e:00:00:01'
+MAC_2 = 'fa:16:3e:00:00:02'
+MAC_3 = 'fa:16:3e:00:00:03'
+
+
+class eSwitchDBIndexTest(unittest.TestCase):
+    def setUp(self):
+        self.db = eswitch_db.eSwitchDB('fabric1')
+        for dev in ('eth1', 'eth2', 'eth3'):
+            self.db.create_port(dev, 'direct')
+
+    def _check_indexes(self):
+        """
+        @note: rebuild the secondary indexes from port_table and
+               port_policy and compare them with the maintained ones
+        """
+        dev_vnic = dict((dev, port.vnic) for dev, port
+                        in self.db.port_table.iteritems() if port.vnic)
+        device_vnics = {}
+        for vnic_mac in dev_vnic.itervalues():
+            vnic = self.db.port_policy.get(vnic_mac)
+            if vnic and vnic.device_id is not None:
+                device_vnics.setdefault(vnic.device_id, set()).add(vnic_mac)
+        vlan_vnics = {}
+        for vnic_mac, vnic in self.db.port_policy.iteritems():
+            if vnic.vlan is not None:
+                vlan_vnics.setdefault(vnic.vlan, set()).add(vnic_mac)
+        self.assertEqual(self.db.dev_vnic, dev_vnic)
+        self.assertEqual(self.db.device_vnics, device_vnics)
+        self.assertEqual(self.db.vlan_vnics, vlan_vnics)
+        self.assertEqual(set(self.db.get_attached_vnics()),
+                         set(dev_vnic.values()))
+
+    def test_attach_detach(self):
+        self.assertTrue(self.db.attach_vnic('eth1', 'vm1', MAC_1))
+        self.db.attach_vnic('eth2', 'vm1', MAC_2)
+        self._check_indexes()
+        self.assertEqual(sorted(self.db.get_vnics_for_device('vm1')),
+                         [MAC_1, MAC_2])
+        self.assertEqual(self.db.detach_vnic(MAC_1), 'eth1')
+        self._check_indexes()
+        self.assertEqual(self.db.get_vnics_for_device('vm1'), [MAC_2])
+        self.assertEqual(self.db.detach_vnic(MAC_3), None)
+        self._check_indexes()
+
+    def test_vlan(self):
+        self.db.attach_vnic('eth1', 'vm1', MAC_1)
+        self.db.set_vlan(MAC_1, 10)
+        # a VLAN may be set before the vNIC is attached
+        self.db.set_vlan(MAC_2, 10)
+        self._check_indexes()
+        self.assertEqual(sorted(self.db.get_vnics_for_vlan(10)),
+                         [MAC_1, MAC_2])
+        self.db.set_vlan(MAC_1, 20)
+        self._check_indexes()
+        self.assertEqual(self.db.get_vnics_for_vlan(10), [MAC_2])
+        self.assertEqual(self.db.get_vnics_for_vlan(20), [MAC_1])
+        # attaching a new vNIC resets its policy
+        self.db.attach_vnic('eth2', 'vm2', MAC_2)
+        self._check_indexes()
+        self.assertEqual(self.db.get_vnics_for_vlan(10), [])
+
+    def test_port_release(self):
+        self.db.attach_vnic('eth1', 'vm1', MAC_1)
+        self.db.set_vlan(MAC_1, 10)
+        self.assertEqual(self.db.port_release(MAC_1),
+                         {'vlan':10, 'dev':'eth1', 'device_id':'vm1',
+                          'type':'direct'})
+        self._check_indexes()
+        self.assertEqual(self.db.get_vnics_for_vlan(10), [])
+        self.assertEqual(self.db.get_vnics_for_device('vm1'), [])
+        self.assertEqual(self.db.port_release(MAC_1), None)
+
+    def test_reattach_port(self):
+        self.db.attach_vnic('eth1', 'vm1', MAC_1)
+        self.db.attach_vnic('eth1', 'vm2', MAC_2)
+        self._check_indexes()
+        self.assertEqual(self.db.get_vnics_for_device('vm1'), [])
+        self.assertEqual(self.db.get_vnics_for_device('vm2'), [MAC_2])
+
+    def test_rename_remove_port(self):
+        self.db.attach_vnic('eth1', 'vm1', MAC_1)
+        self.db.attach_vnic('eth2', 'vm1', MAC_2)
+        self.db.rename_port('eth1', 'eth4')
+        self._check_indexes()
+        self.assertEqual(self.db.get_dev_for_vnic(MAC_1), 'eth4')
+        self.assertEqual(self.db.remove_port('eth4'), MAC_1)
+        self._check_indexes()
+        self.assertEqual(self.db.get_vnics_for_device('vm1'), [MAC_2])
+        self.assertFalse('eth4' in self.db.get_ports())
+
+    def test_random_operations(self):
+        macs = [MAC_1, MAC_2, MAC_3]
+        devs = ['eth1', 'eth2', 'eth3']
+        ops = [lambda i: self.db.attach_vnic(devs[i % 3], 'vm%d' % (i % 2),
+                                             macs[i % 3]),
+               lambda i: self.db.detach_vnic(macs[i % 3]),
+               lambda i: self.db.set_vlan(macs[(i + 1) % 3], i % 4),
+               lambda i: self.db.port_release(macs[(i + 2) % 3])]
+        for i in range(200):
+            ops[(i * 7) % len(ops)](i)
+            self._check_indexes()
+
+
+class eSwitchDBChangesTest(unittest.TestCase):
+    def setUp(self):
+        self.db = eswitch_db.eSwitchDB('fabric1')
+        for dev in ('eth1', 'eth2', 'eth3'):
+            self.db.create_port(dev, 'direct')
+
+    def test_no_changes(self):
+        self.db.attach_vnic('eth1', 'vm1', MAC_1)
+        self.assertEqual(self.db.get_vnics_since(self.db.generation), ({}, []))
+
+    def test_changes_since(self):
+        self.db.attach_vnic('eth1', 'vm1', MAC_1)
+        self.db.attach_vnic('eth2', 'vm1', MAC_2)
+        generation = self.db.generation
+        self.db.detach_vnic(MAC_1)
+        self.db.attach_vnic('eth3', 'vm2', MAC_3)
+        # VLAN changes do not move the cursor
+        self.db.set_vlan(MAC_2, 10)
+        added, removed = self.db.get_vnics_since(generation)
+        self.assertEqual(added, {MAC_3:{'mac':MAC_3, 'device_id':'vm2'}})
+        self.assertEqual(removed, [MAC_1])
+        added, removed = self.db.get_vnics_since(0)
+        self.assertEqual(sorted(added), [MAC_2, MAC_3])
+        self.assertEqual(removed, [MAC_1])
+
+    def test_attach_and_detach_since(self):
+        generation = self.db.generation
+        self.db.attach_vnic('eth1', 'vm1', MAC_1)
+        self.db.port_release(MAC_1)
+        self.assertEqual(self.db.get_vnics_since(generation), ({}, [MAC_1]))
+
+    def test_changes_log_overflow(self):
+        self.db.changes = collections.deque(maxlen=2)
+        self.db.attach_vnic('eth1', 'vm1', MAC_1)
+        generation = self.db.generation
+        self.db.attach_vnic('eth2', 'vm1', MAC_2)
+        self.assertEqual(self.db.get_vnics_since(generation),
+                         ({MAC_2:{'mac':MAC_2, 'device_id':'vm1'}}, []))
+        self.db.attach_vnic('eth3', 'vm1', MAC_3)
+        self.db.detach_vnic(MAC_2)
+        self.assertEqual(self.db.get_vnics_since(generation), None)
+
+    def test_future_generation(self):
+        self.db.attach_vnic('eth1', 'vm1', MAC_1)
+        self.assertEqual(self.db.get_vnics_since(self.db.generation + 1), None)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,437 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+#
+# Copyright 2013 Mellanox Technologies, Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import collections
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+from nova.openstack.common import cfg
+from common import config
+from db import journal
+from eswitch_handler import eSwitchHandler
+from resource_mngr import ResourceManager
+from simulator import fake_libvirt
+from simulator import fake_sysfs
+from simulator import fake_uevents
+from utils.uevent_utils import UeventMonitor
+from utils.uevent_utils import parse_uevent
+
+FABRIC = 'fabric1'
+PF = 'simpf0'
+PCI_ID = '0000:03:00'
+MAC_1 = 'fa:16:3e:00:00:01'
+MAC_2 = 'fa:16:3e:00:00:02'
+MAC_3 = 'fa:16:3e:00:00:03'
+
+
+class FakeLinkBackend(object):
+    def __init__(self):
+        self.changes = []
+
+    def get_vf_vlans(self, pf):
+        return {}
+
+    def set_vf_vlans(self, pf, changes):
+        self.changes.extend((pf,) + tuple(change) for change in changes)
+        return [True] * len(changes)
+
+
+class eSwitchHandlerTestCase(unittest.TestCase):
+    def setUp(self):
+        cfg.CONF(args=[], project='mlnx_daemon', default_config_files=[])
+        self.sysfs = fake_sysfs.FakeSysfs()
+        self.addCleanup(self.sysfs.cleanup)
+        self.eths, self.hostdevs = self.sysfs.add_pf(PF, PCI_ID, vfs=4)
+        self.conn = fake_libvirt.FakeConnection()
+        self.rm = ResourceManager(sysfs_root=self.sysfs.root,
+                                  libvirt_factory=self.conn)
+        self.handler = eSwitchHandler(rm=self.rm)
+        self.link_backend = FakeLinkBackend()
+        self.handler.link_backend = self.link_backend
+        self.handler.vlan_batcher.link_backend = self.link_backend
+        self.handler.add_fabrics([(FABRIC, PF)])
+
+
+class RestoreTest(eSwitchHandlerTestCase):
+    def setUp(self):
+        super(RestoreTest, self).setUp()
+        self.state_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.state_dir)
+
+    def _journal(self):
+        j = journal.Journal(self.state_dir, commit_interval=0)
+        j.load()
+        return j
+
+    def test_unrestorable_vnics_released(self):
+        j = self._journal()
+        j.append(FABRIC, journal.OP_ATTACH, mac=MAC_1, dev=self.eths[0],
+                 device_id='vm1')
+        j.append(FABRIC, journal.OP_VLAN, mac=MAC_1, vlan=10)
+        j.append(FABRIC, journal.OP_ATTACH, mac=MAC_2, dev='simpf0v9',
+                 device_id='vm2')
+        j.append(FABRIC, journal.OP_VLAN, mac=MAC_2, vlan=20)
+        j.commit()
+        handler = eSwitchHandler(journal=self._journal(), rm=ResourceManager(
+            sysfs_root=self.sysfs.root, libvirt_factory=self.conn))
+        handler.link_backend = self.link_backend
+        handler.vlan_batcher.link_backend = self.link_backend
+        handler.add_fabrics([(FABRIC, PF)])
+        eswitch = handler.eswitches[FABRIC]
+        self.assertEqual(eswitch.get_attached_vnics().keys(), [MAC_1])
+        self.assertEqual(eswitch.get_dev_for_vnic(MAC_1), self.eths[0])
+        self.assertEqual(eswitch.get_vnics_for_vlan(10), [MAC_1])
+        self.assertEqual(eswitch.get_vnics_for_vlan(20), [])
+        self.assertEqual(self._journal().get_state()[FABRIC].keys(), [MAC_1])
+
+
+class DomainEventsTest(eSwitchHandlerTestCase):
+    def setUp(self):
+        super(DomainEventsTest, self).setUp()
+        self.rm.start_domain_events(self.handler.handle_domain_event)
+        self.allocated = []
+        allocate_device = self.rm.allocate_device
+        def _allocate_device(fabric, dev_type, dev=None):
+            self.allocated.append(dev)
+            return allocate_device(fabric, dev_type, dev)
+        self.rm.allocate_device = _allocate_device
+
+    def test_started_after_create_port(self):
+        dev = self.handler.create_port(FABRIC, 'direct', 'vm1', MAC_1)
+        domain = self.conn.create_domain([(dev, MAC_1)])
+        self.assertEqual(self.allocated, [None])
+        self.assertEqual(self.handler.domains,
+                         {domain.uuid:set([(dev, MAC_1, FABRIC)])})
+        eswitch = self.handler.eswitches[FABRIC]
+        self.assertEqual(eswitch.get_dev_for_vnic(MAC_1), dev)
+        self.assertEqual(eswitch.get_attached_vnics()[MAC_1]['device_id'],
+                         'vm1')
+
+    def test_started_unknown_vnic(self):
+        dev = self.eths[1]
+        self.conn.create_domain([(dev, MAC_2)])
+        self.assertEqual(self.allocated, [dev])
+        self.assertEqual(self.handler.eswitches[FABRIC].get_dev_for_vnic(MAC_2),
+                         dev)
+        self.assertFalse(dev in self.rm.get_free_eths(FABRIC))
+
+    def test_stopped(self):
+        dev = self.handler.create_port(FABRIC, 'direct', 'vm1', MAC_1)
+        domain = self.conn.create_domain([(dev, MAC_1)])
+        self.conn.destroy_domain(domain.domid)
+        self.assertEqual(self.handler.domains, {})
+        self.assertEqual(self.handler.devices, set())
+        eswitch = self.handler.eswitches[FABRIC]
+        self.assertEqual(eswitch.get_attached_vnics(), {})
+        self.assertTrue(dev in self.rm.get_free_eths(FABRIC))
+
+    def test_restarted(self):
+        dev = self.handler.create_port(FABRIC, 'direct', 'vm1', MAC_1)
+        domain = self.conn.create_domain([(dev, MAC_1)])
+        self.conn.destroy_domain(domain.domid)
+        self.conn.create_domain([(dev, MAC_1)])
+        self.assertEqual(self.allocated, [None, dev])
+        self.assertEqual(self.handler.eswitches[FABRIC].get_dev_for_vnic(MAC_1),
+                         dev)
+        self.assertFalse(dev in self.rm.get_free_eths(FABRIC))
+
+
+class UeventChangesTest(eSwitchHandlerTestCase):
+    def _changes(self, action, vf_pci, netdev=None, **keys):
+        subsystem = 'net' if netdev else 'pci'
+        uevent = fake_uevents.make_uevent(
+            action, fake_uevents.vf_devpath(vf_pci, netdev), subsystem, **keys)
+        return self.rm.get_uevent_changes(parse_uevent(uevent))
+
+    def test_add(self):
+        vf_pci = self.sysfs.add_vf(PCI_ID, 4)
+        self.assertEqual(self._changes('add', vf_pci),
+                         [('add', FABRIC, 'hostdev', vf_pci, None)])
+        self.sysfs.add_netdev(vf_pci, 'simpf0v4')
+        self.assertEqual(self._changes('add', vf_pci), [])
+        self.assertEqual(self._changes('add', vf_pci, 'simpf0v4'),
+                         [('add', FABRIC, 'direct', 'simpf0v4', None)])
+
+    def test_add_other_port(self):
+        vf_pci = self.sysfs.add_vf(PCI_ID, 4)
+        self.sysfs.add_netdev(vf_pci, 'simpf0v4', port=2)
+        self.assertEqual(self._changes('add', vf_pci, 'simpf0v4'), [])
+
+    def test_netdev_of_hostdev_vf(self):
+        vf_pci = self.sysfs.add_vf(PCI_ID, 4)
+        self.rm.add_device(FABRIC, 'hostdev', vf_pci)
+        self.sysfs.add_netdev(vf_pci, 'simpf0v4')
+        self.assertEqual(self._changes('add', vf_pci, 'simpf0v4'),
+                         [('add', FABRIC, 'direct', 'simpf0v4', None),
+                          ('remove', FABRIC, 'hostdev', vf_pci, None)])
+
+    def test_remove(self):
+        vf_pci = '%s.1' % PCI_ID
+        self.sysfs.remove_netdev(vf_pci, self.eths[0])
+        self.assertEqual(self._changes('remove', vf_pci, self.eths[0]),
+                         [('remove', FABRIC, 'direct', self.eths[0], None),
+                          ('add', FABRIC, 'hostdev', vf_pci, None)])
+        self.sysfs.remove_vf(PCI_ID, 0)
+        self.assertEqual(self._changes('remove', vf_pci, self.eths[0]),
+                         [('remove', FABRIC, 'direct', self.eths[0], None)])
+        self.assertEqual(self._changes('remove', vf_pci), [])
+
+    def test_rename(self):
+        vf_pci = '%s.1' % PCI_ID
+        old_devpath = fake_uevents.vf_devpath(vf_pci, self.eths[0])
+        self.assertEqual(self._changes('move', vf_pci, 'eth_renamed',
+                                       DEVPATH_OLD=old_devpath),
+                         [('rename', FABRIC, 'direct', self.eths[0],
+                           'eth_renamed')])
+        self.assertEqual(self._changes('move', vf_pci, 'eth_other',
+                                       DEVPATH_OLD=old_devpath + 'x'), [])
+
+    def test_foreign_devices(self):
+        self.assertEqual(self._changes('add', '0000:09:00.1', 'eth9'), [])
+        self.assertEqual(self._changes('add', '0000:09:00.1'), [])
+        self.assertEqual(self._changes('add', '%s.0' % PCI_ID), [])
+
+
+class GetVnicsSinceTest(eSwitchHandlerTestCase):
+    def test_first_call_is_full(self):
+        self.handler.create_port(FABRIC, 'direct', 'vm1', MAC_1)
+        ret = self.handler.get_vnics_since([FABRIC], {}, None)
+        self.assertTrue(ret['full'])
+        self.assertEqual(ret['epoch'], self.handler.epoch)
+        self.assertEqual(ret['added'].keys(), [MAC_1])
+        self.assertEqual(ret['generation'],
+                         {FABRIC:self.handler.eswitches[FABRIC].generation})
+
+    def test_incremental(self):
+        self.handler.create_port(FABRIC, 'direct', 'vm1', MAC_1)
+        ret = self.handler.get_vnics_since([FABRIC], {}, None)
+        self.handler.create_port(FABRIC, 'direct', 'vm1', MAC_2)
+        self.handler.delete_port(FABRIC, MAC_1)
+        ret = self.handler.get_vnics_since([FABRIC], ret['generation'],
+                                           ret['epoch'])
+        self.assertFalse(ret['full'])
+        self.assertEqual(ret['added'].keys(), [MAC_2])
+        self.assertEqual(ret['removed'], [MAC_1])
+        ret = self.handler.get_vnics_since([FABRIC], ret['generation'],
+                                           ret['epoch'])
+        self.assertFalse(ret['full'])
+        self.assertEqual((ret['added'], ret['removed']), ({}, []))
+
+    def test_epoch_change_is_full(self):
+        self.handler.create_port(FABRIC, 'direct', 'vm1', MAC_1)
+        ret = self.handler.get_vnics_since([FABRIC], {}, None)
+        ret = self.handler.get_vnics_since([FABRIC], ret['generation'],
+                                           'old-epoch')
+        self.assertTrue(ret['full'])
+        self.assertEqual(ret['added'].keys(), [MAC_1])
+
+    def test_changes_log_overflow_is_full(self):
+        self.handler.eswitches[FABRIC].changes = collections.deque(maxlen=1)
+        self.handler.create_port(FABRIC, 'direct', 'vm1', MAC_1)
+        ret = self.handler.get_vnics_since([FABRIC], {}, None)
+        self.handler.create_port(FABRIC, 'direct', 'vm1', MAC_2)
+        self.handler.create_port(FABRIC, 'direct', 'vm1', MAC_3)
+        self.handler.delete_port(FABRIC, MAC_1)
+        ret = self.handler.get_vnics_since([FABRIC], ret['generation'],
+                                           ret['epoch'])
+        self.assertTrue(ret['full'])
+        self.assertEqual(sorted(ret['added']), [MAC_2, MAC_3])
+        self.assertEqual(ret['removed'], [])
+
+    def test_unknown_fabric_is_full(self):
+        ret = self.handler.get_vnics_since([FABRIC], {'other':1},
+                                           self.handler.epoch)
+        self.assertTrue(ret['full'])
+
+
+class SetVlansTest(eSwitchHandlerTestCase):
+    def test_set_vlans(self):
+        self.sysfs.add_pf('simpf1', '0000:04:00', vfs=2)
+        self.handler.add_fabrics([('fabric2', 'simpf1')])
+        dev_1 = self.handler.create_port(FABRIC, 'direct', 'vm1', MAC_1)
+        dev_2 = self.handler.create_port('fabric2', 'direct', 'vm1', MAC_2)
+        results = self.handler.set_vlans([(FABRIC, MAC_1, 10),
+                                          ('fabric2', MAC_2, 20),
+                                          ('fabric3', MAC_3, 30)])
+        self.assertEqual(results, [True, True, False])
+        bounce = cfg.CONF.DAEMON.vlan_link_bounce
+        get_vf_index = self.handler.pci_utils.get_vf_index
+        self.assertEqual(sorted(self.link_backend.changes),
+                         [(PF, get_vf_index(dev_1, 'direct'), dev_1, 10, '0',
+                           bounce),
+                          ('simpf1', get_vf_index(dev_2, 'direct'), dev_2, 20,
+                           '0', bounce)])
+        self.assertEqual(self.handler.eswitches[FABRIC].get_vnics_for_vlan(10),
+                         [MAC_1])
+
+    def test_fabrics_in_parallel(self):
+        self.sysfs.add_pf('simpf1', '0000:04:00', vfs=2)
+        self.handler.add_fabrics([('fabric2', 'simpf1')])
+        self.handler.create_port(FABRIC, 'direct', 'vm1', MAC_1)
+        self.handler.create_port('fabric2', 'direct', 'vm1', MAC_2)
+        # each fabric's VLAN change waits until both are in progress
+        cond = threading.Condition()
+        pfs = set()
+        def set_vf_vlans(pf, changes):
+            with cond:
+                pfs.add(pf)
+                cond.notify_all()
+                deadline = time.time() + 5
+                while len(pfs) < 2 and time.time() < deadline:
+                    cond.wait(deadline - time.time())
+                return [len(pfs) == 2] * len(changes)
+        self.link_backend.set_vf_vlans = set_vf_vlans
+        results = {}
+        def set_vlan(fabric, mac):
+            results[fabric] = self.handler.set_vlan(fabric, mac, 10)
+        threads = [threading.Thread(target=set_vlan, args=args)
+                   for args in ((FABRIC, MAC_1), ('fabric2', MAC_2))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(10)
+        self.assertEqual(results, {FABRIC:True, 'fabric2':True})
+
+    def test_vlan_of_detached_vnic(self):
+        self.assertEqual(self.handler.set_vlans([(FABRIC, MAC_1, 10)]),
+                         [False])
+        self.assertEqual(self.handler.eswitches[FABRIC].get_vnics_for_vlan(10),
+                         [MAC_1])
+        self.assertEqual(self.link_backend.changes, [])
+
+
+class UeventTest(eSwitchHandlerTestCase):
+    def _replay(self, *uevents):
+        """
+        @note: the monitor returns once the fake socket runs dry
+        """
+        sock = fake_uevents.FakeUeventSocket(uevents)
+        UeventMonitor(self.handler.handle_uevent, sock)._run()
+
+    def _vf_uevent(self, action, vf_pci):
+        return fake_uevents.make_uevent(action,
+                                        fake_uevents.vf_devpath(vf_pci), 'pci')
+
+    def _net_uevent(self, action, vf_pci, netdev, **keys):
+        return fake_uevents.make_uevent(
+            action, fake_uevents.vf_devpath(vf_pci, netdev), 'net', **keys)
+
+    def _check_devices(self, eths, vfs):
+        device_db = self.rm.device_db
+        self.assertEqual(device_db.get_devices(FABRIC, True), set(eths))
+        self.assertEqual(device_db.get_devices(FABRIC, False), set(vfs))
+        ports = self.handler.eswitches[FABRIC].get_ports()
+        self.assertEqual(sorted(ports),
+                         sorted(list(eths) + list(vfs)))
+        for dev in eths:
+            self.assertEqual(ports[dev].type, 'direct')
+            self.assertEqual(device_db.get_dev_fabric(dev), FABRIC)
+        for dev in vfs:
+            self.assertEqual(ports[dev].type, 'hostdev')
+
+    def test_add_vf_with_netdev(self):
+        vf_pci = self.sysfs.add_vf(PCI_ID, 4)
+        self.sysfs.add_netdev(vf_pci, 'simpf0v4')
+        self._replay(self._vf_uevent('add', vf_pci),
+                     self._net_uevent('add', vf_pci, 'simpf0v4'))
+        self._check_devices(self.eths + ['simpf0v4'], [])
+        self.assertTrue('simpf0v4' in self.rm.get_free_eths(FABRIC))
+
+    def test_add_hostdev_vf(self):
+        vf_pci = self.sysfs.add_vf(PCI_ID, 4)
+        self._replay(self._vf_uevent('add', vf_pci))
+        self._check_devices(self.eths, [vf_pci])
+        self.assertEqual(self.rm.get_free_vfs(FABRIC), [vf_pci])
+
+    def test_netdev_replaces_hostdev_vf(self):
+        vf_pci = self.sysfs.add_vf(PCI_ID, 4)
+        self._replay(self._vf_uevent('add', vf_pci))
+        self.sysfs.add_netdev(vf_pci, 'simpf0v4')
+        self._replay(self._net_uevent('add', vf_pci, 'simpf0v4'))
+        self._check_devices(self.eths + ['simpf0v4'], [])
+
+    def test_remove_vf(self):
+        self.handler.create_port(FABRIC, 'direct', 'vm1', MAC_1)
+        dev = self.handler.eswitches[FABRIC].get_dev_for_vnic(MAC_1)
+        index = self.eths.index(dev)
+        vf_pci = self.sysfs.remove_vf(PCI_ID, index)
+        self._replay(self._net_uevent('remove', vf_pci, dev),
+                     self._vf_uevent('remove', vf_pci))
+        self._check_devices([eth for eth in self.eths if eth != dev], [])
+        self.assertEqual(self.rm.get_fabric_for_dev(dev), None)
+        self.assertEqual(self.handler.eswitches[FABRIC].get_attached_vnics(),
+                         {})
+
+    def test_rename_netdev(self):
+        self.handler.create_port(FABRIC, 'direct', 'vm1', MAC_1)
+        dev = self.handler.eswitches[FABRIC].get_dev_for_vnic(MAC_1)
+        vf_pci = '%s.%d' % (PCI_ID, self.eths.index(dev) + 1)
+        self.sysfs.rename_netdev(vf_pci, dev, 'eth_renamed')
+        self._replay(self._net_uevent(
+            'move', vf_pci, 'eth_renamed',
+            DEVPATH_OLD=fake_uevents.vf_devpath(vf_pci, dev)))
+        eths = [eth for eth in self.eths if eth != dev] + ['eth_renamed']
+        self._check_devices(eths, [])
+        eswitch = self.handler.eswitches[FABRIC]
+        self.assertEqual(eswitch.get_dev_for_vnic(MAC_1), 'eth_renamed')
+        self.assertEqual(eswitch.dev_vnic, {'eth_renamed':MAC_1})
+        self.assertFalse('eth_renamed' in self.rm.get_free_eths(FABRIC))
+
+    def test_foreign_device_ignored(self):
+        self._replay(self._net_uevent('add', '0000:09:00.1', 'eth9'),
+                     self._vf_uevent('add', '0000:09:00.1'))
+        self._check_devices(self.eths, [])
+
+    def test_rescan_after_lost_uevents(self):
+        self.assertEqual(self.rm.get_free_eths(FABRIC), sorted(self.eths))
+        vf_pci = self.sysfs.add_vf(PCI_ID, 4)
+        self.sysfs.add_netdev(vf_pci, 'simpf0v4')
+        hostdev_pci = self.sysfs.add_vf(PCI_ID, 5)
+        removed_pci = self.sysfs.remove_vf(PCI_ID, 0)
+        self.handler.handle_uevent(None)
+        self._check_devices(self.eths[1:] + ['simpf0v4'], [hostdev_pci])
+        self.assertEqual(self.rm.pci_utils.get_pf_vfs(PF)[4], vf_pci)
+        self.assertFalse(removed_pci in
+                         self.rm.pci_utils.get_pf_vfs(PF).values())
+
+    def test_changes_committed_once(self):
+        commits = []
+        self.handler._commit = lambda: commits.append(True)
+        vfs = [self.sysfs.add_vf(PCI_ID, index) for index in (4, 5, 6)]
+        self.handler.handle_uevent(None)
+        self._check_devices(self.eths, vfs)
+        self.assertEqual(len(commits), 1)
+
+    def test_added_device_refreshes_domain_devices(self):
+        domain = self.conn.create_domain([('simpf0v4', MAC_1)])
+        self.handler.sync_devices()
+        self.assertEqual(self.handler.devices, set())
+        vf_pci = self.sysfs.add_vf(PCI_ID, 4)
+        self.sysfs.add_netdev(vf_pci, 'simpf0v4')
+        self._replay(self._net_uevent('add', vf_pci, 'simpf0v4'))
+        self.handler.sync_devices()
+        self.assertEqual(self.handler.devices,
+                         set([('simpf0v4', MAC_1, FABRIC)]))
+        self.assertEqual(self.handler.domains,
+                         {domain.uuid:set([('simpf0v4', MAC_1, FABRIC)])})
+
+
+if __name__ == '__main__':
+    unittest.main()
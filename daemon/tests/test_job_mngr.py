@@ -0,0 +1,84 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+#
+# Copyright 2013 Mellanox Technologies, Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import threading
+import unittest
+
+import job_mngr
+
+
+class FakePublisher(object):
+    def __init__(self, fail=False):
+        self.fail = fail
+        self.notifications = []
+        self.published = threading.Event()
+
+    def publish(self, topic, msg):
+        self.notifications.append((topic, msg))
+        self.published.set()
+        if self.fail:
+            raise IOError('socket closed')
+
+
+class JobManagerTest(unittest.TestCase):
+    def setUp(self):
+        self.publisher = FakePublisher()
+        self.job_mngr = job_mngr.JobManager(workers=1, max_jobs=2)
+
+    def _run(self, func):
+        self.job_mngr.start(self.publisher)
+        job_id = self.job_mngr.submit('set_vlan', func)
+        self.assertTrue(self.publisher.published.wait(5))
+        return job_id
+
+    def test_pending(self):
+        job_id = self.job_mngr.submit('set_vlan', lambda: {'status':'OK'})
+        self.assertEqual(self.job_mngr.get_job(job_id),
+                         {'job_id':job_id, 'action':'set_vlan',
+                          'state':job_mngr.PENDING})
+
+    def test_done(self):
+        job_id = self._run(lambda: {'status':'OK'})
+        self.assertEqual(self.publisher.notifications,
+                         [(job_mngr.JOB_TOPIC,
+                           {'job_id':job_id, 'result':{'status':'OK'}})])
+        job = self.job_mngr.get_job(job_id)
+        self.assertEqual(job['state'], job_mngr.DONE)
+        self.assertEqual(job['result'], {'status':'OK'})
+
+    def test_failure(self):
+        def fail():
+            raise RuntimeError('device busy')
+        job_id = self._run(fail)
+        self.assertEqual(self.job_mngr.get_job(job_id)['result'],
+                         {'status':'FAIL', 'reason':'device busy'})
+
+    def test_publish_failure(self):
+        self.publisher.fail = True
+        job_id = self._run(lambda: {'status':'OK'})
+        self.assertEqual(self.job_mngr.get_job(job_id)['state'],
+                         job_mngr.DONE)
+        # the worker survives and runs the next job
+        self.publisher.published.clear()
+        self.job_mngr.submit('set_vlan', lambda: {'status':'OK'})
+        self.assertTrue(self.publisher.published.wait(5))
+
+    def test_max_jobs(self):
+        job_ids = [self.job_mngr.submit('set_vlan', lambda: {'status':'OK'})
+                   for i in range(3)]
+        self.assertIsNone(self.job_mngr.get_job(job_ids[0]))
+        self.assertIsNotNone(self.job_mngr.get_job(job_ids[2]))
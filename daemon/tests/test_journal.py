@@ -0,0 +1,150 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+#
+# Copyright 2013 Mellanox Technologies, Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from db import journal
+
+FABRIC = 'fabric1'
+MAC_1 = 'fa:16:3e:00:00:01'
+MAC_2 = 'fa:16:3e:00:00:02'
+
+
+class JournalTest(unittest.TestCase):
+    def setUp(self):
+        self.state_dir = tempfile.mkdtemp()
+        self.journal_path = os.path.join(self.state_dir, journal.JOURNAL_FILE)
+
+    def tearDown(self):
+        shutil.rmtree(self.state_dir)
+
+    def _journal(self, compact_records=10000):
+        j = journal.Journal(self.state_dir, commit_interval=0,
+                            compact_records=compact_records)
+        j.load()
+        return j
+
+    def test_replay(self):
+        j = self._journal()
+        j.append(FABRIC, journal.OP_ATTACH, mac=MAC_1, dev='eth1',
+                 device_id='vm1')
+        j.append(FABRIC, journal.OP_VLAN, mac=MAC_1, vlan=10)
+        j.append(FABRIC, journal.OP_ATTACH, mac=MAC_2, dev='eth2',
+                 device_id='vm2')
+        j.append(FABRIC, journal.OP_DETACH, mac=MAC_2)
+        j.append(FABRIC, journal.OP_RENAME, mac=MAC_1, dev='eth3')
+        j.commit()
+        state = self._journal().get_state()
+        self.assertEqual(state, {FABRIC: {MAC_1: {'dev': 'eth3',
+                                                  'device_id': 'vm1',
+                                                  'vlan': 10,
+                                                  'attached': True},
+                                          MAC_2: {'dev': 'eth2',
+                                                  'device_id': None,
+                                                  'vlan': None,
+                                                  'attached': False}}})
+
+    def test_torn_tail(self):
+        j = self._journal()
+        j.append(FABRIC, journal.OP_VLAN, mac=MAC_1, vlan=10)
+        j.commit()
+        valid_size = os.path.getsize(self.journal_path)
+        with open(self.journal_path, 'ab') as f:
+            f.write('0badc0de [2, "fabric1", "vlan"')
+        j = self._journal()
+        self.assertEqual(j.get_state()[FABRIC][MAC_1]['vlan'], 10)
+        self.assertEqual(j.seq, 1)
+        self.assertEqual(os.path.getsize(self.journal_path), valid_size)
+        # appends continue after the valid prefix
+        j.append(FABRIC, journal.OP_VLAN, mac=MAC_1, vlan=20)
+        j.commit()
+        self.assertEqual(self._journal().get_state()[FABRIC][MAC_1]['vlan'],
+                         20)
+
+    def test_corrupted_record(self):
+        j = self._journal()
+        j.append(FABRIC, journal.OP_VLAN, mac=MAC_1, vlan=10)
+        j.append(FABRIC, journal.OP_VLAN, mac=MAC_2, vlan=20)
+        j.commit()
+        with open(self.journal_path, 'rb') as f:
+            lines = f.readlines()
+        with open(self.journal_path, 'wb') as f:
+            f.write(lines[0] + lines[1].replace('20', '30'))
+        state = self._journal().get_state()
+        self.assertEqual(state, {FABRIC: {MAC_1: {'dev': None,
+                                                  'device_id': None,
+                                                  'vlan': 10,
+                                                  'attached': False}}})
+
+    def test_compaction(self):
+        j = self._journal()
+        for vlan in range(1, 6):
+            j.append(FABRIC, journal.OP_VLAN, mac=MAC_1, vlan=vlan)
+        j.commit()
+        # records not yet committed are kept in the compacted journal
+        j.append(FABRIC, journal.OP_RELEASE, mac=MAC_1)
+        j.append(FABRIC, journal.OP_VLAN, mac=MAC_2, vlan=7)
+        j._compact()
+        self.assertTrue(os.path.exists(os.path.join(self.state_dir,
+                                                     journal.SNAPSHOT_FILE)))
+        self.assertEqual(j.records, 0)
+        j.append(FABRIC, journal.OP_VLAN, mac=MAC_2, vlan=8)
+        j.commit()
+        with open(self.journal_path, 'rb') as f:
+            self.assertEqual(len(f.readlines()), 1)
+        restored = self._journal()
+        self.assertEqual(restored.seq, 8)
+        self.assertEqual(restored.get_state(), j.get_state())
+        self.assertEqual(restored.get_state()[FABRIC].keys(), [MAC_2])
+        self.assertEqual(restored.get_state()[FABRIC][MAC_2]['vlan'], 8)
+
+    def test_commit_raises_flush_error(self):
+        journal.FLUSH_RETRY_INTERVAL = 0.01
+        self.addCleanup(setattr, journal, 'FLUSH_RETRY_INTERVAL', 1)
+        j = self._journal()
+        fd = j.fd
+        class FailingFile(object):
+            def write(self, data):
+                fd.write(data)
+            def flush(self):
+                raise IOError(5, 'Input/output error')
+        j.fd = FailingFile()
+        j.append(FABRIC, journal.OP_VLAN, mac=MAC_1, vlan=10)
+        self.assertRaises(IOError, j.commit)
+        # the flusher retries and commits once the error is gone
+        j.fd = fd
+        j.append(FABRIC, journal.OP_VLAN, mac=MAC_1, vlan=20)
+        j.commit()
+        self.assertEqual(j.synced_seq, 2)
+        self.assertIsNone(j.flush_error)
+        self.assertEqual(self._journal().get_state()[FABRIC][MAC_1]['vlan'],
+                         20)
+
+    def test_corrupted_snapshot(self):
+        with open(os.path.join(self.state_dir, journal.SNAPSHOT_FILE),
+                  'wb') as f:
+            f.write('00000000\n{"seq": 5, "state": {}}')
+        j = self._journal()
+        self.assertEqual(j.seq, 0)
+        self.assertEqual(j.get_state(), {})
+
+
+if __name__ == '__main__':
+    unittest.main()
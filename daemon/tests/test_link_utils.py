@@ -0,0 +1,147 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+#
+# Copyright 2013 Mellanox Technologies, Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import errno
+import unittest
+
+from simulator import fake_netlink
+from simulator import fake_sysfs
+from utils import link_utils
+
+PF = 'simpf0'
+PCI_ID = '0000:03:00'
+
+
+class FakeFallback(object):
+    name = 'fake'
+
+    def __init__(self):
+        self.changes = []
+
+    def set_vf_vlans(self, pf, changes):
+        self.changes.append((pf, list(changes)))
+        return [True] * len(changes)
+
+
+class FailingNetlinkSocket(fake_netlink.FakeNetlinkSocket):
+    """
+    Fails the requests listed in errors, in the order they are handled.
+    """
+    def __init__(self, errors, ifindexes=None):
+        fake_netlink.FakeNetlinkSocket.__init__(self, ifindexes)
+        self.errors = list(errors)
+
+    def _handle(self, msg_type, payload):
+        error = fake_netlink.FakeNetlinkSocket._handle(self, msg_type, payload)
+        if self.errors:
+            return self.errors.pop(0) or error
+        return error
+
+
+class SilentNetlinkSocket(fake_netlink.FakeNetlinkSocket):
+    def send(self, data):
+        return len(data)
+
+
+class NetlinkBackendTest(unittest.TestCase):
+    def setUp(self):
+        self.sysfs = fake_sysfs.FakeSysfs()
+        self.addCleanup(self.sysfs.cleanup)
+        self.eths, hostdevs = self.sysfs.add_pf(PF, PCI_ID, vfs=2)
+        self.fallback = FakeFallback()
+
+    def _backend(self, sock):
+        return link_utils.NetlinkBackend(self.sysfs.root,
+                                         socket_factory=sock,
+                                         fallback=self.fallback,
+                                         timeout=1)
+
+    def _ifindex(self, dev):
+        return link_utils.NetlinkBackend(self.sysfs.root)._get_ifindex(dev)
+
+    def test_set_vf_vlans(self):
+        sock = fake_netlink.FakeNetlinkSocket()
+        backend = self._backend(sock)
+        results = backend.set_vf_vlans(PF, [(1, self.eths[0], 10, 0, True),
+                                            (2, self.eths[1], 20, 3, False)])
+        self.assertEqual(results, [True, True])
+        pf_index = self._ifindex(PF)
+        self.assertEqual(sock.vf_vlans, {(pf_index, 1):(10, 0),
+                                         (pf_index, 2):(20, 3)})
+        # only the bounced device went down and up again
+        self.assertEqual(sock.links, {self._ifindex(self.eths[0]):True})
+        self.assertEqual(len(sock.requests), 4)
+        self.assertTrue(0 < sock.timeout <= 1)
+        self.assertEqual(self.fallback.changes, [])
+
+    def test_partial_failure(self):
+        pf_index = self._ifindex(PF)
+        # the device of the first change is gone
+        sock = fake_netlink.FakeNetlinkSocket(
+            ifindexes=[pf_index, self._ifindex(self.eths[1])])
+        backend = self._backend(sock)
+        results = backend.set_vf_vlans(PF, [(1, self.eths[0], 10, 0, True),
+                                            (2, self.eths[1], 20, 0, True)])
+        self.assertEqual(results, [False, True])
+        self.assertEqual(self.fallback.changes, [])
+
+    def test_identical_payloads(self):
+        # down of the first change fails, the second one is acknowledged
+        sock = FailingNetlinkSocket([errno.EBUSY])
+        backend = self._backend(sock)
+        change = (1, self.eths[0], 10, 0, True)
+        self.assertEqual(backend.set_vf_vlans(PF, [change, change]),
+                         [False, True])
+
+    def test_eperm_fallback(self):
+        sock = FailingNetlinkSocket([errno.EPERM])
+        backend = self._backend(sock)
+        changes = [(1, self.eths[0], 10, 0, True)]
+        self.assertEqual(backend.set_vf_vlans(PF, changes), [True])
+        self.assertEqual(self.fallback.changes, [(PF, changes)])
+        self.assertTrue(backend.disabled)
+        # netlink is no longer tried
+        requests = len(sock.requests)
+        self.assertEqual(backend.set_vf_vlans(PF, changes), [True])
+        self.assertEqual(len(sock.requests), requests)
+        self.assertEqual(len(self.fallback.changes), 2)
+
+    def test_timeout_fallback(self):
+        sock = SilentNetlinkSocket()
+        backend = self._backend(sock)
+        changes = [(1, self.eths[0], 10, 0, False)]
+        self.assertEqual(backend.set_vf_vlans(PF, changes), [True])
+        self.assertEqual(self.fallback.changes, [(PF, changes)])
+        self.assertTrue(sock.closed)
+        self.assertEqual(backend.sock, None)
+        self.assertFalse(backend.disabled)
+
+    def test_unknown_device_fallback(self):
+        backend = self._backend(fake_netlink.FakeNetlinkSocket())
+        changes = [(1, 'nodev', 10, 0, True)]
+        self.assertEqual(backend.set_vf_vlans(PF, changes), [True])
+        self.assertEqual(self.fallback.changes, [(PF, changes)])
+
+    def test_no_fallback(self):
+        backend = link_utils.NetlinkBackend(
+            self.sysfs.root, socket_factory=FailingNetlinkSocket([errno.EPERM]))
+        self.assertRaises(RuntimeError, backend.set_vf_vlan,
+                          PF, 1, self.eths[0], 10)
+
+
+if __name__ == '__main__':
+    unittest.main()
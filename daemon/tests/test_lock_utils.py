@@ -0,0 +1,114 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+#
+# Copyright 2013 Mellanox Technologies, Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import threading
+import time
+import unittest
+
+from utils.lock_utils import RWLock
+
+
+def _spawn(func, *args):
+    thread = threading.Thread(target=func, args=args)
+    thread.daemon = True
+    thread.start()
+    return thread
+
+
+def _wait_for(predicate, timeout=5):
+    deadline = time.time() + timeout
+    while not predicate() and time.time() < deadline:
+        time.sleep(0.01)
+    return predicate()
+
+
+class RWLockTest(unittest.TestCase):
+    def setUp(self):
+        self.lock = RWLock()
+        self.events = []
+
+    def _reader(self, name, hold):
+        with self.lock.read_lock():
+            self.events.append(('in', name))
+            hold.wait(5)
+            self.events.append(('out', name))
+
+    def _writer(self, name, hold=None):
+        with self.lock.write_lock():
+            self.events.append(('in', name))
+            if hold:
+                hold.wait(5)
+            self.events.append(('out', name))
+
+    def test_readers_in_parallel(self):
+        hold = threading.Event()
+        readers = [_spawn(self._reader, 'r%d' % i, hold) for i in range(3)]
+        self.assertTrue(_wait_for(lambda: len(self.events) == 3))
+        self.assertEqual(sorted(self.events),
+                         [('in', 'r0'), ('in', 'r1'), ('in', 'r2')])
+        hold.set()
+        for reader in readers:
+            reader.join(5)
+
+    def test_writer_excludes_readers(self):
+        hold = threading.Event()
+        writer = _spawn(self._writer, 'w', hold)
+        self.assertTrue(_wait_for(lambda: self.events == [('in', 'w')]))
+        reader = _spawn(self._reader, 'r', threading.Event())
+        time.sleep(0.1)
+        self.assertEqual(self.events, [('in', 'w')])
+        hold.set()
+        writer.join(5)
+        self.assertTrue(_wait_for(lambda: ('in', 'r') in self.events))
+        self.assertEqual(self.events[:2], [('in', 'w'), ('out', 'w')])
+
+    def test_waiting_writer_blocks_new_readers(self):
+        hold = threading.Event()
+        _spawn(self._reader, 'r1', hold)
+        self.assertTrue(_wait_for(lambda: self.events == [('in', 'r1')]))
+        writer = _spawn(self._writer, 'w')
+        self.assertTrue(_wait_for(lambda: self.lock._writers_waiting == 1))
+        reader = _spawn(self._reader, 'r2', hold)
+        time.sleep(0.1)
+        # r2 queues behind the waiting writer
+        self.assertEqual(self.events, [('in', 'r1')])
+        hold.set()
+        writer.join(5)
+        reader.join(5)
+        self.assertEqual(self.events, [('in', 'r1'), ('out', 'r1'),
+                                       ('in', 'w'), ('out', 'w'),
+                                       ('in', 'r2'), ('out', 'r2')])
+
+    def test_writer_not_starved(self):
+        stop = threading.Event()
+        def read_forever():
+            while not stop.is_set():
+                with self.lock.read_lock():
+                    time.sleep(0.001)
+        readers = [_spawn(read_forever) for i in range(4)]
+        try:
+            writer = _spawn(self._writer, 'w')
+            writer.join(5)
+            self.assertEqual(self.events, [('in', 'w'), ('out', 'w')])
+        finally:
+            stop.set()
+            for reader in readers:
+                reader.join(5)
+
+
+if __name__ == '__main__':
+    unittest.main()
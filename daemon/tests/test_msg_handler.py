@@ -0,0 +1,214 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+#
+# Copyright 2013 Mellanox Technologies, Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import threading
+import time
+import unittest
+
+from common import codec
+import job_mngr
+import msg_handler
+from tests import test_eswitch_handler
+from tests import test_job_mngr
+from tests.test_eswitch_handler import FABRIC, MAC_1, MAC_2
+
+
+class SetVLANTest(unittest.TestCase):
+    def _validate(self, vlan):
+        msg = {'fabric':'fabric1', 'vnic_mac':'fa:16:3e:00:00:01',
+               'vlan':vlan}
+        return msg_handler.SetVLAN(msg).validate(), msg['vlan']
+
+    def test_valid_vlan(self):
+        self.assertEqual(self._validate(10), (True, 10))
+        self.assertEqual(self._validate('4095'), (True, 4095))
+        self.assertEqual(self._validate(0), (True, 0))
+
+    def test_invalid_vlan(self):
+        for vlan in ('x', None, -1, 4096):
+            self.assertFalse(self._validate(vlan)[0])
+
+    def test_missing_vlan(self):
+        msg = {'fabric':'fabric1', 'vnic_mac':'fa:16:3e:00:00:01'}
+        self.assertFalse(msg_handler.SetVLAN(msg).validate())
+
+
+class BatchTest(test_eswitch_handler.eSwitchHandlerTestCase):
+    def setUp(self):
+        super(BatchTest, self).setUp()
+        self.dispatcher = msg_handler.MessageDispatch(self.handler, None)
+
+    def _batch(self, msgs, stop_on_failure=False):
+        result = self.dispatcher.handle_msg({'action':'batch', 'msgs':msgs,
+                                             'stop_on_failure':stop_on_failure})
+        self.assertEqual(result['status'], 'OK')
+        return result['response']['results']
+
+    def _create_port(self, vnic_mac):
+        return {'action':'create_port', 'fabric':FABRIC, 'vnic_type':'direct',
+                'device_id':'vm1', 'vnic_mac':vnic_mac}
+
+    def _set_vlan(self, vnic_mac, vlan, fabric=FABRIC):
+        return {'action':'set_vlan', 'fabric':fabric, 'vnic_mac':vnic_mac,
+                'vlan':vlan}
+
+    def test_result_per_message(self):
+        results = self._batch([self._create_port(MAC_1),
+                               self._set_vlan(MAC_1, 10),
+                               {'action':'unknown'},
+                               {'action':'port_up', 'fabric':FABRIC,
+                                'ref_by':'mac_address', 'mac':MAC_1}])
+        self.assertEqual([(result['action'], result['status'])
+                          for result in results],
+                         [('create_port', 'OK'), ('set_vlan', 'OK'),
+                          ('unknown', 'FAIL'), ('port_up', 'OK')])
+        self.assertEqual(results[2]['reason'], 'unknown action')
+
+    def test_stop_on_failure(self):
+        results = self._batch([self._set_vlan(MAC_1, 10, fabric='fabric2'),
+                               self._create_port(MAC_1),
+                               self._set_vlan(MAC_1, 10)],
+                              stop_on_failure=True)
+        self.assertEqual([(result['action'], result['status'])
+                          for result in results],
+                         [('set_vlan', 'FAIL'), ('create_port', 'SKIPPED'),
+                          ('set_vlan', 'SKIPPED')])
+        self.assertIsNone(self.handler.eswitches[FABRIC].get_dev_for_vnic(MAC_1))
+
+    def test_set_vlans_grouped(self):
+        calls = []
+        set_vlans = self.handler.set_vlans
+        def _set_vlans(requests):
+            calls.append(list(requests))
+            return set_vlans(requests)
+        self.handler.set_vlans = _set_vlans
+        results = self._batch([self._create_port(MAC_1),
+                               self._create_port(MAC_2),
+                               self._set_vlan(MAC_1, 10),
+                               self._set_vlan(MAC_2, 20)])
+        self.assertEqual([result['status'] for result in results],
+                         ['OK'] * 4)
+        self.assertEqual(calls, [[(FABRIC, MAC_1, 10), (FABRIC, MAC_2, 20)]])
+        self.assertEqual([change[3] for change in self.link_backend.changes],
+                         [10, 20])
+
+
+if __name__ == '__main__':
+    unittest.main()
+
+
+class AsyncTest(test_eswitch_handler.eSwitchHandlerTestCase):
+    def setUp(self):
+        super(AsyncTest, self).setUp()
+        self.publisher = test_job_mngr.FakePublisher()
+        self.job_mngr = job_mngr.JobManager(workers=1)
+        self.job_mngr.start(self.publisher)
+        self.dispatcher = msg_handler.MessageDispatch(self.handler,
+                                                      self.job_mngr)
+        result = self.dispatcher.handle_msg({'action':'create_port',
+                                             'fabric':FABRIC,
+                                             'vnic_type':'direct',
+                                             'device_id':'vm1',
+                                             'vnic_mac':MAC_1})
+        self.assertEqual(result['status'], 'OK')
+
+    def test_set_vlan(self):
+        result = self.dispatcher.handle_msg({'action':'set_vlan',
+                                             'fabric':FABRIC,
+                                             'vnic_mac':MAC_1, 'vlan':10,
+                                             'async':True})
+        self.assertEqual(result['status'], 'OK')
+        job_id = result['response']['job_id']
+        self.assertTrue(self.publisher.published.wait(5))
+        result = self.dispatcher.handle_msg({'action':'get_job',
+                                             'job_id':job_id})
+        self.assertEqual(result['status'], 'OK')
+        self.assertEqual(result['response']['state'], job_mngr.DONE)
+        self.assertEqual(result['response']['result']['status'], 'OK')
+
+    def test_invalid_message(self):
+        result = self.dispatcher.handle_msg({'action':'set_vlan',
+                                             'fabric':FABRIC,
+                                             'vnic_mac':MAC_1, 'vlan':'x',
+                                             'async':True})
+        self.assertEqual(result['status'], 'FAIL')
+
+    def test_not_async_capable(self):
+        result = self.dispatcher.handle_msg({'action':'get_vnics',
+                                             'fabric':FABRIC, 'async':True})
+        self.assertEqual(result, {'action':'get_vnics', 'status':'FAIL',
+                                  'reason':'action cannot run asynchronously',
+                                  'ver':codec.PROTOCOL_VERSION})
+
+    def test_unknown_job(self):
+        result = self.dispatcher.handle_msg({'action':'get_job',
+                                             'job_id':'missing'})
+        self.assertEqual(result['status'], 'FAIL')
+
+
+class ResponseCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.dispatcher = msg_handler.MessageDispatch(None, None,
+                                                      cache_size=2)
+        self.calls = []
+        self.release = threading.Event()
+        self.dispatcher.execute_action = self._execute_action
+
+    def _execute_action(self, action, msg):
+        self.calls.append(msg['n'])
+        self.release.wait(5)
+        return {'action':action, 'status':'OK', 'response':msg['n']}
+
+    def _send(self, req_id, n):
+        return self.dispatcher.handle_msg({'action':'get_vnics',
+                                           'req_id':req_id, 'n':n})
+
+    def test_cached_reply(self):
+        self.release.set()
+        first = self._send('r1', 1)
+        second = self._send('r1', 2)
+        self.assertEqual(second, first)
+        self.assertEqual(second['req_id'], 'r1')
+        self.assertEqual(second['response'], 1)
+        self.assertEqual(self.calls, [1])
+
+    def test_concurrent_duplicates(self):
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(
+                                        self._send('r1', 1)))
+                   for i in range(3)]
+        for thread in threads:
+            thread.start()
+        while not self.calls:
+            time.sleep(0.01)
+        self.release.set()
+        for thread in threads:
+            thread.join(5)
+        self.assertEqual(self.calls, [1])
+        self.assertEqual(len(results), 3)
+        self.assertTrue(all(result == results[0] for result in results))
+
+    def test_lru_eviction(self):
+        self.release.set()
+        self._send('r1', 1)
+        self._send('r2', 2)
+        # r1 becomes the most recently used entry
+        self._send('r1', 1)
+        self._send('r3', 3)
+        self.assertEqual(list(self.dispatcher.responses), ['r1', 'r3'])
+        self.assertEqual(self._send('r2', 4)['response'], 4)
+        self.assertEqual(self.calls, [1, 2, 3, 4])
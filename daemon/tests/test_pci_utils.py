@@ -0,0 +1,66 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+#
+# Copyright 2013 Mellanox Technologies, Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import unittest
+
+from simulator import fake_sysfs
+from utils.pci_utils import pciUtils
+
+PF = 'simpf0'
+PCI_ID = '0000:03:00'
+
+
+class pciUtilsTest(unittest.TestCase):
+    def setUp(self):
+        self.sysfs = fake_sysfs.FakeSysfs()
+        self.addCleanup(self.sysfs.cleanup)
+        self.eths, self.hostdevs = self.sysfs.add_pf(PF, PCI_ID, vfs=2,
+                                                     hostdev_vfs=1)
+        self.pci_utils = pciUtils(self.sysfs.root)
+
+    def test_topology(self):
+        self.assertEqual(self.pci_utils.get_pf_pci(PF), PCI_ID)
+        self.assertEqual(self.pci_utils.get_pf_vfs(PF),
+                         {0:PCI_ID + '.1', 1:PCI_ID + '.2', 2:PCI_ID + '.3'})
+        self.assertEqual(self.pci_utils.get_pci_netdevs(PCI_ID + '.1'),
+                         [self.eths[0]])
+        self.assertEqual(self.pci_utils.get_pci_netdevs(PCI_ID + '.3'), [])
+        self.assertEqual(self.pci_utils.get_eth_port(self.eths[1]), 1)
+        self.assertEqual(self.pci_utils.get_vf_indexes(self.eths, 'direct'),
+                         {self.eths[0]:'1', self.eths[1]:'2'})
+        self.assertEqual(self.pci_utils.get_vf_indexes(self.hostdevs,
+                                                       'hostdev'),
+                         {PCI_ID + '.3':'3'})
+
+    def test_cached_until_invalidated(self):
+        self.assertEqual(len(self.pci_utils.get_pf_vfs(PF)), 3)
+        vf = self.sysfs.add_vf(PCI_ID, 3)
+        self.sysfs.add_netdev(vf, 'simpf0v3')
+        self.assertEqual(len(self.pci_utils.get_pf_vfs(PF)), 3)
+        self.assertIsNone(self.pci_utils.get_eth_vf('simpf0v3'))
+        self.pci_utils.invalidate()
+        self.assertEqual(self.pci_utils.get_pf_vfs(PF)[3], vf)
+        self.assertEqual(self.pci_utils.get_eth_vf('simpf0v3'), vf)
+
+    def test_unknown_devices(self):
+        self.assertEqual(self.pci_utils.get_pf_vfs('eth9'), {})
+        self.assertEqual(self.pci_utils.get_pci_netdevs('0000:09:00.1'), [])
+        self.assertIsNone(self.pci_utils.get_eth_port('eth9'))
+
+
+if __name__ == '__main__':
+    unittest.main()
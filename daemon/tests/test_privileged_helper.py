@@ -0,0 +1,112 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+#
+# Copyright 2013 Mellanox Technologies, Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import socket
+import unittest
+
+import privileged_helper
+from utils import helper_utils
+
+
+class IsAllowedTest(unittest.TestCase):
+    def test_allowed(self):
+        for cmd in (['ip', 'link', 'set', 'eth2', 'up'],
+                    ['ip', 'link', 'set', 'eth2', 'down'],
+                    ['ip', 'link', 'set', 'eth2', 'vf', '3', 'vlan', '10'],
+                    ['ip', 'link', 'set', 'eth2', 'vf', '3', 'vlan', '4095',
+                     'qos', '0']):
+            self.assertTrue(helper_utils.is_allowed(cmd), cmd)
+
+    def test_rejected(self):
+        for cmd in (['ip', 'link', 'set', 'eth2', 'up', 'mtu', '9000'],
+                    ['ip', 'link', 'set', 'eth2', 'address',
+                     'fa:16:3e:00:00:01'],
+                    ['ip', 'link', 'set', 'eth2', 'netns', '1'],
+                    ['ip', 'link', 'set', 'eth2', 'vf', '3', 'mac',
+                     'fa:16:3e:00:00:01'],
+                    ['ip', 'link', 'set', 'eth2', 'vf', '3', 'vlan', '4096'],
+                    ['ip', 'link', 'set', 'eth2', 'vf', '3', 'vlan', '10',
+                     'qos', '8'],
+                    ['ip', 'link', 'set', 'eth2', 'vf', '-1', 'vlan', '10'],
+                    ['ip', 'link', 'set', '-force', 'up'],
+                    ['ip', 'link', 'set', 'eth2\0', 'up'],
+                    ['ip', 'link', 'set', 'a_very_long_netdev', 'up'],
+                    ['ip', 'link', 'show'],
+                    ['ip', 'link', 'delete', 'eth2'],
+                    ['ip', 'netns', 'exec', 'ns', 'sh'],
+                    ['sh', '-c', 'ip link set eth2 up'],
+                    ['ip', 'link', 'set', 'eth2', 5],
+                    [], None, 'ip link set eth2 up'):
+            self.assertFalse(helper_utils.is_allowed(cmd), cmd)
+
+    def test_input_only_for_batch(self):
+        self.assertFalse(helper_utils.is_allowed(
+            ['ip', 'link', 'set', 'eth2', 'up'], 'link set eth2 down\n'))
+
+    def test_batch(self):
+        cmd = helper_utils.BATCH_COMMAND
+        self.assertTrue(helper_utils.is_allowed(
+            cmd, 'link set eth2 down\n'
+                 'link set eth0 vf 1 vlan 10 qos 0\n\n'
+                 'link set eth2 up\n'))
+        for process_input in (None, '', '\n',
+                              'link set eth2 up\nlink set eth2 mtu 9000\n',
+                              'link set eth2 up\nnetns exec ns sh\n',
+                              'link set eth2 up # comment\n',
+                              'link set "eth2" up\n',
+                              '-force link set eth2 up\n'):
+            self.assertFalse(helper_utils.is_allowed(cmd, process_input),
+                             process_input)
+
+
+class PrivilegedHelperTest(unittest.TestCase):
+    def setUp(self):
+        self.sock, helper_sock = socket.socketpair()
+        self.addCleanup(self.sock.close)
+        self.addCleanup(helper_sock.close)
+        self.helper = privileged_helper.PrivilegedHelper(helper_sock)
+
+    def test_not_allowed(self):
+        self.helper._handle({'id':1, 'cmd':['rm', '-rf', '/']})
+        response = helper_utils.recv_frame(self.sock)
+        self.assertEqual((response['id'], response['returncode']), (1, 126))
+
+    def test_undecodable_output(self):
+        response = self.helper._execute(['printf', '\\377ok'], None, 5)
+        self.assertEqual(response['returncode'], 0)
+        self.assertEqual(response['stdout'], u'\ufffdok')
+        self.helper._execute = lambda cmd, process_input, timeout: response
+        self.helper._handle({'id':2, 'cmd':['ip', 'link', 'set', 'eth2',
+                                            'up']})
+        self.assertEqual(helper_utils.recv_frame(self.sock)['stdout'],
+                         u'\ufffdok')
+
+    def test_failure_is_answered(self):
+        def _execute(cmd, process_input, timeout):
+            raise ValueError('boom')
+        self.helper._execute = _execute
+        self.helper._handle({'id':3, 'cmd':['ip', 'link', 'set', 'eth2',
+                                            'up']})
+        response = helper_utils.recv_frame(self.sock)
+        self.assertEqual((response['id'], response['returncode']), (3, 125))
+        self.helper._handle(['not', 'a', 'request'])
+        self.assertEqual(helper_utils.recv_frame(self.sock)['returncode'],
+                         126)
+
+
+if __name__ == '__main__':
+    unittest.main()
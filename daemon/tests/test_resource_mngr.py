@@ -0,0 +1,70 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+#
+# Copyright 2013 Mellanox Technologies, Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from tests import test_eswitch_handler
+from tests.test_eswitch_handler import FABRIC, MAC_1, MAC_2
+
+
+class LibvirtTest(test_eswitch_handler.eSwitchHandlerTestCase):
+    def setUp(self):
+        super(LibvirtTest, self).setUp()
+        self.parsed = []
+        get_domain_devices = self.rm._get_domain_devices
+        def parse(raw_xml):
+            self.parsed.append(raw_xml)
+            return get_domain_devices(raw_xml)
+        self.rm._get_domain_devices = parse
+        self.connects = []
+        def connect(uri):
+            self.connects.append(uri)
+            return self.conn(uri)
+        self.rm.libvirt_factory = connect
+
+    def test_cache_hit(self):
+        domain = self.conn.create_domain([(self.eths[0], MAC_1)])
+        expected = [(self.eths[0], MAC_1, FABRIC)]
+        self.assertEqual(self.rm.scan_attached_devices()['direct'], expected)
+        self.assertEqual(self.rm.scan_attached_devices()['direct'], expected)
+        self.assertEqual(self.rm.get_domain_devices(domain.uuid), expected)
+        self.assertEqual(len(self.parsed), 1)
+
+    def test_xml_changed(self):
+        domain = self.conn.create_domain([(self.eths[0], MAC_1)])
+        self.rm.scan_attached_devices()
+        domain.devices.append((self.eths[1], MAC_2))
+        self.assertEqual(self.rm.get_domain_devices(domain.uuid),
+                         [(self.eths[0], MAC_1, FABRIC),
+                          (self.eths[1], MAC_2, FABRIC)])
+        self.assertEqual(len(self.parsed), 2)
+
+    def test_stopped_domain_forgotten(self):
+        domain = self.conn.create_domain([(self.eths[0], MAC_1)])
+        self.rm.scan_attached_devices()
+        self.conn.destroy_domain(domain.domid)
+        self.assertEqual(self.rm.scan_attached_devices(),
+                         {'direct':[], 'domains':{}})
+        self.assertEqual(self.rm.domain_cache, {})
+
+    def test_reconnect(self):
+        self.conn.create_domain([(self.eths[0], MAC_1)])
+        self.rm.scan_attached_devices()
+        # the connection opened by setUp is reused while it is alive
+        self.assertEqual(self.connects, [])
+        self.conn.alive = False
+        self.assertEqual(len(self.rm.scan_attached_devices()['direct']), 1)
+        self.assertEqual(len(self.connects), 1)
+        self.assertTrue(self.conn.isAlive())
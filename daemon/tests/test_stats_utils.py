@@ -0,0 +1,84 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+#
+# Copyright 2013 Mellanox Technologies, Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import unittest
+
+from utils import stats_utils
+
+
+class HistogramTest(unittest.TestCase):
+    def test_buckets(self):
+        histogram = stats_utils.Histogram(buckets=(0.1, 1.0))
+        for value in (0.05, 0.1, 0.5, 2.0):
+            histogram.observe(value)
+        self.assertEqual(histogram.counts, [2, 1, 1])
+        self.assertEqual(histogram.snapshot(),
+                         {'buckets':[[0.1, 2], [1.0, 3], ['+Inf', 4]],
+                          'sum':2.65, 'count':4})
+
+    def test_empty(self):
+        snapshot = stats_utils.Histogram().snapshot()
+        self.assertEqual(len(snapshot['buckets']),
+                         len(stats_utils.LATENCY_BUCKETS) + 1)
+        self.assertTrue(all(count == 0
+                            for bound, count in snapshot['buckets']))
+
+
+class StatsCollectorTest(unittest.TestCase):
+    def setUp(self):
+        self.stats = stats_utils.StatsCollector()
+
+    def test_snapshot(self):
+        self.stats.record(stats_utils.ACTION, 'set_vlan', 0.002)
+        self.stats.record(stats_utils.ACTION, 'set_vlan', 0.2, failed=True)
+        self.stats.increment(stats_utils.ACTION, 'set_vlan', 'cached')
+        entry = self.stats.snapshot()[stats_utils.ACTION]['set_vlan']
+        self.assertEqual((entry['count'], entry['errors'], entry['cached']),
+                         (2, 1, 1))
+        self.assertEqual(entry['latency']['count'], 2)
+
+    def test_prometheus(self):
+        self.stats.record(stats_utils.COMMAND, 'ip link', 0.002)
+        self.stats.increment(stats_utils.COMMAND, 'ip link', 'timeouts')
+        lines = self.stats.to_prometheus().splitlines()
+        self.assertEqual(lines[0],
+                         '# TYPE mlnx_daemon_uptime_seconds gauge')
+        self.assertTrue(lines[1].startswith('mlnx_daemon_uptime_seconds '))
+        label = 'command="ip link"'
+        prefix = 'mlnx_daemon_command'
+        self.assertEqual(lines[2:5],
+                         ['%s_count_total{%s} 1' % (prefix, label),
+                          '%s_errors_total{%s} 0' % (prefix, label),
+                          '%s_timeouts_total{%s} 1' % (prefix, label)])
+        buckets = lines[5:-2]
+        self.assertEqual(len(buckets), len(stats_utils.LATENCY_BUCKETS) + 1)
+        self.assertEqual(buckets[0],
+                         '%s_latency_seconds_bucket{%s,le="0.001"} 0' %
+                         (prefix, label))
+        self.assertEqual(buckets[1],
+                         '%s_latency_seconds_bucket{%s,le="0.0025"} 1' %
+                         (prefix, label))
+        self.assertEqual(buckets[-1],
+                         '%s_latency_seconds_bucket{%s,le="+Inf"} 1' %
+                         (prefix, label))
+        self.assertEqual(lines[-2:],
+                         ['%s_latency_seconds_sum{%s} 0.002000' %
+                          (prefix, label),
+                          '%s_latency_seconds_count{%s} 1' % (prefix, label)])
+
+    def test_prometheus_empty(self):
+        self.assertEqual(len(self.stats.to_prometheus().splitlines()), 2)
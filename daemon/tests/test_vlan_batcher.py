@@ -0,0 +1,119 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+#
+# Copyright 2013 Mellanox Technologies, Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import threading
+import time
+import unittest
+
+from vlan_batcher import VlanBatcher
+
+PF = 'eth0'
+
+
+class FakeLinkBackend(object):
+    def __init__(self, vf_vlans=None, fail=()):
+        self.vf_vlans = vf_vlans or {}
+        self.fail = set(fail)
+        self.calls = []
+
+    def get_vf_vlans(self, pf):
+        return dict(self.vf_vlans)
+
+    def set_vf_vlans(self, pf, changes):
+        self.calls.append((pf, list(changes)))
+        return [change[0] not in self.fail for change in changes]
+
+
+class VlanBatcherTest(unittest.TestCase):
+    def setUp(self):
+        self.backend = FakeLinkBackend()
+        self.batcher = VlanBatcher(self.backend)
+
+    def test_set_vf_vlans(self):
+        results = self.batcher.set_vf_vlans(PF, [('1', 'eth1', 10, 0, True),
+                                                 ('2', 'eth2', 20, 0, True)])
+        self.assertEqual(results, [True, True])
+        self.assertEqual(len(self.backend.calls), 1)
+
+    def test_unchanged_vlan_skipped(self):
+        self.backend.vf_vlans = {'1':(10, 0)}
+        self.batcher.load_pf(PF)
+        self.assertEqual(self.batcher.set_vf_vlans(PF, [('1', 'eth1', 10, 0,
+                                                          True)]), [True])
+        self.assertEqual(self.backend.calls, [])
+
+    def test_failed_change_forgotten(self):
+        self.backend.fail = set(['1'])
+        self.assertEqual(self.batcher.set_vf_vlans(PF, [('1', 'eth1', 10, 0,
+                                                          True)]), [False])
+        self.backend.fail = set()
+        self.assertEqual(self.batcher.set_vf_vlans(PF, [('1', 'eth1', 10, 0,
+                                                          True)]), [True])
+        self.assertEqual(len(self.backend.calls), 2)
+
+    def test_submission_order_wins(self):
+        first = self.batcher.submit(PF, [('1', 'eth1', 10, 0, True)])
+        second = self.batcher.submit(PF, [('1', 'eth1', 20, 0, True)])
+        self.assertTrue(first['leader'])
+        self.assertFalse(second['leader'])
+        waiter = threading.Thread(target=self.batcher.wait, args=([second],))
+        waiter.start()
+        self.assertEqual(self.batcher.wait([first]), [[True]])
+        waiter.join()
+        self.assertEqual(self.backend.calls,
+                         [(PF, [('1', 'eth1', 20, 0, True)])])
+
+    def test_single_window_for_all_pfs(self):
+        self.batcher.window = 0.2
+        tickets = [self.batcher.submit('eth%d' % index,
+                                       [('1', 'eth1', 10, 0, True)])
+                   for index in range(3)]
+        start = time.time()
+        self.assertEqual(self.batcher.wait(tickets), [[True]] * 3)
+        self.assertTrue(time.time() - start < 0.4)
+        self.assertEqual(len(self.backend.calls), 3)
+
+    def test_sync_before_apply(self):
+        synced = []
+        self.batcher.sync = lambda: synced.append(len(self.backend.calls))
+        self.batcher.set_vf_vlans(PF, [('1', 'eth1', 10, 0, True)])
+        self.assertEqual(synced, [0])
+
+
+    def test_invalid_vlan(self):
+        results = self.batcher.set_vf_vlans(PF, [('1', 'eth1', 'x', 0, True),
+                                                 ('2', 'eth2', 20, 0, True)])
+        self.assertEqual(results, [False, True])
+        self.assertEqual(self.backend.calls,
+                         [(PF, [('2', 'eth2', 20, 0, True)])])
+
+    def test_failed_batch_releases_waiters(self):
+        def sync():
+            raise RuntimeError('sync failed')
+        self.batcher.sync = sync
+        first = self.batcher.submit(PF, [('1', 'eth1', 10, 0, True)])
+        second = self.batcher.submit(PF, [('2', 'eth2', 20, 0, True)])
+        waiter = threading.Thread(target=self.batcher.wait, args=([second],))
+        waiter.start()
+        self.assertEqual(self.batcher.wait([first]), [[False]])
+        waiter.join(5)
+        self.assertFalse(waiter.is_alive())
+        self.assertEqual(self.batcher.wait([second]), [[False]])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -15,38 +15,285 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import itertools
 import os
 import shlex
+import socket
 import subprocess
+import sys
+import threading
+import time
 
 from nova.openstack.common import log as logging
+import helper_utils
+import stats_utils
 
 LOG = logging.getLogger('mlnx_daemon')
 
+HELPER_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                           'privileged_helper.py')
 
-def execute(cmd, root_helper=None, process_input=None, addl_env=None,
-            check_exit_code=True, return_stderr=False):
-    if root_helper:
-        cmd = shlex.split(root_helper) + cmd
-    cmd = map(str, cmd)
-    LOG.debug("Running command: " + " ".join(cmd))
-    env = os.environ.copy()
+
+# reply grace period of the helper after the command timeout, seconds
+HELPER_GRACE = 5
+
+
+class HelperError(Exception):
+    pass
+
+
+class CommandTimeout(RuntimeError):
+    pass
+
+
+class CommandLimits(object):
+    """
+    Bounds commands running at once, in total and per key (the PF a
+    command configures), and their run time.
+    """
+    def __init__(self, timeout=0, retries=0, concurrency=0, key_concurrency=0):
+        """
+        @param timeout: seconds a command may run before it is killed, 0 for no limit
+        @param retries: times a timed out command is run again
+        @param concurrency, key_concurrency: commands running at once, 0 for no limit
+        """
+        self.timeout = timeout
+        self.retries = retries
+        self.key_concurrency = key_concurrency
+        self.slots = concurrency and threading.BoundedSemaphore(concurrency)
+        self.key_slots = {}
+        self.lock = threading.Lock()
+
+    def _get_slots(self, key):
+        if key is None or not self.key_concurrency:
+            return None
+        with self.lock:
+            slots = self.key_slots.get(key)
+            if slots is None:
+                slots = threading.BoundedSemaphore(self.key_concurrency)
+                self.key_slots[key] = slots
+            return slots
+
+    def acquire(self, key=None):
+        """
+        @return: slots to pass to release
+        @note: the key slot is taken before the global one so that
+               commands of a busy PF do not hold global slots
+        """
+        acquired = [slots for slots in (self._get_slots(key), self.slots)
+                    if slots]
+        for slots in acquired:
+            slots.acquire()
+        return acquired
+
+    def release(self, acquired):
+        for slots in reversed(acquired):
+            slots.release()
+
+
+LIMITS = CommandLimits()
+
+
+def configure(timeout, retries, concurrency, key_concurrency):
+    global LIMITS
+    LIMITS = CommandLimits(timeout, retries, concurrency, key_concurrency)
+
+
+class HelperClient(object):
+    """
+    Runs commands through the privileged helper process, started once
+    with root_helper. Commands may be executed concurrently, responses
+    are matched to requests by id.
+    """
+    def __init__(self, root_helper):
+        self.sock, helper_sock = socket.socketpair()
+        try:
+            self.process = subprocess.Popen(shlex.split(root_helper) +
+                                            [sys.executable, HELPER_PATH],
+                                            stdin=helper_sock,
+                                            stdout=helper_sock,
+                                            close_fds=True)
+        finally:
+            helper_sock.close()
+        self.ids = itertools.count()
+        self.lock = threading.Lock()
+        self.pending = {}
+        self.alive = True
+        reader = threading.Thread(target=self._read_loop, name='helper-reader')
+        reader.daemon = True
+        reader.start()
+        LOG.info("Privileged helper started (pid %d)", self.process.pid)
+
+    def execute(self, cmd, process_input=None, timeout=0):
+        """
+        @param timeout: seconds the helper lets the command run
+        @return: (returncode, stdout, stderr)
+        @raise HelperError: if the helper is gone
+        @raise CommandTimeout: if the command timed out
+        """
+        waiter = {'event':threading.Event(), 'response':None}
+        with self.lock:
+            if not self.alive:
+                raise HelperError("privileged helper is not running")
+            request_id = self.ids.next()
+            self.pending[request_id] = waiter
+            try:
+                helper_utils.send_frame(self.sock, {'id':request_id,
+                                                    'cmd':cmd,
+                                                    'input':process_input,
+                                                    'timeout':timeout})
+            except socket.error, e:
+                del self.pending[request_id]
+                raise HelperError("privileged helper failed: %s" % e)
+        if not waiter['event'].wait(timeout and timeout + HELPER_GRACE or None):
+            with self.lock:
+                self.pending.pop(request_id, None)
+            raise CommandTimeout("privileged helper did not reply in %d seconds"
+                                 % (timeout + HELPER_GRACE))
+        response = waiter['response']
+        if response is None:
+            raise HelperError("privileged helper exited")
+        if response.get('timed_out'):
+            raise CommandTimeout("command timed out after %d seconds" % timeout)
+        return (response['returncode'], response['stdout'].encode('utf-8'),
+                response['stderr'].encode('utf-8'))
+
+    def _read_loop(self):
+        try:
+            while True:
+                response = helper_utils.recv_frame(self.sock)
+                with self.lock:
+                    waiter = self.pending.pop(response['id'], None)
+                if waiter:
+                    waiter['response'] = response
+                    waiter['event'].set()
+        except (EOFError, ValueError, socket.error), e:
+            LOG.error("Privileged helper connection lost: %s", e)
+        with self.lock:
+            self.alive = False
+            pending, self.pending = self.pending, {}
+        for waiter in pending.itervalues():
+            waiter['event'].set()
+
+
+_helper = None
+
+
+def start_helper(root_helper='sudo'):
+    """
+    @note: commands run with a root_helper go through the helper from now on
+    """
+    global _helper
+    _helper = HelperClient(root_helper)
+
+
+def _execute_by_helper(cmd, process_input, timeout):
+    """
+    @return: (returncode, stdout, stderr), None if the helper cannot be used
+    """
+    if not _helper:
+        return None
+    try:
+        return _helper.execute(cmd, process_input, timeout)
+    except HelperError, e:
+        LOG.warning("%s - running command directly", e)
+        return None
+
+
+def _execute_directly(cmd, process_input, addl_env, timeout):
+    """
+    @return: (returncode, stdout, stderr)
+    @raise CommandTimeout: if the command timed out, it is killed
+    """
+    env = None
     if addl_env:
+        env = os.environ.copy()
         env.update(addl_env)
     obj = subprocess.Popen(cmd, shell=False, stdin=subprocess.PIPE,
                            stdout=subprocess.PIPE, stderr=subprocess.PIPE,
                            env=env)
-
-    _stdout, _stderr = (process_input and
-                        obj.communicate(process_input) or
-                        obj.communicate())
+    timed_out = []
+    timer = None
+    if timeout:
+        timer = threading.Timer(timeout, _kill, (obj, timed_out))
+        timer.start()
+    try:
+        _stdout, _stderr = (process_input and
+                            obj.communicate(process_input) or
+                            obj.communicate())
+    finally:
+        if timer:
+            timer.cancel()
     obj.stdin.close()
+    if timed_out:
+        raise CommandTimeout("command timed out after %d seconds" % timeout)
+    return (obj.returncode, _stdout, _stderr)
+
+
+def _kill(obj, timed_out):
+    timed_out.append(True)
+    try:
+        obj.kill()
+    except OSError:
+        # already exited
+        pass
+
+
+def _execute_once(cmd, root_helper, process_input, addl_env, timeout):
+    result = None
+    if root_helper and not addl_env:
+        LOG.debug("Running command by helper: " + " ".join(cmd))
+        result = _execute_by_helper(cmd, process_input, timeout)
+    if result is None:
+        if root_helper:
+            cmd = shlex.split(root_helper) + cmd
+        LOG.debug("Running command: " + " ".join(cmd))
+        result = _execute_directly(cmd, process_input, addl_env, timeout)
+    return result
+
+
+def execute(cmd, root_helper=None, process_input=None, addl_env=None,
+            check_exit_code=True, return_stderr=False, limit_key=None):
+    """
+    @param limit_key: commands of the same key (PF) are limited together
+    @raise CommandTimeout: if all attempts timed out
+    @note: commands are killed after LIMITS.timeout and run again up to
+           LIMITS.retries times
+    """
+    # commands are accounted by program and sub command, e.g. 'ip link'
+    cmd_name = " ".join(map(str, cmd[:2]))
+    cmd = map(str, cmd)
+    limits = LIMITS
+    start = time.time()
+    acquired = limits.acquire(limit_key)
+    stats_utils.STATS.record(stats_utils.QUEUE, cmd_name, time.time() - start)
+    start = time.time()
+    try:
+        for attempt in range(limits.retries + 1):
+            if attempt:
+                stats_utils.STATS.increment(stats_utils.COMMAND, cmd_name,
+                                            'retries')
+            try:
+                result = _execute_once(cmd, root_helper, process_input,
+                                       addl_env, limits.timeout)
+                break
+            except CommandTimeout, e:
+                LOG.warning("Command %s: %s", " ".join(cmd), e)
+                stats_utils.STATS.increment(stats_utils.COMMAND, cmd_name,
+                                            'timeouts')
+        else:
+            stats_utils.STATS.record(stats_utils.COMMAND, cmd_name,
+                                     time.time() - start, failed=True)
+            raise CommandTimeout("\nCommand: %s\nTimed out %d times" %
+                                 (cmd, limits.retries + 1))
+    finally:
+        limits.release(acquired)
+    returncode, _stdout, _stderr = result
+    stats_utils.STATS.record(stats_utils.COMMAND, cmd_name,
+                             time.time() - start, failed=bool(returncode))
     m = ("\nCommand: %s\nExit code: %s\nStdout: %r\nStderr: %r" %
-        (cmd, obj.returncode, _stdout, _stderr))
-    print m
+        (cmd, returncode, _stdout, _stderr))
     LOG.debug(m)
-    if obj.returncode and check_exit_code:
+    if returncode and check_exit_code:
         raise RuntimeError(m)
     return return_stderr and (_stdout, _stderr) or _stdout
-
-
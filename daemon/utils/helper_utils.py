@@ -0,0 +1,121 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+#
+# Copyright 2013 Mellanox Technologies, Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Protocol of the privileged helper.
+
+Requests and responses are JSON objects, each sent as a 4 byte big
+endian length followed by the JSON data:
+    request:  {'id', 'cmd': [...], 'input': str or None, 'timeout'}
+    response: {'id', 'returncode', 'stdout', 'stderr', 'timed_out'}
+A command running longer than its timeout seconds, if not 0, is killed.
+Only commands matching one of ALLOWED_COMMANDS argument by argument are
+run. 'ip -batch -' input may only hold commands allowed as
+'ip <command>', one per line.
+"""
+
+import json
+import re
+import socket
+import struct
+
+FRAME_HDR = struct.Struct('!I')
+MAX_FRAME = 16 * 1024 * 1024
+
+# netdev names, up to IFNAMSIZ - 1 characters and never an option
+NETDEV = re.compile(r'^\w[\w.:-]{0,14}$')
+NUMBER = re.compile(r'^\d{1,4}$')
+MAX_VF = 1023
+MAX_VLAN = 4095
+MAX_QOS = 7
+
+
+def _netdev(arg):
+    return bool(NETDEV.match(arg))
+
+
+def _number(limit):
+    return lambda arg: bool(NUMBER.match(arg)) and int(arg) <= limit
+
+
+# each argument is matched by a string, a tuple of strings or a check
+ALLOWED_COMMANDS = [
+    ['ip', 'link', 'set', _netdev, ('up', 'down')],
+    ['ip', 'link', 'set', _netdev, 'vf', _number(MAX_VF),
+     'vlan', _number(MAX_VLAN)],
+    ['ip', 'link', 'set', _netdev, 'vf', _number(MAX_VF),
+     'vlan', _number(MAX_VLAN), 'qos', _number(MAX_QOS)]]
+BATCH_COMMAND = ['ip', '-batch', '-']
+
+SAFE_PATH = '/sbin:/bin:/usr/sbin:/usr/bin'
+
+
+def _matches_arg(pattern, arg):
+    if callable(pattern):
+        return pattern(arg)
+    if isinstance(pattern, tuple):
+        return arg in pattern
+    return arg == pattern
+
+
+def _matches(cmd):
+    for pattern in ALLOWED_COMMANDS:
+        if len(cmd) == len(pattern) and all(_matches_arg(pattern_arg, arg)
+                                            for pattern_arg, arg
+                                            in zip(pattern, cmd)):
+            return True
+    return False
+
+
+def is_allowed(cmd, process_input=None):
+    if not isinstance(cmd, list) or not cmd:
+        return False
+    if not all(isinstance(arg, basestring) for arg in cmd):
+        return False
+    if cmd == BATCH_COMMAND:
+        if not isinstance(process_input, basestring):
+            return False
+        lines = [line for line in process_input.splitlines() if line.strip()]
+        return bool(lines) and all(_matches(['ip'] + line.split())
+                                   for line in lines)
+    return not process_input and _matches(cmd)
+
+
+def send_frame(sock, msg):
+    data = json.dumps(msg)
+    sock.sendall(FRAME_HDR.pack(len(data)) + data)
+
+
+def _recv_exact(sock, size):
+    chunks = []
+    while size:
+        chunk = sock.recv(size)
+        if not chunk:
+            raise EOFError("helper connection closed")
+        chunks.append(chunk)
+        size -= len(chunk)
+    return ''.join(chunks)
+
+
+def recv_frame(sock):
+    """
+    @raise EOFError: when the peer closed the connection
+    """
+    size = FRAME_HDR.unpack(_recv_exact(sock, FRAME_HDR.size))[0]
+    if size > MAX_FRAME:
+        raise ValueError("frame of %d bytes exceeds limit" % size)
+    return json.loads(_recv_exact(sock, size))
@@ -0,0 +1,325 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+#
+# Copyright 2013 Mellanox Technologies, Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Backends configuring VF VLAN/QoS and netdev link state.
+
+'netlink' talks rtnetlink directly: the link down, VF VLAN and link up
+requests are sent in a single datagram and acknowledged together,
+without creating any process. It needs CAP_NET_ADMIN; on any netlink
+failure the request is retried with the 'ip' backend, which runs
+'sudo ip link' commands.
+"""
+
+import errno
+import os
+import re
+import socket
+import struct
+import threading
+import time
+
+from nova.openstack.common import log as logging
+from utils.command_utils import execute
+from utils import stats_utils
+
+LOG = logging.getLogger('mlnx_daemon')
+
+NETLINK_ROUTE = 0
+
+NLMSG_ERROR = 2
+RTM_SETLINK = 19
+
+NLM_F_REQUEST = 1
+NLM_F_ACK = 4
+
+IFLA_VFINFO_LIST = 22
+IFLA_VF_INFO = 1
+IFLA_VF_VLAN = 2
+
+IFF_UP = 1
+
+VF_LINE = re.compile(r'^\s*vf (\d+)\b(.*)$', re.MULTILINE)
+VF_VLAN = re.compile(r'\bvlan (\d+)')
+VF_QOS = re.compile(r'\bqos (\d+)')
+
+NLMSG_HDR = struct.Struct('=LHHLL')
+IFINFOMSG = struct.Struct('=BxHiII')
+RTATTR_HDR = struct.Struct('=HH')
+IFLA_VF_VLAN_STRUCT = struct.Struct('=III')
+NLMSG_ERR = struct.Struct('=i')
+
+
+def _align(length):
+    return (length + 3) & ~3
+
+
+def pack_attr(attr_type, payload):
+    length = RTATTR_HDR.size + len(payload)
+    return (RTATTR_HDR.pack(length, attr_type) + payload +
+            '\0' * (_align(length) - length))
+
+
+def pack_msg(msg_type, seq, payload, flags=NLM_F_REQUEST | NLM_F_ACK):
+    return NLMSG_HDR.pack(NLMSG_HDR.size + len(payload), msg_type, flags,
+                          seq, 0) + payload
+
+
+def parse_msgs(data):
+    """
+    @return: [(type, seq, payload)...] of a netlink datagram
+    """
+    msgs = []
+    offset = 0
+    while offset + NLMSG_HDR.size <= len(data):
+        length, msg_type, flags, seq, pid = NLMSG_HDR.unpack_from(data, offset)
+        if length < NLMSG_HDR.size:
+            break
+        msgs.append((msg_type, seq, data[offset + NLMSG_HDR.size:offset + length]))
+        offset += _align(length)
+    return msgs
+
+
+class IpLinkBackend(object):
+    name = 'ip'
+
+    def __init__(self, root_helper='sudo'):
+        self.root_helper = root_helper
+
+    def _vf_vlan_cmds(self, pf, vf_index, dev, vlan, qos, bounce):
+        cmds = []
+        if bounce:
+            cmds.append(['link', 'set', dev, 'down'])
+        cmds.append(['link','set',pf, 'vf', vf_index , 'vlan', vlan, 'qos', qos])
+        if bounce:
+            cmds.append(['link', 'set', dev, 'up'])
+        return cmds
+
+    def set_vf_vlan(self, pf, vf_index, dev, vlan, qos=0, bounce=True):
+        """
+        @param bounce: set dev down while changing the VLAN
+        @raise RuntimeError: on failure
+        """
+        for cmd in self._vf_vlan_cmds(pf, vf_index, dev, vlan, qos, bounce):
+            execute(['ip'] + cmd, root_helper=self.root_helper,
+                    limit_key=pf)
+
+    def get_vf_vlans(self, pf):
+        """
+        @return: {VF index: (vlan, qos)} as configured on the PF
+        @raise RuntimeError: on failure
+        """
+        vf_vlans = {}
+        output = execute(['ip', 'link', 'show', 'dev', pf], limit_key=pf)
+        for vf_index, attrs in VF_LINE.findall(output):
+            vlan = VF_VLAN.search(attrs)
+            qos = VF_QOS.search(attrs)
+            vf_vlans[vf_index] = (int(vlan.group(1)) if vlan else 0,
+                                  int(qos.group(1)) if qos else 0)
+        return vf_vlans
+
+    def set_vf_vlans(self, pf, changes):
+        """
+        @param changes: [(vf_index, dev, vlan, qos, bounce)...]
+        @return: [succeeded...] per change
+        @note: all changes are applied by a single 'ip -batch' process,
+               if it fails they are applied one by one to find out which
+        """
+        if len(changes) > 1:
+            lines = []
+            for vf_index, dev, vlan, qos, bounce in changes:
+                lines.extend(' '.join(map(str, cmd)) for cmd in
+                             self._vf_vlan_cmds(pf, vf_index, dev, vlan, qos,
+                                                bounce))
+            try:
+                execute(['ip', '-batch', '-'], root_helper=self.root_helper,
+                        process_input='\n'.join(lines) + '\n', limit_key=pf)
+                return [True] * len(changes)
+            except RuntimeError:
+                LOG.warning("VLAN batch on %s failed, applying one by one", pf)
+        results = []
+        for change in changes:
+            try:
+                self.set_vf_vlan(pf, *change)
+                results.append(True)
+            except RuntimeError:
+                results.append(False)
+        return results
+
+
+class NetlinkBackend(object):
+    name = 'netlink'
+
+    def __init__(self, sysfs_root='/sys', socket_factory=None, fallback=None,
+                 timeout=10):
+        """
+        @param socket_factory: callable() returning a connected netlink
+                               socket, a NETLINK_ROUTE socket by default
+        @param fallback: backend used when netlink fails
+        @param timeout: seconds to wait for the acknowledgements, 0 for
+                        no limit
+        """
+        self.sysfs_root = sysfs_root
+        self.socket_factory = socket_factory or self._open_socket
+        self.fallback = fallback
+        self.timeout = timeout
+        self.sock = None
+        self.disabled = False
+        self.seq = int(time.time())
+        self.lock = threading.Lock()
+
+    def _open_socket(self):
+        sock = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, NETLINK_ROUTE)
+        sock.bind((0, 0))
+        return sock
+
+    def _get_ifindex(self, dev):
+        path = os.path.join(self.sysfs_root, 'class', 'net', dev, 'ifindex')
+        try:
+            with open(path) as f:
+                return int(f.read())
+        except (IOError, ValueError):
+            raise RuntimeError("No ifindex for device %s" % dev)
+
+    def _link_msg(self, ifindex, attrs='', flags=0, change=0):
+        return IFINFOMSG.pack(socket.AF_UNSPEC, 0, ifindex, flags, change) + attrs
+
+    def _vf_vlan_attrs(self, vf_index, vlan, qos):
+        vf_vlan = pack_attr(IFLA_VF_VLAN,
+                            IFLA_VF_VLAN_STRUCT.pack(vf_index, vlan, qos))
+        return pack_attr(IFLA_VFINFO_LIST, pack_attr(IFLA_VF_INFO, vf_vlan))
+
+    def get_vf_vlans(self, pf):
+        """
+        @note: VF state is read through the fallback backend
+        """
+        if not self.fallback:
+            raise RuntimeError("Cannot read VF state of %s" % pf)
+        return self.fallback.get_vf_vlans(pf)
+
+    def set_vf_vlan(self, pf, vf_index, dev, vlan, qos=0, bounce=True):
+        """
+        @raise RuntimeError: on failure
+        """
+        if not self.set_vf_vlans(pf, [(vf_index, dev, vlan, qos, bounce)])[0]:
+            raise RuntimeError("Failed to set VLAN %s on VF %s of %s" %
+                               (vlan, vf_index, pf))
+
+    def set_vf_vlans(self, pf, changes):
+        """
+        @param changes: [(vf_index, dev, vlan, qos, bounce)...]
+        @return: [succeeded...] per change
+        @note: the devices are set down, the VFs configured and the devices
+               set up again, all in one datagram
+        """
+        if self.disabled:
+            return self.fallback.set_vf_vlans(pf, changes)
+        try:
+            pf_index = self._get_ifindex(pf)
+            # (change index, payload) of the down, VLAN and up messages
+            downs, vlans, ups = [], [], []
+            for index, (vf_index, dev, vlan, qos, bounce) in enumerate(changes):
+                vlans.append((index,
+                              self._link_msg(pf_index,
+                                             self._vf_vlan_attrs(int(vf_index),
+                                                                 int(vlan),
+                                                                 int(qos)))))
+                if bounce:
+                    dev_index = self._get_ifindex(dev)
+                    downs.append((index, self._link_msg(dev_index,
+                                                        change=IFF_UP)))
+                    ups.append((index, self._link_msg(dev_index, flags=IFF_UP,
+                                                      change=IFF_UP)))
+            msgs = downs + vlans + ups
+            errors = self._request([payload for index, payload in msgs])
+        except (RuntimeError, socket.error, OSError), e:
+            if not self.fallback:
+                raise RuntimeError("netlink request failed: %s" % e)
+            LOG.warning("netlink request failed, falling back to %s: %s",
+                        self.fallback.name, e)
+            if getattr(e, 'errno', None) in (errno.EPERM, errno.EACCES):
+                LOG.warning("No permission for netlink, using %s from now on",
+                            self.fallback.name)
+                self.disabled = True
+            return self.fallback.set_vf_vlans(pf, changes)
+        failures = [[] for change in changes]
+        for (index, payload), error in zip(msgs, errors):
+            if error:
+                failures[index].append(error)
+        for change_failures in failures:
+            if change_failures:
+                LOG.error("netlink request on %s failed: %s", pf,
+                          os.strerror(change_failures[0]))
+        return [not change_failures for change_failures in failures]
+
+    def _request(self, payloads):
+        """
+        @return: errno per payload, 0 on success
+        @note: all messages go in one datagram, each one is acknowledged
+               and matched to its payload by sequence number
+        @raise socket.timeout: if not all acknowledgements arrived in time
+        """
+        start = time.time()
+        failed = True
+        try:
+            with self.lock:
+                if self.sock is None:
+                    self.sock = self.socket_factory()
+                pending = {}
+                data = ''
+                for index, payload in enumerate(payloads):
+                    self.seq = (self.seq + 1) & 0xffffffff
+                    pending[self.seq] = index
+                    data += pack_msg(RTM_SETLINK, self.seq, payload)
+                errors = [0] * len(payloads)
+                try:
+                    self.sock.send(data)
+                    deadline = time.time() + self.timeout
+                    while pending:
+                        if self.timeout:
+                            remaining = deadline - time.time()
+                            if remaining <= 0:
+                                raise socket.timeout("netlink acknowledgement timed out")
+                            self.sock.settimeout(remaining)
+                        for msg_type, seq, payload in parse_msgs(self.sock.recv(65536)):
+                            if msg_type != NLMSG_ERROR or seq not in pending:
+                                continue
+                            errors[pending.pop(seq)] = -NLMSG_ERR.unpack_from(payload)[0]
+                except socket.error:
+                    # drop the socket, a new one is opened on next request
+                    self.sock.close()
+                    self.sock = None
+                    raise
+            failed = any(errors)
+            if errors and errors[0] in (errno.EPERM, errno.EACCES):
+                raise OSError(errors[0], os.strerror(errors[0]))
+            return errors
+        finally:
+            stats_utils.STATS.record(stats_utils.COMMAND, 'netlink setlink',
+                                     time.time() - start, failed=failed)
+
+
+BACKENDS = ('netlink', 'ip')
+
+
+def get_backend(name, sysfs_root='/sys', root_helper='sudo', timeout=10):
+    ip_backend = IpLinkBackend(root_helper)
+    if name == 'netlink':
+        return NetlinkBackend(sysfs_root, fallback=ip_backend, timeout=timeout)
+    if name != 'ip':
+        LOG.error("Unknown link backend %s, using ip", name)
+    return ip_backend
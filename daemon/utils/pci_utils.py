@@ -15,38 +15,86 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import glob
 import os
+import threading
 from nova.openstack.common import log as logging
 
 LOG = logging.getLogger('mlnx_daemon')
 
 class pciUtils:
-    pci_path =      "/sys/bus/pci/devices/"
-    VF_PF_NETDEV =  "/sys/bus/pci/devices/VF/physfn/net"
-    ETH_PF_NETDEV = "/sys/class/net/DEV/device/physfn/net"
-    ETH_VF =        "/sys/class/net/ETH/device"
-    ETH_PORT =      "/sys/class/net/ETH/dev_id"
-    
-    def __init__(self):
-        pass
+    """
+    Lookups of the PCI/netdev topology.
+    The topology is read from sysfs in one pass on first use and kept in
+    memory until invalidate() is called, e.g. on device hotplug.
+    """
+    PCI_DEVICES =   "bus/pci/devices"
+    NET_DEVICES =   "class/net"
+
+    def __init__(self, sysfs_root='/sys'):
+        self.sysfs_root = sysfs_root
+        self.topology = None
+        self.lock = threading.Lock()
+
+    def invalidate(self):
+        self.topology = None
+
+    def _get_topology(self):
+        topology = self.topology
+        if topology is None:
+            with self.lock:
+                if self.topology is None:
+                    self.topology = self._build_topology()
+                topology = self.topology
+        return topology
+
+    def _build_topology(self):
+        """
+        @return: {'netdevs': {netdev: {'pci', 'port'}},
+                  'pcis': {pci: [netdev...]},
+                  'pfs': {PF pci: {VF index: VF pci}}}
+        """
+        netdevs = {}
+        pcis = {}
+        pfs = {}
+        net_path = os.path.join(self.sysfs_root, pciUtils.NET_DEVICES)
+        for netdev_path in glob.glob(os.path.join(net_path, '*')):
+            netdev = os.path.basename(netdev_path)
+            try:
+                pci = os.path.basename(os.readlink(netdev_path + '/device'))
+            except OSError:
+                # virtual netdev
+                continue
+            try:
+                with open(netdev_path + '/dev_id') as f:
+                    port = int(f.read(),0) + 1
+            except (IOError, ValueError):
+                port = None
+            netdevs[netdev] = {'pci':pci, 'port':port}
+            pcis.setdefault(pci, []).append(netdev)
+        pci_path = os.path.join(self.sysfs_root, pciUtils.PCI_DEVICES)
+        for virtfn_path in glob.glob(os.path.join(pci_path, '*', 'virtfn*')):
+            pf_pci = os.path.basename(os.path.dirname(virtfn_path))
+            vf_index = int(os.path.basename(virtfn_path)[len('virtfn'):])
+            vf_pci = os.path.basename(os.readlink(virtfn_path))
+            pfs.setdefault(pf_pci, {})[vf_index] = vf_pci
+        LOG.debug("Topology: %d netdevs, %d PFs", len(netdevs), len(pfs))
+        return {'netdevs':netdevs, 'pcis':pcis, 'pfs':pfs}
        
     def get_eth_vf(self, dev):
         """
         @param dev: Ethetnet device
         @return: VF of Ethernet device
         """
-        vf_path = pciUtils.ETH_VF.replace("ETH", dev)
-        try:
-            device = os.readlink(vf_path)
-            vf = device.split('/')[3]
-            return vf
-        except:
-            return None 
+        netdev = self._get_topology()['netdevs'].get(dev)
+        if netdev:
+            return netdev['pci']
+        return None
     
     def get_pf_pci(self, pf):
         vf = self.get_eth_vf(pf)
         if vf:
-            return vf[:-2]
+            return vf.rpartition('.')[0]
         else:
             return None
         
@@ -70,13 +118,29 @@ class pciUtils:
                 return None
         else:
             return None
+
+    def get_vf_indexes(self, devs, dev_type):
+        """
+        @return: {dev: VF index} of devs of the same type
+        """
+        return dict((dev, self.get_vf_index(dev, dev_type)) for dev in devs)
         
     def get_eth_port(self, dev):
-        port_path = pciUtils.ETH_PORT.replace("ETH", dev)
-        try:
-            with open(port_path) as f:
-                dev_id = int(f.read(),0)
-                return dev_id+1
-        except IOError:
-            return
-            
+        netdev = self._get_topology()['netdevs'].get(dev)
+        if netdev:
+            return netdev['port']
+        return None
+
+    def get_pci_netdevs(self, pci):
+        """
+        @return: netdevs of the PCI device
+        """
+        return list(self._get_topology()['pcis'].get(pci, []))
+
+    def get_pf_vfs(self, pf):
+        """
+        @param pf: PF Ethernet device
+        @return: {VF index: VF PCI address} of the PF
+        """
+        pf_pci = self.get_eth_vf(pf)
+        return dict(self._get_topology()['pfs'].get(pf_pci, {}))
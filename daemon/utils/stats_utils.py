@@ -0,0 +1,157 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+#
+# Copyright 2013 Mellanox Technologies, Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import bisect
+import threading
+import time
+import BaseHTTPServer
+
+from nova.openstack.common import log as logging
+
+LOG = logging.getLogger('mlnx_daemon')
+
+# upper bounds in seconds
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+                   0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+ACTION = 'action'
+COMMAND = 'command'
+QUEUE = 'queue'
+
+METRIC_PREFIX = 'mlnx_daemon'
+
+
+class Histogram(object):
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def snapshot(self):
+        """
+        @return: cumulative bucket counts as Prometheus reports them
+        """
+        cumulative = 0
+        buckets = []
+        for bound, count in zip(self.buckets + ('+Inf',), self.counts):
+            cumulative += count
+            buckets.append([bound, cumulative])
+        return {'buckets':buckets, 'sum':self.sum, 'count':self.count}
+
+
+class StatsCollector(object):
+    """
+    Thread safe counters and latency histograms.
+    Metrics are grouped by category (action, command, queue) and name,
+    e.g. ('action', 'set_vlan') or ('command', 'ip link').
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.metrics = {}
+        self.start_time = time.time()
+
+    def _get_metric(self, category, name):
+        key = (category, name)
+        metric = self.metrics.get(key)
+        if metric is None:
+            metric = {'count':0, 'errors':0, 'latency':Histogram()}
+            self.metrics[key] = metric
+        return metric
+
+    def record(self, category, name, latency, failed=False):
+        with self.lock:
+            metric = self._get_metric(category, name)
+            metric['count'] += 1
+            if failed:
+                metric['errors'] += 1
+            metric['latency'].observe(latency)
+
+    def increment(self, category, name, counter, value=1):
+        with self.lock:
+            metric = self._get_metric(category, name)
+            metric[counter] = metric.get(counter, 0) + value
+
+    def snapshot(self):
+        """
+        @return: {category: {name: {counter: value, 'latency': histogram}}}
+        """
+        stats = {'uptime':time.time() - self.start_time}
+        with self.lock:
+            for (category, name), metric in self.metrics.iteritems():
+                entry = dict(metric)
+                entry['latency'] = metric['latency'].snapshot()
+                stats.setdefault(category, {})[name] = entry
+        return stats
+
+    def to_prometheus(self):
+        lines = ['# TYPE %s_uptime_seconds gauge' % METRIC_PREFIX,
+                 '%s_uptime_seconds %f' % (METRIC_PREFIX,
+                                           time.time() - self.start_time)]
+        stats = self.snapshot()
+        for category in (ACTION, COMMAND, QUEUE):
+            for name, entry in sorted(stats.get(category, {}).iteritems()):
+                prefix = '%s_%s' % (METRIC_PREFIX, category)
+                label = '%s="%s"' % (category, name)
+                for counter, value in sorted(entry.iteritems()):
+                    if counter != 'latency':
+                        lines.append('%s_%s_total{%s} %d' %
+                                     (prefix, counter, label, value))
+                latency = entry['latency']
+                for bound, count in latency['buckets']:
+                    lines.append('%s_latency_seconds_bucket{%s,le="%s"} %d' %
+                                 (prefix, label, bound, count))
+                lines.append('%s_latency_seconds_sum{%s} %f' %
+                             (prefix, label, latency['sum']))
+                lines.append('%s_latency_seconds_count{%s} %d' %
+                             (prefix, label, latency['count']))
+        return '\n'.join(lines) + '\n'
+
+
+# daemon wide collector
+STATS = StatsCollector()
+
+
+class _MetricsHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def do_GET(self):
+        body = STATS.to_prometheus()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        LOG.debug("metrics: " + format, *args)
+
+
+def start_metrics_server(host, port):
+    """
+    @note: serve STATS in Prometheus text format from a daemon thread
+    """
+    server = BaseHTTPServer.HTTPServer((host, port), _MetricsHandler)
+    thread = threading.Thread(target=server.serve_forever,
+                              name='metrics-server')
+    thread.daemon = True
+    thread.start()
+    LOG.info("Metrics served on %s:%d", host, port)
+    return server
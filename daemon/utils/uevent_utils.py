@@ -0,0 +1,100 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+#
+# Copyright 2013 Mellanox Technologies, Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import errno
+import os
+import socket
+import threading
+
+from nova.openstack.common import log as logging
+
+LOG = logging.getLogger('mlnx_daemon')
+
+NETLINK_KOBJECT_UEVENT = 15
+# kernel uevents multicast group (udev uses group 2 for its own events)
+UEVENT_GROUP = 1
+UEVENT_BUFSIZE = 64 * 1024
+
+SUBSYSTEMS = ('net', 'pci')
+
+
+def parse_uevent(data):
+    """
+    @param data: raw kernel uevent "ACTION@DEVPATH\\0KEY=VALUE\\0..."
+    @return: dict of the event keys, None for messages which are not
+             kernel uevents (e.g. udev's "libudev" messages)
+    """
+    fields = data.split('\0')
+    if '@' not in fields[0]:
+        return None
+    uevent = {}
+    for field in fields[1:]:
+        key, sep, value = field.partition('=')
+        if sep:
+            uevent[key] = value
+    if 'ACTION' not in uevent or 'DEVPATH' not in uevent:
+        return None
+    return uevent
+
+
+def open_uevent_socket():
+    sock = socket.socket(socket.AF_NETLINK, socket.SOCK_DGRAM,
+                         NETLINK_KOBJECT_UEVENT)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1024 * 1024)
+    sock.bind((os.getpid(), UEVENT_GROUP))
+    return sock
+
+
+class UeventMonitor(object):
+    """
+    Listens for kernel uevents of network and PCI devices.
+    callback(uevent) is invoked from the monitor thread for every event,
+    callback(None) when events were lost (receive buffer overrun) and
+    the devices must be rescanned.
+    A fake socket producing synthetic events may be passed for testing.
+    """
+    def __init__(self, callback, sock=None):
+        self.callback = callback
+        self.sock = sock
+
+    def start(self):
+        if self.sock is None:
+            self.sock = open_uevent_socket()
+        thread = threading.Thread(target=self._run, name='uevent-monitor')
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def _run(self):
+        while True:
+            try:
+                data = self.sock.recv(UEVENT_BUFSIZE)
+            except socket.error, e:
+                if e.errno == errno.ENOBUFS:
+                    LOG.warning("uevents lost - rescanning devices")
+                    self.callback(None)
+                    continue
+                if e.errno == errno.EINTR:
+                    continue
+                LOG.exception("uevent monitor stopped")
+                return
+            if not data:
+                # fake event streams end with an empty message
+                return
+            uevent = parse_uevent(data)
+            if uevent and uevent.get('SUBSYSTEM') in SUBSYSTEMS:
+                self.callback(uevent)
@@ -0,0 +1,170 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+#
+# Copyright 2013 Mellanox Technologies, Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import threading
+import time
+
+from nova.openstack.common import log as logging
+
+LOG = logging.getLogger('mlnx_daemon')
+
+class VlanBatcher(object):
+    """
+    Coalesces VF VLAN changes per PF.
+    Changes are queued by submit() and applied by wait(). The first
+    caller queueing a change for a PF waits window ms for more changes
+    and applies all of them with one link backend call, every caller
+    then gets the result of its own changes. Changes of a PF are applied
+    in submission order, when a VF is changed twice in a batch only the
+    last change is applied.
+    The VLAN/QoS last applied to every VF is remembered, changes to the
+    current values succeed without touching the VF. The state of a PF is
+    read from the hardware by load_pf and dropped for a VF whose change
+    failed.
+    """
+    def __init__(self, link_backend, window=0, sync=None):
+        """
+        @param window: ms to gather changes, 0 applies them right away
+        @param sync: callable() run before a batch is applied, e.g. to
+                     make the changes durable first
+        """
+        self.link_backend = link_backend
+        self.window = window / 1000.0
+        self.sync = sync
+        self.cond = threading.Condition()
+        # {pf: {'queue': [entry...], 'leader': bool, 'lock': Lock}}
+        self.pfs = {}
+        # {pf: {VF index: (vlan, qos)}}
+        self.applied = {}
+
+    def load_pf(self, pf):
+        """
+        @note: verify the remembered VF state against the hardware
+        """
+        try:
+            vf_vlans = self.link_backend.get_vf_vlans(pf)
+        except RuntimeError, e:
+            LOG.warning("Cannot read VF VLANs of %s: %s", pf, e)
+            vf_vlans = {}
+        with self.cond:
+            self.applied[pf] = vf_vlans
+        LOG.debug("VF VLANs of %s: %s", pf, vf_vlans)
+
+    def set_vf_vlans(self, pf, changes):
+        """
+        @param changes: [(vf_index, dev, vlan, qos, bounce)...]
+        @return: [succeeded...] per change
+        """
+        return self.wait([self.submit(pf, changes)])[0]
+
+    def submit(self, pf, changes):
+        """
+        @param changes: [(vf_index, dev, vlan, qos, bounce)...]
+        @return: ticket to pass to wait()
+        @note: queue the changes without applying them, callers holding a
+               lock while submitting get their changes applied in the
+               lock order
+        """
+        entries = [{'change':change, 'done':False, 'result':False}
+                   for change in changes]
+        with self.cond:
+            state = self.pfs.setdefault(pf, {'queue':[],
+                                             'leader':False,
+                                             'lock':threading.Lock()})
+            state['queue'].extend(entries)
+            leader = not state['leader']
+            state['leader'] = True
+        return {'pf':pf, 'state':state, 'entries':entries, 'leader':leader}
+
+    def wait(self, tickets):
+        """
+        @param tickets: tickets returned by submit()
+        @return: [[succeeded...] per change] per ticket
+        @note: the batches led by the tickets are applied after a single
+               window
+        """
+        leaders = [ticket for ticket in tickets if ticket['leader']]
+        if leaders and self.window:
+            time.sleep(self.window)
+        for ticket in leaders:
+            self._apply_batch(ticket['pf'], ticket['state'])
+        with self.cond:
+            while not all(entry['done'] for ticket in tickets
+                          for entry in ticket['entries']):
+                self.cond.wait()
+        return [[entry['result'] for entry in ticket['entries']]
+                for ticket in tickets]
+
+    def _apply_batch(self, pf, state):
+        with state['lock']:
+            with self.cond:
+                batch = state['queue']
+                state['queue'] = []
+                state['leader'] = False
+            try:
+                if self.sync:
+                    self.sync()
+                self._apply(pf, batch)
+            except Exception:
+                LOG.exception("Failed to apply VLAN changes on %s", pf)
+            finally:
+                # waiters are released even if the batch failed half way
+                with self.cond:
+                    for entry in batch:
+                        entry['done'] = True
+                    self.cond.notify_all()
+
+    def _apply(self, pf, batch):
+        # the last change of a VF wins
+        latest = {}
+        for entry in batch:
+            latest[entry['change'][0]] = entry
+        with self.cond:
+            vf_state = self.applied.setdefault(pf, {})
+        applied = []
+        for entry in batch:
+            vf_index, dev, vlan, qos, bounce = entry['change']
+            if latest[vf_index] is not entry:
+                continue
+            try:
+                entry['vlan_qos'] = (int(vlan), int(qos))
+            except (TypeError, ValueError):
+                LOG.error("Invalid VLAN %s/QoS %s for VF %s of %s",
+                          vlan, qos, vf_index, pf)
+                continue
+            if vf_state.get(str(vf_index)) == entry['vlan_qos']:
+                entry['result'] = True
+            else:
+                applied.append(entry)
+        results = []
+        if applied:
+            try:
+                results = self.link_backend.set_vf_vlans(
+                    pf, [entry['change'] for entry in applied])
+            except Exception:
+                LOG.exception("Failed to apply VLAN changes on %s", pf)
+                results = [False] * len(applied)
+            LOG.debug("Applied %d of %d VLAN changes on %s",
+                      len(applied), len(latest), pf)
+        for entry, result in zip(applied, results):
+            entry['result'] = result
+            if result:
+                vf_state[str(entry['change'][0])] = entry['vlan_qos']
+            else:
+                vf_state.pop(str(entry['change'][0]), None)
+        for entry in batch:
+            entry['result'] = latest[entry['change'][0]]['result']
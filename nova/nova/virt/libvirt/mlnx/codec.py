@@ -0,0 +1,87 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+#
+# Copyright 2013 Mellanox Technologies, Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Wire encoding of messages exchanged with the eSwitch daemon.
+
+JSON is always available. msgpack is used when installed and accepted
+by the daemon, field names are then replaced by small integer keys.
+The key table MUST be kept in sync with the daemon's common/codec.py.
+"""
+
+import json
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+# msgpack >= 1.0 rejects integer map keys and returns raw bytes unless told
+# otherwise, both options exist since 0.6.1
+if msgpack and msgpack.version >= (0, 6, 1):
+    UNPACK_OPTIONS = {'raw': False, 'strict_map_key': False}
+else:
+    UNPACK_OPTIONS = {'encoding': 'utf-8'}
+
+PROTOCOL_VERSION = 1
+
+JSON = 'json'
+MSGPACK = 'msgpack'
+
+FIELD_KEYS = ['action', 'status', 'response', 'reason', 'ver',
+              'fabric', 'vnic_mac', 'vnic_type', 'device_id', 'dev',
+              'vlan', 'mac', 'ref_by', 'interface', 'msgs', 'results',
+              'stop_on_failure', 'encodings', 'encoding', 'job_id', 'async',
+              'state', 'result', 'req_id', 'generation', 'epoch', 'full',
+              'added', 'removed', 'seq', 'event']
+
+SHORT_KEYS = dict((key, index) for index, key in enumerate(FIELD_KEYS))
+LONG_KEYS = dict((index, key) for index, key in enumerate(FIELD_KEYS))
+
+
+def available_encodings():
+    encodings = [JSON]
+    if msgpack:
+        encodings.insert(0, MSGPACK)
+    return encodings
+
+
+def _translate(obj, keys):
+    if isinstance(obj, dict):
+        return dict((keys.get(key, key), _translate(value, keys))
+                    for key, value in obj.iteritems())
+    if isinstance(obj, (list, tuple)):
+        return [_translate(value, keys) for value in obj]
+    return obj
+
+
+def encode(msg, encoding=JSON):
+    if encoding == MSGPACK:
+        return msgpack.packb(_translate(msg, SHORT_KEYS))
+    return json.dumps(msg)
+
+
+def decode(data):
+    """
+    @param data: raw message
+    @return: (message, encoding) - replies are sent in the same encoding
+    """
+    if data[:1] == '{' or not msgpack:
+        return json.loads(data), JSON
+    return (_translate(msgpack.unpackb(data, **UNPACK_OPTIONS), LONG_KEYS),
+            MSGPACK)
+
@@ -15,18 +15,21 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-import json
+import uuid
 import zmq
 from nova.openstack.common import log as logging
+from nova.virt.libvirt.mlnx import codec
 from nova.virt.libvirt.mlnx import exceptions
 
 MLX_DAEMON = "tcp://127.0.0.1:5001"
 REQUEST_TIMEOUT = 1000
+REQUEST_RETRIES = 2
 LOG = logging.getLogger(__name__)
 
 class ConnUtil(object):
     def __init__(self):
         self.__conn = None
+        self.encoding = None
 
     @property
     def _conn(self):
@@ -41,7 +44,40 @@ class ConnUtil(object):
         return self.__conn
 
     def send_msg(self,msg):
-        self._conn.send(msg)
+        """
+        @note: a request timing out is resent with the same req_id, the
+               daemon answers a duplicate from its response cache
+               instead of executing it again
+        """
+        msg['req_id'] = uuid.uuid4().hex
+        for attempt in range(REQUEST_RETRIES):
+            try:
+                return self._send_request(msg)
+            except exceptions.MlxTimeoutException:
+                LOG.warning(_("eSwitchD: request %s timed out, retrying"),
+                            msg['req_id'])
+        return self._send_request(msg)
+
+    def _send_request(self, msg):
+        if self.encoding is None:
+            self.encoding = self._negotiate_encoding()
+        return self._send_msg(msg, self.encoding)
+
+    def _negotiate_encoding(self):
+        msg = {'action':'negotiate',
+               'encodings':codec.available_encodings()}
+        try:
+            response = self._send_msg(msg, codec.JSON)
+            return response['encoding']
+        except exceptions.MlxTimeoutException:
+            raise
+        except exceptions.MlxException:
+            LOG.debug(_("Encoding negotiation failed, using JSON"))
+            return codec.JSON
+
+    def _send_msg(self, msg, encoding):
+        msg['ver'] = codec.PROTOCOL_VERSION
+        self._conn.send(codec.encode(msg, encoding))
 
         socks = dict(self.poller.poll(REQUEST_TIMEOUT))
         if socks.get(self._conn) == zmq.POLLIN:
@@ -53,10 +89,11 @@ class ConnUtil(object):
             self._conn.close()
             self.poller.unregister(self._conn)
             self.__conn = None
-            raise exceptions.MlxException("eSwitchD: Timeout processing  request")
+            self.encoding = None
+            raise exceptions.MlxTimeoutException("eSwitchD: Timeout processing  request")
 
     def parse_response_msg(self, recv_msg):
-        msg = json.loads(recv_msg)
+        msg, encoding = codec.decode(recv_msg)
         error_msg = " "
         if msg['status'] == 'OK':
             if 'response' in msg:
@@ -70,14 +107,14 @@ class ConnUtil(object):
         raise exceptions.MlxException(error_msg)
 
     def allocate_nic(self, vnic_mac, device_id, fabric, vnic_type):
-        msg = json.dumps({'action':'create_port','vnic_mac':vnic_mac,
-                          'device_id':device_id, 'fabric':fabric, 'vnic_type':vnic_type})
+        msg = {'action':'create_port','vnic_mac':vnic_mac,
+               'device_id':device_id, 'fabric':fabric, 'vnic_type':vnic_type}
         recv_msg = self.send_msg(msg)
         dev = recv_msg['dev']
         return dev
            
     def deallocate_nic(self, vnic_mac, fabric):
-        msg = json.dumps({'action':'delete_port', 'fabric':fabric, 'vnic_mac':vnic_mac})
+        msg = {'action':'delete_port', 'fabric':fabric, 'vnic_mac':vnic_mac}
         recv_msg = self.send_msg(msg)
         dev = recv_msg['dev']
         return dev
@@ -27,9 +27,13 @@ from quantum.openstack.common import context
 from quantum.openstack.common import cfg
 from quantum.openstack.common import log as logging
 from quantum.openstack.common.rpc import dispatcher
+from quantum.plugins.mlnx.agent import executor
+from quantum.plugins.mlnx.agent import plugin_api
+from quantum.plugins.mlnx.agent import port_registry
 from quantum.plugins.mlnx.agent import utils
 from quantum.plugins.mlnx.common import config
 from quantum.plugins.mlnx.common import constants
+from quantum.plugins.mlnx.common import exceptions
 
 LOG = logging.getLogger(__name__)
 
@@ -39,43 +43,110 @@ class EswitchMngr(object):
         self.utils = utils.eSwitchUtils()
         self.interface_mappings = interface_mappings
         self.network_map = {}
+        self.ports = port_registry.PortRegistry(cfg.CONF.AGENT.max_ports)
+        # attached vNICs as of the daemon's vnics generation
+        self.vnics = {}
+        self.vnics_generation = None
+        self.vnics_epoch = None
+        # last vNIC event applied to vnics, set if vnics is up to date
+        self.vnics_seq = None
+        self.vnics_pushed = False
         self.utils.define_fabric_mappings(interface_mappings)
     
     def get_port_id_by_mac(self,port_mac):
-        for network_id, data in self.network_map.iteritems(): 
-            for port in data['ports']:
-                if port['port_mac'] == port_mac:
-                    return port['port_id']
+        port = self.ports.get(port_mac)
+        if port:
+            return port['port_id']
         return port_mac
         
+    def get_vnics(self):
+        """
+        @note: fetch only the vNICs changed since the last call, daemons
+               not supporting it are asked for all the vNICs. vNICs just
+               updated by events are returned without asking the daemon.
+        """
+        if self.vnics_pushed:
+            self.vnics_pushed = False
+            return self.vnics
+        try:
+            delta = self.utils.get_attached_vnics_since(self.vnics_generation,
+                                                        self.vnics_epoch)
+        except exceptions.MlxTimeoutException:
+            raise
+        except exceptions.MlxException:
+            LOG.debug(_("get_vnics_since failed, fetching all vNICs"))
+            delta = None
+        if delta is None:
+            self.vnics_epoch = None
+            self.vnics_seq = None
+            self.vnics = self.utils.get_attached_vnics()
+            return self.vnics
+        if delta['full']:
+            self.vnics = dict(delta['added'])
+        else:
+            self.vnics.update(delta['added'])
+            for port_mac in delta['removed']:
+                self.vnics.pop(port_mac, None)
+        self.vnics_generation = delta['generation']
+        self.vnics_epoch = delta['epoch']
+        self.vnics_seq = delta.get('seq')
+        return self.vnics
+
+    def wait_vnic_events(self, timeout):
+        """
+        @param timeout: seconds to wait for vNIC events
+        @return: True if vnics was updated by events
+        @note: on a seq gap or a daemon restart the events are dropped,
+               get_vnics then resyncs with the daemon
+        """
+        events = self.utils.get_vnic_events(int(timeout * 1000))
+        for event in events:
+            if event['epoch'] != self.vnics_epoch or self.vnics_seq is None:
+                LOG.debug(_("vNIC event of another daemon epoch, resyncing"))
+                self.vnics_pushed = False
+                return False
+            if event['seq'] <= self.vnics_seq:
+                # already covered by the last get_vnics
+                continue
+            if event['seq'] != self.vnics_seq + 1:
+                LOG.debug(_("Missed vNIC events %s to %s, resyncing"),
+                          self.vnics_seq + 1, event['seq'] - 1)
+                self.vnics_pushed = False
+                return False
+            if event['event'] == 'attach':
+                self.vnics[event['vnic_mac']] = {'mac':event['vnic_mac'],
+                                                 'device_id':event['device_id']}
+            elif event['event'] == 'detach':
+                self.vnics.pop(event['vnic_mac'], None)
+            self.vnics_seq = event['seq']
+            self.vnics_pushed = True
+        return self.vnics_pushed
+
     def get_vnics_mac(self):    
-        return set(self.utils.get_attached_vnics().keys()) 
+        return set(self.get_vnics().keys()) 
     
     def vnic_port_exists(self,network_id,physical_network, port_mac):  
-        if port_mac in self.utils.get_attached_vnics():
+        if port_mac in self.get_vnics():
             return True
         return False
           
     def remove_network(self,network_id,physical_network,vlan_id):
         if network_id in self.network_map:
             del self.network_map[network_id]
+            self.ports.remove_network(network_id)
         else:
             LOG.debug(_("Network %s not defined on Agent."), network_id)
     
     def port_down(self,network_id,physical_network,port_mac):
         """
-        @note: check  internal network map for port data
+        @note: check  internal port registry for port data
             if port exists
                 set port to Down
         """
-        for network_id, data in self.network_map.iteritems(): 
-            for port in data['ports']:
-                if port['port_mac'] == port_mac:
-                    self.utils.port_down(physical_network,port_mac)
-                    break
+        if port_mac in self.ports:
+            self.utils.port_down(physical_network,port_mac)
         else:
-            return        
-        LOG.info(_('Network %s is not available on this agent'),network_id)
+            LOG.info(_('Network %s is not available on this agent'),network_id)
     
     def port_up(self,network_id,network_type,
                 physical_network,seg_id,port_id,port_mac):
@@ -91,15 +162,13 @@ class EswitchMngr(object):
             self.provision_network(port_id,port_mac,
                                    network_id,network_type,
                                    physical_network,seg_id)
-        net_map = self.network_map[network_id]
-        net_map['ports'].append({'port_id':port_id,'port_mac':port_mac})
+        self.ports.add(network_id, physical_network, port_id, port_mac)
         
         if network_type == constants.TYPE_VLAN:
             LOG.info(_('Binding VLAN ID %s to eSwitch for vNIC  mac_address %s'),seg_id, port_mac)
-            self.utils.set_port_vlan_id(physical_network,
-                                         seg_id,
-                                         port_mac)
-            self.utils.port_up(physical_network,port_mac)
+            self.utils.set_port_vlan_id_and_up(physical_network,
+                                               seg_id,
+                                               port_mac)
         elif network_type == constants.TYPE_IB:
             LOG.debug(_('Network Type IB currently not supported'))
         else:
@@ -110,15 +179,12 @@ class EswitchMngr(object):
         """
     	@note: clear port configuration from eSwitch
     	"""
-        for network_id, net_data in self.network_map.iteritems(): 
-            for port in net_data['ports']:
-                if port['port_mac'] == port_mac:
-                    self.utils.port_release(net_data['physical_network'],port['port_mac'])
-                    break
+        port = self.ports.get(port_mac)
+        if port:
+            self.utils.port_release(port['physical_network'],port_mac)
+            self.ports.remove(port_mac)
         else:
-            return 
-        
-        LOG.info(_('Port_mac %s is not available on this agent'),port_mac)
+            LOG.info(_('Port_mac %s is not available on this agent'),port_mac)
             
     def provision_network(self, port_id, port_mac,
                             network_id, network_type,
@@ -138,7 +204,6 @@ class EswitchMngr(object):
         data = {
             'physical_network': physical_network,
             'network_type': network_type,
-            'ports': [],
             'vlan_id': segmentation_id}
         
         self.network_map[network_id] = data
@@ -193,6 +258,11 @@ class MlxEswitchQuantumAgent(object):
     def __init__(self,interface_mapping):
         self._polling_interval = cfg.CONF.AGENT.polling_interval
         #self._root_helper = cfg.CONF.AGENT.root_helper
+        self._device_retries = cfg.CONF.AGENT.device_retries
+        self.executor = executor.DeviceExecutor(cfg.CONF.AGENT.device_workers)
+        # devices to process again on the next loop
+        self.failed_added = set()
+        self.failed_removed = set()
         self._setup_eswitches(interface_mapping)
         self._setup_rpc()
 
@@ -202,7 +272,8 @@ class MlxEswitchQuantumAgent(object):
     def _setup_rpc(self):
         self.agent_id = 'mlx-agent.%s' % socket.gethostname()
         self.topic = topics.AGENT
-        self.plugin_rpc = agent_rpc.PluginApi(topics.PLUGIN)
+        self.plugin_rpc = plugin_api.MlnxPluginApi(topics.PLUGIN,
+                                                   self.executor.pool)
         # RPC network init
         self.context = context.RequestContext('quantum', 'quantum',
                                               is_admin=False)
@@ -249,54 +320,86 @@ class MlxEswitchQuantumAgent(object):
         else:
             LOG.debug(_("No port %s defined on agent."), port_id)
 
+    def _retry_devices(self, failed):
+        """
+        @return: True if a device failed more than device_retries times
+                 in a row, the agent then resyncs with the plugin
+        """
+        exhausted = [device for device in failed
+                     if self.executor.get_failures(device) > self._device_retries]
+        for device in exhausted:
+            LOG.warning(_("Device %s failed %d times, resyncing"), device,
+                        self.executor.get_failures(device))
+            self.executor.reset(device)
+        return bool(exhausted)
+
+    def _treat_device_added(self, dev_details):
+        device = dev_details['device']
+        if 'port_id' in dev_details:
+            LOG.info(_("Port %s updated"),device)
+            LOG.debug(_("Device details %s"),str(dev_details))
+            self.treat_vif_port(
+                dev_details['port_id'],
+                dev_details['port_mac'],
+                dev_details['network_id'],
+                dev_details['network_type'],
+                dev_details['physical_network'],
+                dev_details['vlan_id'],
+                dev_details['admin_state_up'])
+        else:
+            LOG.debug("Device with mac_address %s not defined on Quantum Plugin", device)
+
     def treat_devices_added(self, devices):
-        resync = False
-        for device in devices:
-            LOG.info(_("Adding port with mac %s"),device)
-            try:
-                dev_details = self.plugin_rpc.get_device_details(
-                        self.context,
-                        device,
-                        self.agent_id)
-            except Exception as e:
-                LOG.debug(_(
-                    "Unable to get device dev_details for device with mac_address %s: %s"),
-                    device, e)
-                resync = True
-                continue
-            if 'port_id' in dev_details:
-                LOG.info(_("Port %s updated"),device)
-                LOG.debug(_("Device details %s"),str(dev_details))
-                self.treat_vif_port(
-                    dev_details['port_id'],
-                    dev_details['port_mac'],
-                    dev_details['network_id'],
-                    dev_details['network_type'],
-                    dev_details['physical_network'],
-                    dev_details['vlan_id'],
-                    dev_details['admin_state_up'])
-            else:
-                LOG.debug("Device with mac_address %s not defined on Quantum Plugin", device)
-        return resync
+        """
+        @note: devices failing are kept in failed_added to be retried
+        """
+        self.failed_added = set()
+        devices = list(devices)
+        if not devices:
+            return False
+        LOG.info(_("Adding ports with mac %s"), devices)
+        try:
+            devices_details = self.plugin_rpc.get_devices_details(
+                    self.context,
+                    devices,
+                    self.agent_id)
+        except Exception as e:
+            LOG.debug(_(
+                "Unable to get device dev_details for devices with mac_address %s: %s"),
+                devices, e)
+            return True
+        self.failed_added = self.executor.run(self._treat_device_added,
+                                              devices_details,
+                                              key=lambda details: details['device'])
+        return self._retry_devices(self.failed_added)
+
+    def _treat_device_removed(self, device):
+        LOG.info(_("Port %s updated."),device)
+        self.eswitch.port_release(device)
 
     def treat_devices_removed(self, devices):
-        resync = False
-        for device in devices:
-            LOG.info(_("Removing device with mac_address %s"), device)
-            try:
-                port_id = self.eswitch.get_port_id_by_mac(device)
-                dev_details = self.plugin_rpc.update_device_down(self.context,
-                                                             port_id,
-                                                             self.agent_id)
-            except Exception as e:
-                LOG.debug(_(
-                    "Removing port failed for device %s: %s"),
-                    device, e)
-                resync = True
-                continue           
-            LOG.info(_("Port %s updated."),device)
-            self.eswitch.port_release(device) 
-        return resync
+        """
+        @note: devices failing are kept in failed_removed to be retried
+        """
+        self.failed_removed = set()
+        devices = list(devices)
+        if not devices:
+            return False
+        LOG.info(_("Removing devices with mac_address %s"), devices)
+        port_ids = [self.eswitch.get_port_id_by_mac(device)
+                    for device in devices]
+        try:
+            self.plugin_rpc.update_devices_down(self.context,
+                                                port_ids,
+                                                self.agent_id)
+        except Exception as e:
+            LOG.debug(_(
+                "Removing ports failed for devices %s: %s"),
+                devices, e)
+            return True
+        self.failed_removed = self.executor.run(self._treat_device_removed,
+                                                devices)
+        return self._retry_devices(self.failed_removed)
 
     def daemon_loop(self):
         sync = True
@@ -315,14 +418,24 @@ class MlxEswitchQuantumAgent(object):
                     LOG.debug(_("Agent loop has new devices!"))
                     # If treat devices fails - must resync with plugin
                     sync = self.process_network_ports(port_info)
-                    ports = port_info['current']
+                    LOG.debug(_("Port registry: %(ports)d ports in "
+                                "%(networks)d networks, %(overflows)d over limit"),
+                              self.eswitch.ports.get_stats())
+                    # failed devices are seen as added/removed again
+                    ports = ((port_info['current'] - self.failed_added) |
+                             self.failed_removed)
             except Exception as e:
                 LOG.exception(_("Error in agent event loop: %s"), e)
                 sync = True
-            # sleep till end of polling interval
+            # wait for vNIC events till end of polling interval
             elapsed = (time.time() - start)
             if (elapsed < self._polling_interval):
-                time.sleep(self._polling_interval - elapsed)
+                try:
+                    self.eswitch.wait_vnic_events(self._polling_interval -
+                                                  elapsed)
+                except Exception as e:
+                    LOG.exception(_("Error receiving vNIC events: %s"), e)
+                    time.sleep(self._polling_interval - elapsed)
             else:
                 LOG.debug(_("Loop iteration exceeded interval "
                             "(%(polling_interval)s vs. %(elapsed)s)"),
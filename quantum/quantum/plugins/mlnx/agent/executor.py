@@ -0,0 +1,66 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+#
+# Copyright 2013 Mellanox Technologies, Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import eventlet
+
+from quantum.openstack.common import log as logging
+
+LOG = logging.getLogger(__name__)
+
+
+class DeviceExecutor(object):
+    """
+    Runs a function for every device of a batch on a GreenPool, so that
+    a device waiting on an RPC or daemon round trip does not hold up the
+    others. Daemon requests share one socket and are still sent one at a
+    time. Consecutive failures are counted per device until it succeeds.
+    """
+    def __init__(self, workers):
+        self.pool = eventlet.GreenPool(workers)
+        # {device: consecutive failed attempts}
+        self.failures = {}
+
+    def _run_one(self, func, device, item):
+        try:
+            func(item)
+            return device, True
+        except Exception as e:
+            LOG.exception(_("Processing device %s failed: %s"), device, e)
+            return device, False
+
+    def run(self, func, items, key=None):
+        """
+        @param func: called with every item, fails by raising
+        @param key: returns the device of an item, the item itself by default
+        @return: set of the failed devices
+        """
+        pile = eventlet.GreenPile(self.pool)
+        for item in items:
+            pile.spawn(self._run_one, func, key(item) if key else item, item)
+        failed = set()
+        for device, succeeded in pile:
+            if succeeded:
+                self.failures.pop(device, None)
+            else:
+                self.failures[device] = self.failures.get(device, 0) + 1
+                failed.add(device)
+        return failed
+
+    def get_failures(self, device):
+        return self.failures.get(device, 0)
+
+    def reset(self, device):
+        self.failures.pop(device, None)
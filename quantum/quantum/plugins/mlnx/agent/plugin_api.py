@@ -0,0 +1,89 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+#
+# Copyright 2013 Mellanox Technologies, Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from quantum.agent import rpc as agent_rpc
+from quantum.openstack.common import log as logging
+from quantum.openstack.common.rpc import common as rpc_common
+
+LOG = logging.getLogger(__name__)
+
+
+class MlnxPluginApi(agent_rpc.PluginApi):
+    '''
+       Plugin side of the Embedded Switch RPC API, as used by the agent.
+       API version history:
+       1.0 - Initial version.
+       1.1 - get_devices_details
+       1.2 - update_devices_down
+    '''
+    # errors of plugins not supporting a bulk call
+    UNSUPPORTED_ERRORS = ('UnsupportedRpcVersion', 'AttributeError')
+
+    def __init__(self, topic, pool=None):
+        """
+        @param pool: GreenPool running the per device calls of plugins
+                     without bulk calls, they run one by one without
+        """
+        super(MlnxPluginApi, self).__init__(topic)
+        self.pool = pool
+        # bulk calls the plugin turned out not to support
+        self.unsupported = set()
+
+    def _map(self, func, devices):
+        if self.pool:
+            return list(self.pool.imap(func, devices))
+        return map(func, devices)
+
+    def _bulk_call(self, context, method, version, **kwargs):
+        """
+        @return: the call's result, None if the plugin does not support it
+        """
+        if method in self.unsupported:
+            return None
+        try:
+            return self.call(context, self.make_msg(method, **kwargs),
+                             topic=self.topic, version=version)
+        except rpc_common.RemoteError as e:
+            if e.exc_type not in self.UNSUPPORTED_ERRORS:
+                raise
+            LOG.info(_("Plugin does not support %s, asking device by "
+                       "device: %s"), method, e)
+            self.unsupported.add(method)
+            return None
+
+    def get_devices_details(self, context, devices, agent_id):
+        """
+        @return: device details per device, as get_device_details returns
+        @note: plugins without get_devices_details are asked device by device
+        """
+        details = self._bulk_call(context, 'get_devices_details', '1.1',
+                                  devices=devices, agent_id=agent_id)
+        if details is None:
+            details = self._map(lambda device: self.get_device_details(
+                context, device, agent_id), devices)
+        return details
+
+    def update_devices_down(self, context, devices, agent_id):
+        """
+        @return: {'device', 'exists'} per device, as update_device_down returns
+        @note: plugins without update_devices_down are told device by device
+        """
+        entries = self._bulk_call(context, 'update_devices_down', '1.2',
+                                  devices=devices, agent_id=agent_id)
+        if entries is None:
+            entries = self._map(lambda device: self.update_device_down(
+                context, device, agent_id), devices)
+        return entries
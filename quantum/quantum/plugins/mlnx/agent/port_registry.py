@@ -0,0 +1,87 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+#
+# Copyright 2013 Mellanox Technologies, Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from quantum.openstack.common import log as logging
+
+LOG = logging.getLogger(__name__)
+
+
+class PortRegistry(object):
+    """
+    Ports bound on the agent, indexed by MAC and by network.
+    A MAC is registered once, registering it again updates its entry.
+    Ports are never dropped as their release still has to reach the
+    daemon, registering a new port beyond max_ports is only logged and
+    counted as an overflow.
+    """
+    def __init__(self, max_ports=0):
+        self.max_ports = max_ports
+        # {port_mac: port}
+        self.ports = {}
+        # {network_id: set(port_mac)}
+        self.network_ports = {}
+        self.overflows = 0
+
+    def __len__(self):
+        return len(self.ports)
+
+    def __contains__(self, port_mac):
+        return port_mac in self.ports
+
+    def add(self, network_id, physical_network, port_id, port_mac):
+        if self.remove(port_mac) is None:
+            if self.max_ports and len(self.ports) >= self.max_ports:
+                LOG.warning(_("Port registry over its limit of %d ports, "
+                              "adding port %s"), self.max_ports, port_mac)
+                self.overflows += 1
+        self.ports[port_mac] = {'port_id':port_id,
+                                'port_mac':port_mac,
+                                'network_id':network_id,
+                                'physical_network':physical_network}
+        self.network_ports.setdefault(network_id, set()).add(port_mac)
+
+    def get(self, port_mac):
+        return self.ports.get(port_mac)
+
+    def remove(self, port_mac):
+        """
+        @return: the removed port, None if not registered
+        """
+        port = self.ports.pop(port_mac, None)
+        if port:
+            macs = self.network_ports[port['network_id']]
+            macs.discard(port_mac)
+            if not macs:
+                del self.network_ports[port['network_id']]
+        return port
+
+    def remove_network(self, network_id):
+        """
+        @return: MACs of the removed ports
+        """
+        macs = self.network_ports.pop(network_id, set())
+        for port_mac in macs:
+            del self.ports[port_mac]
+        return macs
+
+    def get_network_ports(self, network_id):
+        return [self.ports[port_mac]
+                for port_mac in self.network_ports.get(network_id, ())]
+
+    def get_stats(self):
+        return {'ports':len(self.ports),
+                'networks':len(self.network_ports),
+                'overflows':self.overflows}
@@ -15,15 +15,28 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-import json
-import zmq
+import eventlet
+import threading
+import time
+import uuid
+
+# green sockets let other green threads run while waiting for the daemon
+from eventlet.green import zmq
 
 from quantum.openstack.common import cfg
 from quantum.openstack.common import log as logging
+from quantum.plugins.mlnx.common import codec
 from quantum.plugins.mlnx.common import exceptions
 
 MLX_DAEMON = "tcp://127.0.0.1:5001"
+MLX_DAEMON_EVENTS = "tcp://127.0.0.1:5002"
 REQUEST_TIMEOUT = 1000
+REQUEST_RETRIES = 2
+JOB_TIMEOUT = 30000
+JOB_TOPIC = 'job'
+VNIC_TOPIC = 'vnic'
+# reason of the daemon's reply to an action it does not know
+UNKNOWN_ACTION = 'unknown action'
 
 CONF = cfg.CONF
 LOG = logging.getLogger(__name__)
@@ -32,6 +45,14 @@ LOG = logging.getLogger(__name__)
 class  eSwitchUtils(object):
     def __init__(self):
         self.__conn = None
+        self.__job_events = None
+        self.__vnic_events = None
+        self.encoding = None
+        # the REQ socket serves one request at a time, requests of
+        # concurrent green threads are sent one after the other
+        self.lock = threading.Lock()
+        # actions the daemon turned out not to support
+        self.unsupported = set()
         
     @property
     def _conn(self):
@@ -41,35 +62,157 @@ class  eSwitchUtils(object):
             socket.setsockopt(zmq.LINGER, 0)
             socket.connect(MLX_DAEMON)
             self.__conn = socket
-            self.poller = zmq.Poller()
-            self.poller.register(self._conn, zmq.POLLIN)
         return self.__conn
+
+    @property
+    def _job_events(self):
+        if self.__job_events is None:
+            context = zmq.Context()
+            socket = context.socket(zmq.SUB)
+            socket.setsockopt(zmq.LINGER, 0)
+            socket.setsockopt(zmq.SUBSCRIBE, JOB_TOPIC)
+            socket.connect(MLX_DAEMON_EVENTS)
+            self.__job_events = socket
+        return self.__job_events
+
+    @property
+    def _vnic_events(self):
+        if self.__vnic_events is None:
+            context = zmq.Context()
+            socket = context.socket(zmq.SUB)
+            socket.setsockopt(zmq.LINGER, 0)
+            socket.setsockopt(zmq.SUBSCRIBE, VNIC_TOPIC)
+            socket.connect(MLX_DAEMON_EVENTS)
+            self.__vnic_events = socket
+        return self.__vnic_events
      
     def send_msg(self,msg):
-        self._conn.send(msg)
+        """
+        @note: a request timing out is resent with the same req_id, the
+               daemon answers a duplicate from its response cache
+               instead of executing it again
+        """
+        msg['req_id'] = uuid.uuid4().hex
+        with self.lock:
+            for attempt in range(REQUEST_RETRIES):
+                try:
+                    return self._send_request(msg)
+                except exceptions.MlxTimeoutException:
+                    LOG.warning(_("eSwitchD: request %s timed out, retrying"),
+                                msg['req_id'])
+            return self._send_request(msg)
+
+    def _send_request(self, msg):
+        if self.encoding is None:
+            self.encoding = self._negotiate_encoding()
+        return self._send_msg(msg, self.encoding)
+
+    def _negotiate_encoding(self):
+        msg = {'action':'negotiate',
+               'encodings':codec.available_encodings()}
+        try:
+            response = self._send_msg(msg, codec.JSON)
+            return response['encoding']
+        except exceptions.MlxTimeoutException:
+            raise
+        except exceptions.MlxException:
+            LOG.debug(_("Encoding negotiation failed, using JSON"))
+            return codec.JSON
+
+    def _send_msg(self, msg, encoding):
+        msg['ver'] = codec.PROTOCOL_VERSION
+        self._conn.send(codec.encode(msg, encoding))
         
-        socks = dict(self.poller.poll(REQUEST_TIMEOUT))
-        if socks.get(self._conn) == zmq.POLLIN:
+        recv_msg = None
+        # the green Poller blocks the process, wait on a green recv instead
+        with eventlet.Timeout(REQUEST_TIMEOUT / 1000.0, False):
             recv_msg = self._conn.recv()
+        if recv_msg is not None:
             response = self.parse_response_msg(recv_msg)
             return response  
         else:
             self._conn.setsockopt(zmq.LINGER, 0)
             self._conn.close()
-            self.poller.unregister(self._conn)
             self.__conn = None
-            raise exceptions.MlxException("eSwitchD: Timeout processing  request")
+            self.encoding = None
+            raise exceptions.MlxTimeoutException("eSwitchD: Timeout processing  request")
             
+    def send_msg_async(self, msg):
+        """
+        @return: job id, the result is collected by wait_jobs
+        """
+        # subscribe before the job is submitted so its result is not missed
+        self._job_events
+        msg['async'] = True
+        return self.send_msg(msg)['job_id']
+
+    def wait_jobs(self, job_ids, timeout=JOB_TIMEOUT):
+        """
+        @param job_ids: ids returned by send_msg_async
+        @return: dict of job id to job response message
+        @note: jobs not reported within timeout ms are queried once with
+               get_job before giving up
+        """
+        pending = set(job_ids)
+        results = {}
+        deadline = time.time() + timeout / 1000.0
+        while pending:
+            remaining = int((deadline - time.time()) * 1000)
+            if remaining <= 0:
+                break
+            for notification in self._recv_events(self._job_events,
+                                                  remaining):
+                job_id = notification['job_id']
+                if job_id in pending:
+                    pending.discard(job_id)
+                    results[job_id] = notification['result']
+        for job_id in pending:
+            job = self.send_msg({'action':'get_job', 'job_id':job_id})
+            if 'result' not in job:
+                raise exceptions.MlxException("eSwitchD: Timeout waiting for job %s" % job_id)
+            results[job_id] = job['result']
+        return results
+
+    def get_vnic_events(self, timeout):
+        """
+        @param timeout: ms to wait for the first event
+        @return: vNIC events published by the daemon, in order
+        """
+        return self._recv_events(self._vnic_events, timeout)
+
+    def _recv_events(self, socket, timeout):
+        """
+        @param timeout: ms to wait for the first message
+        @return: messages queued on the SUB socket, in order
+        """
+        events = []
+        frames = None
+        with eventlet.Timeout(timeout / 1000.0, False):
+            frames = socket.recv_multipart()
+        while frames:
+            topic, data = frames
+            events.append(codec.decode(data)[0])
+            try:
+                frames = socket.recv_multipart(zmq.NOBLOCK)
+            except zmq.Again:
+                frames = None
+        return events
+
     def parse_response_msg(self, recv_msg):
-        msg = json.loads(recv_msg)
+        msg, encoding = codec.decode(recv_msg)
+        return self.parse_response(msg)
+
+    def parse_response(self, msg):
         error_msg = " "
         if msg['status'] == 'OK':
             if 'response' in msg:
                 return msg['response']
             return    
         elif msg['status'] == 'FAIL':
-            LOG.error(_("Action %s failed: %s"),msg['action'],msg['reason'])
-            error_msg = "Action  %s failed: %s"%(msg['action'],msg['reason'])
+            if msg.get('reason') == UNKNOWN_ACTION:
+                raise exceptions.MlxUnsupportedAction(msg.get('action'))
+            LOG.error(_("Action %s failed: %s"),msg.get('action'),msg['reason'])
+            error_msg = "Action  %s failed: %s"%(msg.get('action'),msg['reason'])
         else:
             LOG.error(_("Unknown operation status %s"),msg['status'])
             error_msg = "Unknown operation status %s"%msg['status']
@@ -77,50 +220,115 @@ class  eSwitchUtils(object):
     
     def get_attached_vnics(self):
         LOG.debug(_("get_attached_vnics"))
-        msg = json.dumps({'action':'get_vnics', 'fabric':'*'})
+        msg = {'action':'get_vnics', 'fabric':'*'}
         vnics = self.send_msg(msg)
         return vnics
+
+    def get_attached_vnics_since(self, generation=None, epoch=None):
+        """
+        @param generation, epoch: as returned by the previous call
+        @return: {'epoch', 'seq', 'generation', 'full', 'added', 'removed'}
+                 - if full is set added holds all the attached vNICs.
+                 None if the daemon does not support it
+        """
+        if 'get_vnics_since' in self.unsupported:
+            return None
+        msg = {'action':'get_vnics_since', 'fabric':'*'}
+        if epoch:
+            msg.update({'generation':generation, 'epoch':epoch})
+        try:
+            return self.send_msg(msg)
+        except exceptions.MlxUnsupportedAction:
+            LOG.info(_("eSwitchD does not support get_vnics_since, "
+                       "fetching all vNICs from now on"))
+            self.unsupported.add('get_vnics_since')
+            return None
     
     def set_port_vlan_id(self,physical_network,
                         segmentation_id,port_mac):
         LOG.debug(_("Set Vlan  %s on Port %s on Fabric %s"),segmentation_id,port_mac,physical_network)
-        msg = json.dumps({'action':'set_vlan', 'fabric':physical_network, 'vnic_mac':port_mac,'vlan':segmentation_id})
+        msg = {'action':'set_vlan', 'fabric':physical_network, 'vnic_mac':port_mac,'vlan':segmentation_id}
         recv_msg = self.send_msg(msg)
         return True
 
+    def set_port_vlan_id_async(self,physical_network,
+                               segmentation_id,port_mac):
+        """
+        @return: job id of the VLAN change, see wait_jobs
+        """
+        LOG.debug(_("Set Vlan  %s on Port %s on Fabric %s asynchronously"),segmentation_id,port_mac,physical_network)
+        msg = {'action':'set_vlan', 'fabric':physical_network, 'vnic_mac':port_mac,'vlan':segmentation_id}
+        return self.send_msg_async(msg)
+
+    def set_port_vlan_id_and_up(self,physical_network,
+                                segmentation_id,port_mac):
+        LOG.debug(_("Set Vlan  %s and Port Up on Port %s on Fabric %s"),segmentation_id,port_mac,physical_network)
+        msgs = [{'action':'set_vlan',
+                 'fabric':physical_network,
+                 'vnic_mac':port_mac,
+                 'vlan':segmentation_id},
+                {'action':'port_up',
+                 'fabric':physical_network,
+                 'ref_by':'mac_address',
+                 'mac':port_mac}]
+        if 'batch' not in self.unsupported:
+            try:
+                self.send_batch(msgs)
+                return True
+            except exceptions.MlxUnsupportedAction:
+                LOG.info(_("eSwitchD does not support batches, sending "
+                           "messages one by one"))
+                self.unsupported.add('batch')
+        self.set_port_vlan_id(physical_network, segmentation_id, port_mac)
+        self.port_up(physical_network, port_mac)
+        return True
+
+    def send_batch(self, msgs, stop_on_failure=True):
+        """
+        @param msgs: list of messages executed by the daemon in order
+        @param stop_on_failure: skip the messages following a failure
+        @return: list of responses, raise MlxException on first failure
+        """
+        LOG.debug(_("Send batch of %d messages"), len(msgs))
+        msg = {'action':'batch',
+               'msgs':msgs,
+               'stop_on_failure':stop_on_failure}
+        response = self.send_msg(msg)
+        return [self.parse_response(result) for result in response['results']]
+
     def define_fabric_mappings(self,interface_mapping):
         for fabric, phy_interface in interface_mapping.iteritems():
             LOG.debug(_("Define Fabric %s on interface %s"),fabric,phy_interface)
-            msg = json.dumps({'action':'define_fabric_mapping', 
-                              'fabric':fabric,
-                              'interface':phy_interface})
+            msg = {'action':'define_fabric_mapping', 
+                   'fabric':fabric,
+                   'interface':phy_interface}
             self.send_msg(msg)
         return True
 
     def port_up(self,fabric,port_mac):
         LOG.debug(_("Port Up for %s on fabric %s"),port_mac, fabric)
-        msg = json.dumps({'action':'port_up', 
-                          'fabric':fabric,
-                          'ref_by':'mac_address',
-                          'mac':'port_mac'})
+        msg = {'action':'port_up', 
+               'fabric':fabric,
+               'ref_by':'mac_address',
+               'mac':port_mac}
         self.send_msg(msg)
         return True
     
     def port_down(self,fabric,port_mac):
         LOG.debug(_("Port Down for %s on fabric %s"),port_mac, fabric)
-        msg = json.dumps({'action':'port_down', 
-                          'fabric':fabric,
-                          'ref_by':'mac_address',
-                          'mac':port_mac})
+        msg = {'action':'port_down', 
+               'fabric':fabric,
+               'ref_by':'mac_address',
+               'mac':port_mac}
         self.send_msg(msg)
         return True
     
     def port_release(self,fabric,port_mac):
         LOG.debug(_("release port %s on fabric %s"),port_mac, fabric)
-        msg = json.dumps({'action':'port_release', 
-                          'fabric':fabric,
-                          'ref_by':'mac_address',
-                          'mac':port_mac})
+        msg = {'action':'port_release', 
+               'fabric':fabric,
+               'ref_by':'mac_address',
+               'mac':port_mac}
         self.send_msg(msg)
         return True
         
@@ -46,6 +46,15 @@ agent_opts = [
     cfg.IntOpt('polling_interval', default=2),
     cfg.StrOpt('root_helper', default='sudo'),
     cfg.BoolOpt('rpc', default=True),
+    cfg.IntOpt('device_workers', default=8,
+               help="Devices processed concurrently by the agent"),
+    cfg.IntOpt('device_retries', default=3,
+               help="Times a failed device is retried before resyncing "
+               "all the devices"),
+    cfg.IntOpt('max_ports', default=4096,
+               help="Ports the agent expects to track, more ports are "
+               "still tracked but logged and counted as overflows, "
+               "0 for no limit"),
 ]
 
 cfg.CONF.register_opts(vlan_opts, "VLANS")
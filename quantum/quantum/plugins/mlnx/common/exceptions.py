@@ -23,3 +23,13 @@ class MlxException(qexc.QuantumException):
 
     def __str__(self):
         return 'MlxException: %s' % self.message
+
+
+class MlxTimeoutException(MlxException):
+    def __str__(self):
+        return 'MlxTimeoutException: %s' % self.message
+
+
+class MlxUnsupportedAction(MlxException):
+    def __str__(self):
+        return 'MlxUnsupportedAction: %s' % self.message
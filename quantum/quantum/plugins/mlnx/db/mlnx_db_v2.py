@@ -17,6 +17,7 @@
 
 import logging
 
+import sqlalchemy as sa
 from sqlalchemy.orm import exc
 
 from quantum.common import exceptions as q_exc
@@ -190,6 +191,18 @@ def get_network_binding(session, network_id):
         return
 
 
+def get_network_bindings(session, network_ids):
+    """
+    @return: {network_id: binding} of the bound networks
+    """
+    if not network_ids:
+        return {}
+    bindings = (session.query(mlnx_models_v2.NetworkBinding).
+                filter(mlnx_models_v2.NetworkBinding.network_id.in_(network_ids)).
+                all())
+    return dict((binding.network_id, binding) for binding in bindings)
+
+
 def get_port_from_device(device):
     """Get port from database"""
     LOG.debug("get_port_from_device() called")
@@ -227,3 +240,40 @@ def set_port_status(port_id, status):
         session.flush()
     except exc.NoResultFound:
         raise q_exc.PortNotFound(port_id=port_id)
+
+
+def get_ports_from_devices(id_prefixes, device_macs):
+    """
+    Get ports from database by port id prefix and by MAC address
+    @return: ({id_prefix: port}, {mac: port}) of the ports found
+    """
+    LOG.debug("get_ports_from_devices() called")
+    session = db.get_session()
+    ports_by_prefix = {}
+    ports_by_mac = {}
+    criteria = [models_v2.Port.id.startswith(prefix) for prefix in id_prefixes]
+    if device_macs:
+        criteria.append(models_v2.Port.mac_address.in_(device_macs))
+    if not criteria:
+        return ports_by_prefix, ports_by_mac
+    prefixes = set(id_prefixes)
+    macs = set(device_macs)
+    for port in session.query(models_v2.Port).filter(sa.or_(*criteria)):
+        for prefix in prefixes:
+            if port['id'].startswith(prefix):
+                ports_by_prefix.setdefault(prefix, port)
+        if port['mac_address'] in macs:
+            ports_by_mac[port['mac_address']] = port
+    return ports_by_prefix, ports_by_mac
+
+
+def set_ports_status(port_ids, status):
+    """Set the status of the ports in one transaction"""
+    LOG.debug("set_ports_status as %s called", status)
+    if not port_ids:
+        return 0
+    session = db.get_session()
+    with session.begin():
+        return (session.query(models_v2.Port).
+                filter(models_v2.Port.id.in_(port_ids)).
+                update({'status': status}, synchronize_session=False))
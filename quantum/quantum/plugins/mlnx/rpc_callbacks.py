@@ -25,8 +25,11 @@ from quantum.plugins.mlnx.db import mlnx_db_v2 as db
 LOG = logging.getLogger(__name__)
 
 class MlnxRpcCallbacks(dhcp_rpc_base.DhcpRpcCallbackMixin):
-    # Set RPC API version to 1.0 by default.
-    RPC_API_VERSION = '1.0'
+    # API version history:
+    #     1.0 - Initial version.
+    #     1.1 - get_devices_details
+    #     1.2 - update_devices_down
+    RPC_API_VERSION = '1.2'
         
     #to be compatible with Linux Bridge Agent on Network Node
     TAP_PREFIX_LEN = 3
@@ -56,6 +59,37 @@ class MlnxRpcCallbacks(dhcp_rpc_base.DhcpRpcCallbackMixin):
             port = db.get_port_from_device_mac(device)
         return  port
 
+    @classmethod
+    def get_ports_from_devices(cls, devices):
+        """
+           Bulk get_port_from_device
+           @return: {device: port} of the devices found
+        """
+        ports_by_prefix, ports_by_mac = db.get_ports_from_devices(
+            [device[cls.TAP_PREFIX_LEN:] for device in devices
+             if len(device) > cls.TAP_PREFIX_LEN], devices)
+        ports = {}
+        for device in devices:
+            port = ports_by_prefix.get(device[cls.TAP_PREFIX_LEN:])
+            if port:
+                port['device'] = device
+            else:
+                port = ports_by_mac.get(device)
+            if port:
+                ports[device] = port
+        return ports
+
+    @staticmethod
+    def _device_entry(device, port, binding):
+        return {'device': device,
+                'physical_network': binding.physical_network,
+                'network_type':'vlan',
+                'vlan_id': binding.segmentation_id,
+                'network_id': port['network_id'],
+                'port_mac':port['mac_address'],
+                'port_id': port['id'],
+                'admin_state_up': port['admin_state_up']}
+
     def get_device_details(self, rpc_context, **kwargs):
         """Agent requests device details"""
         agent_id = kwargs.get('agent_id')
@@ -65,14 +99,7 @@ class MlnxRpcCallbacks(dhcp_rpc_base.DhcpRpcCallbackMixin):
         if port:
             binding = db.get_network_binding(db_api.get_session(),
                                              port['network_id'])
-            entry = {'device': device,
-                     'physical_network': binding.physical_network,
-                     'network_type':'vlan',
-                     'vlan_id': binding.segmentation_id,
-                     'network_id': port['network_id'],
-                     'port_mac':port['mac_address'],
-                     'port_id': port['id'],
-                     'admin_state_up': port['admin_state_up']}
+            entry = self._device_entry(device, port, binding)
             # Set the port status to UP
             db.set_port_status(port['id'], q_const.PORT_STATUS_ACTIVE)
         else:
@@ -80,6 +107,31 @@ class MlnxRpcCallbacks(dhcp_rpc_base.DhcpRpcCallbackMixin):
             LOG.debug("%s can not be found in database", device)
         return entry
 
+    def get_devices_details(self, rpc_context, **kwargs):
+        """Agent requests details of several devices"""
+        agent_id = kwargs.get('agent_id')
+        devices = kwargs.get('devices') or []
+        LOG.debug("Details of %d devices requested from %s", len(devices),
+                  agent_id)
+        ports = self.get_ports_from_devices(devices)
+        bindings = db.get_network_bindings(db_api.get_session(),
+                                           set(port['network_id'] for port
+                                               in ports.itervalues()))
+        entries = []
+        port_ids = []
+        for device in devices:
+            port = ports.get(device)
+            binding = port and bindings.get(port['network_id'])
+            if binding:
+                entries.append(self._device_entry(device, port, binding))
+                port_ids.append(port['id'])
+            else:
+                entries.append({'device': device})
+                LOG.debug("%s can not be found in database", device)
+        # Set the ports status to UP
+        db.set_ports_status(port_ids, q_const.PORT_STATUS_ACTIVE)
+        return entries
+
     def update_device_down(self, rpc_context, **kwargs):
         """Device no longer exists on agent"""
         agent_id = kwargs.get('agent_id')
@@ -96,3 +148,24 @@ class MlnxRpcCallbacks(dhcp_rpc_base.DhcpRpcCallbackMixin):
                      'exists': False}
             LOG.debug("%s can not be found in database", device)
         return entry
+
+    def update_devices_down(self, rpc_context, **kwargs):
+        """Devices no longer exist on agent"""
+        agent_id = kwargs.get('agent_id')
+        devices = kwargs.get('devices') or []
+        LOG.debug("%d devices no longer exist on %s", len(devices), agent_id)
+        ports_by_prefix, ports_by_mac = db.get_ports_from_devices(
+            [device for device in devices if device], devices)
+        entries = []
+        port_ids = []
+        for device in devices:
+            port = ports_by_prefix.get(device) or ports_by_mac.get(device)
+            if port:
+                port_ids.append(port['id'])
+            else:
+                LOG.debug("%s can not be found in database", device)
+            entries.append({'device': device,
+                            'exists': bool(port)})
+        # Set the ports status to DOWN
+        db.set_ports_status(port_ids, q_const.PORT_STATUS_DOWN)
+        return entries
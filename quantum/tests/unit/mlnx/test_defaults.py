@@ -34,6 +34,12 @@ class ConfigurationTest(unittest.TestCase):
                          cfg.CONF.AGENT.root_helper)
         self.assertEqual(True,
                          cfg.CONF.AGENT.rpc)
+        self.assertEqual(8,
+                         cfg.CONF.AGENT.device_workers)
+        self.assertEqual(3,
+                         cfg.CONF.AGENT.device_retries)
+        self.assertEqual(4096,
+                         cfg.CONF.AGENT.max_ports)
         self.assertEqual('vlan',
                          cfg.CONF.VLANS.tenant_network_type)
         self.assertEqual(1,
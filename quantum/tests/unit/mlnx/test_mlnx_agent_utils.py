@@ -0,0 +1,150 @@
+# Copyright (c) 2012 OpenStack, LLC.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import os
+import shutil
+import tempfile
+
+import eventlet
+from eventlet.green import zmq
+import unittest2
+
+from quantum.plugins.mlnx.agent import utils
+from quantum.plugins.mlnx.common import codec
+from quantum.plugins.mlnx.common import exceptions
+
+FABRIC = 'fabric1'
+MAC = 'fa:16:3e:00:00:01'
+
+
+class FakeDaemon(object):
+    """Answers the agent's requests, without the actions in unsupported"""
+
+    def __init__(self, unsupported=()):
+        self.unsupported = set(unsupported)
+        self.actions = []
+
+    def __call__(self, msg):
+        self.actions.append(msg['action'])
+        if msg['action'] in self.unsupported:
+            return {'action': msg['action'], 'status': 'FAIL',
+                    'reason': utils.UNKNOWN_ACTION}
+        if msg['action'] == 'batch':
+            return {'action': 'batch', 'status': 'OK',
+                    'response': {'results': [
+                        {'action': sub_msg['action'], 'status': 'OK'}
+                        for sub_msg in msg['msgs']]}}
+        return {'action': msg['action'], 'status': 'OK'}
+
+
+class eSwitchUtilsTest(unittest2.TestCase):
+    def _utils(self, daemon):
+        esw_utils = utils.eSwitchUtils()
+        esw_utils._send_request = (
+            lambda msg: esw_utils.parse_response(daemon(msg)))
+        return esw_utils
+
+    def test_batch(self):
+        daemon = FakeDaemon()
+        esw_utils = self._utils(daemon)
+        self.assertTrue(esw_utils.set_port_vlan_id_and_up(FABRIC, 10, MAC))
+        self.assertEqual(daemon.actions, ['batch'])
+
+    def test_batch_unsupported(self):
+        daemon = FakeDaemon(unsupported=['batch'])
+        esw_utils = self._utils(daemon)
+        self.assertTrue(esw_utils.set_port_vlan_id_and_up(FABRIC, 10, MAC))
+        self.assertTrue(esw_utils.set_port_vlan_id_and_up(FABRIC, 20, MAC))
+        self.assertEqual(daemon.actions, ['batch', 'set_vlan', 'port_up',
+                                          'set_vlan', 'port_up'])
+
+    def test_failure_is_not_unsupported(self):
+        esw_utils = self._utils(lambda msg: {'action': msg['action'],
+                                             'status': 'FAIL',
+                                             'reason': 'Set VLAN Failed'})
+        self.assertRaises(exceptions.MlxException,
+                          esw_utils.set_port_vlan_id_and_up, FABRIC, 10, MAC)
+        self.assertEqual(esw_utils.unsupported, set())
+
+    def test_get_vnics_since_unsupported(self):
+        daemon = FakeDaemon(unsupported=['get_vnics_since'])
+        esw_utils = self._utils(daemon)
+        self.assertIsNone(esw_utils.get_attached_vnics_since())
+        self.assertIsNone(esw_utils.get_attached_vnics_since())
+        self.assertEqual(daemon.actions, ['get_vnics_since'])
+
+
+class JobsTest(unittest2.TestCase):
+    def setUp(self):
+        state_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, state_dir)
+        self.addCleanup(setattr, utils, 'MLX_DAEMON_EVENTS',
+                        utils.MLX_DAEMON_EVENTS)
+        utils.MLX_DAEMON_EVENTS = 'ipc://%s' % os.path.join(state_dir,
+                                                            'events')
+        self.context = zmq.Context()
+        self.publisher = self.context.socket(zmq.PUB)
+        self.publisher.setsockopt(zmq.LINGER, 0)
+        self.publisher.bind(utils.MLX_DAEMON_EVENTS)
+        self.addCleanup(self.publisher.close)
+        self.publish = True
+        self.jobs = {}
+        self.esw_utils = utils.eSwitchUtils()
+        self.esw_utils._send_request = (
+            lambda msg: self.esw_utils.parse_response(self._daemon(msg)))
+
+    def _daemon(self, msg):
+        if msg['action'] == 'get_job':
+            job = self.jobs[msg['job_id']]
+            return {'action': 'get_job', 'status': 'OK', 'response': job}
+        self.assertTrue(msg.pop('async'))
+        job_id = 'job%d' % len(self.jobs)
+        result = {'action': msg['action'], 'status': 'OK'}
+        self.jobs[job_id] = {'job_id': job_id, 'state': 'DONE',
+                             'result': result}
+        if self.publish:
+            # the subscription needs a moment to reach the publisher
+            eventlet.spawn_after(0.1, self.publisher.send_multipart,
+                                 [utils.JOB_TOPIC,
+                                  codec.encode({'job_id': job_id,
+                                                'result': result})])
+        return {'action': msg['action'], 'status': 'OK',
+                'response': {'job_id': job_id}}
+
+    def test_wait_jobs(self):
+        job_ids = [self.esw_utils.set_port_vlan_id_async('fabric1', vlan, MAC)
+                   for vlan in (10, 20)]
+        # results come from the notifications, not from get_job
+        for job in self.jobs.values():
+            job['state'] = 'PENDING'
+            del job['result']
+        results = self.esw_utils.wait_jobs(job_ids, timeout=5000)
+        self.assertEqual(sorted(results), job_ids)
+        self.assertEqual(results['job0']['status'], 'OK')
+
+    def test_missed_notification(self):
+        self.publish = False
+        job_id = self.esw_utils.set_port_vlan_id_async('fabric1', 10, MAC)
+        results = self.esw_utils.wait_jobs([job_id], timeout=100)
+        self.assertEqual(results[job_id]['action'], 'set_vlan')
+
+    def test_job_timeout(self):
+        self.publish = False
+        job_id = self.esw_utils.set_port_vlan_id_async('fabric1', 10, MAC)
+        del self.jobs[job_id]['result']
+        self.jobs[job_id]['state'] = 'PENDING'
+        self.assertRaises(exceptions.MlxException,
+                          self.esw_utils.wait_jobs, [job_id], timeout=100)
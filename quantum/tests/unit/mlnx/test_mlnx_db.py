@@ -17,6 +17,8 @@ import unittest2
 
 from quantum.common import exceptions as q_exc
 from quantum.db import api as db
+from quantum.db import models_v2
+from quantum.plugins.mlnx import rpc_callbacks
 from quantum.plugins.mlnx.db import mlnx_db_v2 as mlnx_db
 
 PHYS_NET = 'physnet1'
@@ -28,6 +30,10 @@ VLAN_RANGES = {PHYS_NET: [(VLAN_MIN, VLAN_MAX)]}
 UPDATED_VLAN_RANGES = {PHYS_NET: [(VLAN_MIN + 5, VLAN_MAX + 5)],
                        PHYS_NET_2: [(VLAN_MIN + 20, VLAN_MAX + 20)]}
 TEST_NETWORK_ID = 'abcdefghijklmnopqrstuvwxyz'
+TEST_PORT_ID = '12345678-1234-1234-1234-123456789012'
+TEST_PORT_ID_2 = '87654321-4321-4321-4321-210987654321'
+TEST_MAC = '00:11:22:33:44:55'
+TEST_MAC_2 = '00:11:22:33:44:66'
 
 
 class SegmentationIdAllocationTest(unittest2.TestCase):
@@ -164,3 +170,98 @@ class NetworkBindingsTest(unittest2.TestCase):
         self.assertEqual(binding.network_type,NET_TYPE)
         self.assertEqual(binding.physical_network, PHYS_NET)
         self.assertEqual(binding.segmentation_id, 1234)
+
+    def test_get_network_bindings(self):
+        self.assertEqual(mlnx_db.get_network_bindings(self.session,
+                                                      [TEST_NETWORK_ID]), {})
+        mlnx_db.add_network_binding(self.session, TEST_NETWORK_ID, NET_TYPE,
+                                    PHYS_NET, 1234)
+        bindings = mlnx_db.get_network_bindings(self.session,
+                                                [TEST_NETWORK_ID, 'other'])
+        self.assertEqual(bindings.keys(), [TEST_NETWORK_ID])
+        self.assertEqual(bindings[TEST_NETWORK_ID].segmentation_id, 1234)
+
+
+class PortsFromDevicesTest(unittest2.TestCase):
+    def setUp(self):
+        mlnx_db.initialize()
+        self.session = db.get_session()
+        with self.session.begin():
+            self.session.add(models_v2.Network(id=TEST_NETWORK_ID,
+                                               tenant_id='tenant',
+                                               name='net',
+                                               status='ACTIVE',
+                                               admin_state_up=True,
+                                               shared=False))
+            for port_id, mac in ((TEST_PORT_ID, TEST_MAC),
+                                 (TEST_PORT_ID_2, TEST_MAC_2)):
+                self.session.add(models_v2.Port(id=port_id,
+                                                tenant_id='tenant',
+                                                name='port',
+                                                network_id=TEST_NETWORK_ID,
+                                                mac_address=mac,
+                                                admin_state_up=True,
+                                                status='DOWN',
+                                                device_id='vm',
+                                                device_owner='compute:None'))
+
+    def tearDown(self):
+        db.clear_db()
+
+    def test_get_ports_from_devices(self):
+        prefix = TEST_PORT_ID[:11]
+        by_prefix, by_mac = mlnx_db.get_ports_from_devices(
+            [prefix, 'unknown'], [TEST_MAC_2, 'ff:ff:ff:ff:ff:ff'])
+        self.assertEqual(by_prefix.keys(), [prefix])
+        self.assertEqual(by_prefix[prefix]['id'], TEST_PORT_ID)
+        self.assertEqual(by_mac.keys(), [TEST_MAC_2])
+        self.assertEqual(by_mac[TEST_MAC_2]['id'], TEST_PORT_ID_2)
+
+    def test_get_ports_from_no_devices(self):
+        self.assertEqual(mlnx_db.get_ports_from_devices([], []), ({}, {}))
+
+    def test_set_ports_status(self):
+        self.assertEqual(mlnx_db.set_ports_status([TEST_PORT_ID,
+                                                   TEST_PORT_ID_2],
+                                                  'ACTIVE'), 2)
+        session = db.get_session()
+        for port in session.query(models_v2.Port):
+            self.assertEqual(port['status'], 'ACTIVE')
+
+    def test_get_devices_details(self):
+        mlnx_db.add_network_binding(self.session, TEST_NETWORK_ID, NET_TYPE,
+                                    PHYS_NET, 1234)
+        callbacks = rpc_callbacks.MlnxRpcCallbacks(None)
+        tap_device = 'tap' + TEST_PORT_ID[:11]
+        entries = callbacks.get_devices_details(None,
+                                                devices=[tap_device,
+                                                         'unknown',
+                                                         TEST_MAC_2],
+                                                agent_id='fake_agent_id')
+        self.assertEqual([entry['device'] for entry in entries],
+                         [tap_device, 'unknown', TEST_MAC_2])
+        self.assertEqual(entries[0]['port_id'], TEST_PORT_ID)
+        self.assertEqual(entries[0]['vlan_id'], 1234)
+        self.assertNotIn('port_id', entries[1])
+        self.assertEqual(entries[2]['port_id'], TEST_PORT_ID_2)
+        self.assertEqual(entries[2]['physical_network'], PHYS_NET)
+        session = db.get_session()
+        for port in session.query(models_v2.Port):
+            self.assertEqual(port['status'], 'ACTIVE')
+
+    def test_update_devices_down(self):
+        mlnx_db.set_ports_status([TEST_PORT_ID, TEST_PORT_ID_2], 'ACTIVE')
+        callbacks = rpc_callbacks.MlnxRpcCallbacks(None)
+        entries = callbacks.update_devices_down(None,
+                                                devices=[TEST_PORT_ID[:11],
+                                                         'unknown'],
+                                                agent_id='fake_agent_id')
+        self.assertEqual(entries, [{'device': TEST_PORT_ID[:11],
+                                    'exists': True},
+                                   {'device': 'unknown',
+                                    'exists': False}])
+        session = db.get_session()
+        statuses = dict((port['id'], port['status'])
+                        for port in session.query(models_v2.Port))
+        self.assertEqual(statuses, {TEST_PORT_ID: 'DOWN',
+                                    TEST_PORT_ID_2: 'ACTIVE'})
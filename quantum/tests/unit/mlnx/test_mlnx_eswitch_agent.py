@@ -0,0 +1,119 @@
+# Copyright (c) 2012 OpenStack, LLC.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import collections
+
+import unittest2
+
+from quantum.plugins.mlnx.agent import eswitch_quantum_agent
+
+MAC_1 = 'fa:16:3e:00:00:01'
+MAC_2 = 'fa:16:3e:00:00:02'
+
+
+class FakeUtils(object):
+    """eSwitchUtils answering get_vnics_since and feeding vNIC events"""
+
+    def __init__(self):
+        self.events = collections.deque()
+        self.calls = []
+        self.epoch = 'epoch1'
+        self.seq = 5
+        self.vnics = {MAC_1: {'mac': MAC_1, 'device_id': 'vm1'}}
+
+    def get_attached_vnics_since(self, generation=None, epoch=None):
+        self.calls.append('get_vnics_since')
+        if self.epoch is None:
+            # daemon without get_vnics_since
+            return None
+        return {'epoch': self.epoch, 'seq': self.seq, 'generation': {},
+                'full': True, 'added': dict(self.vnics), 'removed': []}
+
+    def get_attached_vnics(self):
+        self.calls.append('get_vnics')
+        return dict(self.vnics)
+
+    def get_vnic_events(self, timeout):
+        events = list(self.events)
+        self.events.clear()
+        return events
+
+    def add_event(self, event, vnic_mac, seq, epoch=None, **fields):
+        fields.update({'event': event, 'vnic_mac': vnic_mac, 'seq': seq,
+                       'epoch': epoch or self.epoch, 'fabric': 'fabric1'})
+        self.events.append(fields)
+
+
+class VnicEventsTest(unittest2.TestCase):
+    def setUp(self):
+        self.eswitch = eswitch_quantum_agent.EswitchMngr({})
+        self.utils = FakeUtils()
+        self.eswitch.utils = self.utils
+        self.assertEqual(self.eswitch.get_vnics_mac(), set([MAC_1]))
+
+    def test_event_in_order(self):
+        self.utils.add_event('attach', MAC_2, 6, device_id='vm2')
+        self.utils.add_event('detach', MAC_1, 7)
+        self.assertTrue(self.eswitch.wait_vnic_events(1))
+        self.assertEqual(self.eswitch.get_vnics_mac(), set([MAC_2]))
+        self.assertEqual(self.eswitch.vnics_seq, 7)
+        self.assertEqual(self.utils.calls, ['get_vnics_since'])
+
+    def test_covered_event_ignored(self):
+        self.utils.add_event('detach', MAC_1, 5)
+        self.assertFalse(self.eswitch.wait_vnic_events(1))
+        self.assertEqual(self.eswitch.get_vnics_mac(), set([MAC_1]))
+        self.assertEqual(self.utils.calls, ['get_vnics_since'] * 2)
+
+    def test_seq_gap_resyncs(self):
+        self.utils.vnics[MAC_2] = {'mac': MAC_2, 'device_id': 'vm2'}
+        self.utils.seq = 7
+        self.utils.add_event('attach', MAC_2, 7, device_id='vm2')
+        self.assertFalse(self.eswitch.wait_vnic_events(1))
+        self.assertEqual(self.eswitch.get_vnics_mac(), set([MAC_1, MAC_2]))
+        self.assertEqual(self.utils.calls, ['get_vnics_since'] * 2)
+        self.assertEqual(self.eswitch.vnics_seq, 7)
+
+    def test_new_epoch_resyncs(self):
+        self.utils.epoch = 'epoch2'
+        self.utils.seq = 1
+        self.utils.vnics = {}
+        self.utils.add_event('detach', MAC_1, 1)
+        self.assertFalse(self.eswitch.wait_vnic_events(1))
+        self.assertEqual(self.eswitch.get_vnics_mac(), set())
+        self.assertEqual(self.utils.calls, ['get_vnics_since'] * 2)
+        self.assertEqual(self.eswitch.vnics_epoch, 'epoch2')
+        # events of the new epoch apply from now on
+        self.utils.add_event('attach', MAC_2, 2, device_id='vm2')
+        self.assertTrue(self.eswitch.wait_vnic_events(1))
+        self.assertEqual(self.eswitch.get_vnics_mac(), set([MAC_2]))
+
+
+class GetVnicsTest(unittest2.TestCase):
+    def setUp(self):
+        self.eswitch = eswitch_quantum_agent.EswitchMngr({})
+        self.utils = FakeUtils()
+        self.eswitch.utils = self.utils
+
+    def test_get_vnics_since_unsupported(self):
+        self.utils.epoch = None
+        self.assertEqual(self.eswitch.get_vnics_mac(), set([MAC_1]))
+        self.assertEqual(self.utils.calls, ['get_vnics_since', 'get_vnics'])
+        self.assertIsNone(self.eswitch.vnics_seq)
+        # events are not trusted without a get_vnics_since seq
+        self.utils.add_event('attach', MAC_2, 1, epoch='epoch1',
+                             device_id='vm2')
+        self.assertFalse(self.eswitch.wait_vnic_events(1))
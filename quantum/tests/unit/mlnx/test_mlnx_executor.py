@@ -0,0 +1,65 @@
+# Copyright (c) 2012 OpenStack, LLC.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import eventlet
+import unittest2
+
+from quantum.plugins.mlnx.agent import executor
+
+
+class DeviceExecutorTest(unittest2.TestCase):
+    def setUp(self):
+        self.executor = executor.DeviceExecutor(4)
+        self.processed = []
+
+    def _process(self, device):
+        if device.startswith('bad'):
+            raise ValueError(device)
+        eventlet.sleep(0)
+        self.processed.append(device)
+
+    def test_run(self):
+        failed = self.executor.run(self._process, ['dev1', 'bad1', 'dev2'])
+        self.assertEqual(failed, set(['bad1']))
+        self.assertEqual(sorted(self.processed), ['dev1', 'dev2'])
+
+    def test_run_key(self):
+        items = [{'device': 'dev1'}, {'device': 'bad1'}]
+        failed = self.executor.run(lambda item: self._process(item['device']),
+                                   items, key=lambda item: item['device'])
+        self.assertEqual(failed, set(['bad1']))
+
+    def test_failures(self):
+        for attempt in range(3):
+            self.executor.run(self._process, ['bad1', 'dev1'])
+        self.assertEqual(self.executor.get_failures('bad1'), 3)
+        self.assertEqual(self.executor.get_failures('dev1'), 0)
+        self.executor.reset('bad1')
+        self.assertEqual(self.executor.get_failures('bad1'), 0)
+
+    def test_concurrency(self):
+        running = []
+        peak = []
+
+        def _process(device):
+            running.append(device)
+            peak.append(len(running))
+            eventlet.sleep(0.01)
+            running.remove(device)
+
+        failed = self.executor.run(_process,
+                                   ['dev%d' % i for i in range(10)])
+        self.assertEqual(failed, set())
+        self.assertEqual(max(peak), 4)
@@ -0,0 +1,85 @@
+# Copyright (c) 2012 OpenStack, LLC.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import unittest2
+
+from quantum.plugins.mlnx.agent import port_registry
+
+NET_1 = 'net1'
+NET_2 = 'net2'
+PHYS_NET = 'physnet1'
+MAC_1 = '00:11:22:33:44:55'
+MAC_2 = '00:11:22:33:44:66'
+MAC_3 = '00:11:22:33:44:77'
+
+
+class PortRegistryTest(unittest2.TestCase):
+    def setUp(self):
+        self.registry = port_registry.PortRegistry()
+
+    def test_add(self):
+        self.registry.add(NET_1, PHYS_NET, 'port1', MAC_1)
+        self.assertIn(MAC_1, self.registry)
+        self.assertEqual(self.registry.get(MAC_1)['port_id'], 'port1')
+        self.assertEqual(self.registry.get(MAC_1)['physical_network'],
+                         PHYS_NET)
+        self.assertIsNone(self.registry.get(MAC_2))
+
+    def test_add_deduplicates(self):
+        for attempt in range(3):
+            self.registry.add(NET_1, PHYS_NET, 'port1', MAC_1)
+        self.assertEqual(len(self.registry), 1)
+        self.assertEqual(len(self.registry.get_network_ports(NET_1)), 1)
+
+    def test_add_moves_network(self):
+        self.registry.add(NET_1, PHYS_NET, 'port1', MAC_1)
+        self.registry.add(NET_2, PHYS_NET, 'port1', MAC_1)
+        self.assertEqual(self.registry.get_network_ports(NET_1), [])
+        self.assertEqual(self.registry.get(MAC_1)['network_id'], NET_2)
+        self.assertEqual(self.registry.get_stats()['networks'], 1)
+
+    def test_remove(self):
+        self.registry.add(NET_1, PHYS_NET, 'port1', MAC_1)
+        self.assertEqual(self.registry.remove(MAC_1)['port_id'], 'port1')
+        self.assertIsNone(self.registry.remove(MAC_1))
+        self.assertEqual(self.registry.get_stats(),
+                         {'ports': 0, 'networks': 0, 'overflows': 0})
+
+    def test_remove_network(self):
+        self.registry.add(NET_1, PHYS_NET, 'port1', MAC_1)
+        self.registry.add(NET_1, PHYS_NET, 'port2', MAC_2)
+        self.registry.add(NET_2, PHYS_NET, 'port3', MAC_3)
+        self.assertEqual(self.registry.remove_network(NET_1),
+                         set([MAC_1, MAC_2]))
+        self.assertNotIn(MAC_1, self.registry)
+        self.assertIn(MAC_3, self.registry)
+        self.assertEqual(self.registry.remove_network(NET_1), set())
+
+    def test_max_ports(self):
+        registry = port_registry.PortRegistry(max_ports=2)
+        registry.add(NET_1, PHYS_NET, 'port1', MAC_1)
+        registry.add(NET_1, PHYS_NET, 'port2', MAC_2)
+        # registering a known port again is not an overflow
+        registry.add(NET_1, PHYS_NET, 'port1', MAC_1)
+        self.assertEqual(registry.get_stats()['overflows'], 0)
+        registry.add(NET_2, PHYS_NET, 'port3', MAC_3)
+        # ports beyond the limit are kept
+        self.assertEqual(len(registry), 3)
+        self.assertIn(MAC_1, registry)
+        self.assertIn(MAC_2, registry)
+        self.assertEqual(registry.get(MAC_3)['port_id'], 'port3')
+        self.assertEqual(registry.get_stats(),
+                         {'ports': 3, 'networks': 2, 'overflows': 1})
+        self.assertEqual(registry.remove(MAC_1)['port_id'], 'port1')
@@ -26,16 +26,19 @@ from quantum.agent import rpc as agent_rpc
 from quantum.common import topics
 from quantum.openstack.common import context
 from quantum.openstack.common import rpc
+from quantum.openstack.common.rpc import common as rpc_common
 from quantum.plugins.mlnx import agent_notify_api
+from quantum.plugins.mlnx.agent import plugin_api
 
 
 class rpcApiTestCase(unittest2.TestCase):
 
-    def _test_mlnx_api(self, rpcapi, topic, method, rpc_method, **kwargs):
+    def _test_mlnx_api(self, rpcapi, topic, method, rpc_method,
+                       version=None, **kwargs):
         ctxt = context.RequestContext('fake_user', 'fake_project')
         expected_retval = 'foo' if method == 'call' else None
         expected_msg = rpcapi.make_msg(method, **kwargs)
-        expected_msg['version'] = rpcapi.BASE_RPC_API_VERSION
+        expected_msg['version'] = version or rpcapi.BASE_RPC_API_VERSION
         if rpc_method == 'cast' and method == 'run_instance':
             kwargs['call'] = False
 
@@ -93,3 +96,57 @@ class rpcApiTestCase(unittest2.TestCase):
                           'update_device_down', rpc_method='call',
                           device='fake_device',
                           agent_id='fake_agent_id')
+
+    def test_devices_details(self):
+        rpcapi = plugin_api.MlnxPluginApi(topics.PLUGIN)
+        self._test_mlnx_api(rpcapi, topics.PLUGIN,
+                          'get_devices_details', rpc_method='call',
+                          version='1.1',
+                          devices=['fake_device'],
+                          agent_id='fake_agent_id')
+
+    def test_devices_details_fallback(self):
+        rpcapi = plugin_api.MlnxPluginApi(topics.PLUGIN)
+        ctxt = context.RequestContext('fake_user', 'fake_project')
+        self.calls = []
+
+        def _fake_call(context, topic, msg, timeout=None):
+            self.calls.append(msg)
+            if msg['method'] == 'get_devices_details':
+                raise rpc_common.RemoteError('UnsupportedRpcVersion')
+            return {'device': msg['args']['device']}
+
+        self.stubs = stubout.StubOutForTesting()
+        self.stubs.Set(rpc, 'call', _fake_call)
+        devices = ['fake_device1', 'fake_device2']
+        for attempt in range(2):
+            retval = rpcapi.get_devices_details(ctxt, devices, 'fake_agent_id')
+            self.assertEqual(retval, [{'device': device}
+                                      for device in devices])
+        # the bulk call is not retried once it failed
+        self.assertEqual([msg['method'] for msg in self.calls],
+                         ['get_devices_details'] +
+                         ['get_device_details'] * 4)
+        self.stubs.UnsetAll()
+
+    def test_devices_details_remote_error(self):
+        rpcapi = plugin_api.MlnxPluginApi(topics.PLUGIN)
+        ctxt = context.RequestContext('fake_user', 'fake_project')
+
+        def _fake_call(context, topic, msg, timeout=None):
+            raise rpc_common.RemoteError('DBError')
+
+        self.stubs = stubout.StubOutForTesting()
+        self.stubs.Set(rpc, 'call', _fake_call)
+        with self.assertRaises(rpc_common.RemoteError):
+            rpcapi.get_devices_details(ctxt, ['fake_device'], 'fake_agent_id')
+        self.assertEqual(rpcapi.unsupported, set())
+        self.stubs.UnsetAll()
+
+    def test_update_devices_down(self):
+        rpcapi = plugin_api.MlnxPluginApi(topics.PLUGIN)
+        self._test_mlnx_api(rpcapi, topics.PLUGIN,
+                          'update_devices_down', rpc_method='call',
+                          version='1.2',
+                          devices=['fake_device'],
+                          agent_id='fake_agent_id')